@@ -0,0 +1,301 @@
+"""Contention-safe spot allocation.
+
+A spot is claimed with a single conditional UPDATE (``status`` flips from
+``'A'`` to ``'O'`` only if it is still ``'A'``), so two workers racing for
+the same spot can never both win. The reservation row is written in the
+same transaction as the claim. The in-memory free-spot index is used to
+pick candidates and is kept in step with every claim and release.
+
+Each function works in the shard of the spot, lot or reservation it is
+given, so bookings on different shards never share a write lock.
+
+With write-behind bookings on (write_behind.py), claims and releases are
+decided in memory and logged instead, and the database is written later
+in batches; the returned Reservation is then transient.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+
+from models import db, ParkingSpot, Reservation
+from spot_index import free_spots
+from booking_index import booking_index, end_checked_in
+import analytics
+import billing
+import cache
+from availability import hub
+import reports
+import shards
+import write_behind
+
+
+MAX_CLAIM_ATTEMPTS = 8
+CANDIDATE_WINDOW = 16
+RETRY_BACKOFF_SECONDS = 0.01
+
+
+def backoff(attempt):
+    time.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt) * random.random())
+
+
+def _try_claim(spot_id, user_id, vehicle_number):
+    """Compare-and-swap one spot. Returns the Reservation or None if it was taken."""
+    result = db.session.execute(
+        update(ParkingSpot)
+        .where(ParkingSpot.id == spot_id, ParkingSpot.status == 'A')
+        .values(status='O')
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None
+
+    now = datetime.utcnow()
+    reservation = Reservation(user_id=user_id, spot_id=spot_id, vechile_number=vehicle_number, parking_timestamp=now)
+    db.session.add(reservation)
+    reports.record_claim(spot_id)
+    analytics.record_booking(spot_id, now)
+    db.session.commit()
+    # Loaded here, in its shard: callers may read it outside shards.use().
+    db.session.refresh(reservation)
+    free_spots.mark_occupied(spot_id)
+    hub.publish(free_spots.lot_of(spot_id))
+    cache.invalidate_bookings(user_id)
+    return reservation
+
+
+def claim_spot(spot_id, user_id, vehicle_number):
+    """Books a specific spot. Returns the new Reservation, or None if the spot is not free."""
+    if write_behind.enabled():
+        return write_behind.claim(None, spot_id, user_id, vehicle_number)
+    with shards.use(shards.for_id(spot_id)):
+        for attempt in range(MAX_CLAIM_ATTEMPTS):
+            try:
+                return _try_claim(spot_id, user_id, vehicle_number)
+            except OperationalError:
+                # The database was locked by another writer; back off and retry.
+                db.session.rollback()
+                backoff(attempt)
+    return None
+
+
+def _walk_in_window(now=None):
+    """The stay a walk-in arriving now is assumed to need, or None if WALK_IN_STAY_HOURS is off."""
+    stay = current_app.config.get('WALK_IN_STAY_HOURS')
+    if not stay:
+        return None
+    now = now or datetime.utcnow()
+    return now, now + timedelta(hours=stay)
+
+
+def held_for_bookings(lot_id, now=None):
+    """Spots of the lot a walk-in arriving now should leave alone: booked within WALK_IN_STAY_HOURS."""
+    window = _walk_in_window(now)
+    return booking_index.held(lot_id, *window) if window else set()
+
+
+def claim_any_spot(lot_id, user_id, vehicle_number):
+    """Books any free spot in the lot that is not held for a booking. Returns the new Reservation, or None."""
+    if write_behind.enabled():
+        return write_behind.claim(lot_id, None, user_id, vehicle_number, skip=held_for_bookings(lot_id))
+    with shards.use(shards.for_lot(lot_id)):
+        return _claim_any_spot(lot_id, user_id, vehicle_number, held_for_bookings(lot_id))
+
+
+def _claim_any_spot(lot_id, user_id, vehicle_number, held):
+    attempt = 0
+    while attempt < MAX_CLAIM_ATTEMPTS:
+        spot_id = free_spots.take(lot_id, skip=held)
+        if spot_id is None:
+            break
+        try:
+            reservation = _try_claim(spot_id, user_id, vehicle_number)
+        except OperationalError:
+            db.session.rollback()
+            free_spots.mark_free(spot_id)
+            backoff(attempt)
+            attempt += 1
+            continue
+        if reservation:
+            return reservation
+        # The index was stale (another worker took the spot); it is now dropped, try the next one.
+
+    return _claim_any_spot_from_db(lot_id, user_id, vehicle_number, held)
+
+
+def _claim_any_spot_from_db(lot_id, user_id, vehicle_number, held):
+    """Fallback for when the index has no candidate, e.g. a spot freed by another worker process."""
+    for attempt in range(MAX_CLAIM_ATTEMPTS):
+        candidates = [row[0] for row in db.session.query(ParkingSpot.id)
+                      .filter_by(lot_id=lot_id, status='A')
+                      .filter(ParkingSpot.id.notin_(held))
+                      .order_by(ParkingSpot.spot_number)
+                      .limit(CANDIDATE_WINDOW)]
+        if not candidates:
+            return None
+
+        # Spread concurrent claimers over the window instead of all racing for the first spot.
+        random.shuffle(candidates)
+        try:
+            for spot_id in candidates:
+                reservation = _try_claim(spot_id, user_id, vehicle_number)
+                if reservation:
+                    return reservation
+        except OperationalError:
+            db.session.rollback()
+        backoff(attempt)
+    return None
+
+
+def _stage_release(reservation_id, cost, leaving_timestamp):
+    """Closes the reservation and frees its spot in the current transaction.
+
+    Returns (spot_id, user_id, lot_id, ended windows) for _after_release, or None if it was already released.
+    """
+    result = db.session.execute(
+        update(Reservation)
+        .where(Reservation.id == reservation_id, Reservation.leaving_timestamp.is_(None))
+        .values(leaving_timestamp=leaving_timestamp, parking_cost=cost)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return None
+
+    spot_id, user_id, parked_at, lot_id = db.session.query(
+        Reservation.spot_id, Reservation.user_id, Reservation.parking_timestamp, ParkingSpot.lot_id
+    ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
+     .filter(Reservation.id == reservation_id).one()
+    db.session.execute(
+        update(ParkingSpot)
+        .where(ParkingSpot.id == spot_id)
+        .values(status='A')
+        .execution_options(synchronize_session=False)
+    )
+    reports.record_release(spot_id, cost)
+    analytics.record_release(lot_id, parked_at, leaving_timestamp, cost)
+    return spot_id, user_id, lot_id, end_checked_in({reservation_id: leaving_timestamp})
+
+
+def _after_release(spot_id, user_id, lot_id, ended):
+    free_spots.mark_free(spot_id)
+    for window in ended:
+        booking_index.remove(*window)
+    hub.publish(lot_id)
+    cache.invalidate_bookings(user_id)
+
+
+def release_reservation(reservation_id, cost, leaving_timestamp=None):
+    """Closes an active reservation and frees its spot. Returns False if it was already released."""
+    leaving_timestamp = leaving_timestamp or datetime.utcnow()
+    if write_behind.enabled():
+        return write_behind.release({reservation_id: cost}, leaving_timestamp) == 1
+    with shards.use(shards.for_id(reservation_id)):
+        for attempt in range(MAX_CLAIM_ATTEMPTS):
+            try:
+                released = _stage_release(reservation_id, cost, leaving_timestamp)
+                if released is None:
+                    db.session.rollback()
+                    return False
+                db.session.commit()
+                _after_release(*released)
+                return True
+            except OperationalError:
+                db.session.rollback()
+                backoff(attempt)
+    return False
+
+
+def release_reservations(costs, leaving_timestamp=None):
+    """Releases many reservations of the current shard in one transaction. costs maps reservation id -> cost.
+
+    Reservations released in the meantime are skipped. Returns the number released.
+    """
+    leaving_timestamp = leaving_timestamp or datetime.utcnow()
+    if write_behind.enabled():
+        return write_behind.release(costs, leaving_timestamp)
+    for attempt in range(MAX_CLAIM_ATTEMPTS):
+        try:
+            released = [_stage_release(reservation_id, cost, leaving_timestamp)
+                        for reservation_id, cost in costs.items()]
+            released = [r for r in released if r is not None]
+            db.session.commit()
+            for r in released:
+                _after_release(*r)
+            return len(released)
+        except OperationalError:
+            db.session.rollback()
+            backoff(attempt)
+    return 0
+
+
+def get_reservation(reservation_id):
+    """The Reservation, or None. Under write-behind an active one may not be written yet; it comes from memory."""
+    if write_behind.enabled():
+        reservation = write_behind.active_reservation(reservation_id) or db.session.get(Reservation, reservation_id)
+        if reservation is None:
+            # Possibly booked and released moments ago, and not written yet.
+            write_behind.drain()
+            reservation = db.session.get(Reservation, reservation_id)
+        return reservation
+    return db.session.get(Reservation, reservation_id)
+
+
+# The rules behind booking and releasing, shared by the pages (routes.py) and the JSON API (api.py).
+
+SPOT_UNAVAILABLE = 'This spot is already occupied or unavailable.'
+SPOT_HELD = 'This spot is reserved for an advance booking soon; please pick another one.'
+RELEASE_REFUSED = 'Invalid reservation or already released.'
+
+
+class BookingRefused(Exception):
+    """The spot or lot cannot be booked, or the reservation released, right now. The message is for the user."""
+
+
+def check_bookable(spot):
+    if spot.status != 'A':
+        raise BookingRefused(SPOT_UNAVAILABLE)
+    window = _walk_in_window()
+    if window and not booking_index.is_free(spot.id, *window, lot_id=spot.lot_id):
+        raise BookingRefused(SPOT_HELD)
+
+
+def book_spot(spot, user_id, vehicle_number):
+    """Books spot for the user. Raises ValueError for a missing vehicle number, BookingRefused if it is taken."""
+    check_bookable(spot)
+    if not vehicle_number:
+        raise ValueError('Vehicle number is required.')
+    reservation = claim_spot(spot.id, user_id, vehicle_number)
+    if reservation is None:
+        raise BookingRefused(SPOT_UNAVAILABLE)
+    return reservation
+
+
+def book_lot(lot, user_id, vehicle_number):
+    """Books any free spot in lot for the user. Raises ValueError or BookingRefused like book_spot."""
+    if not vehicle_number:
+        raise ValueError('Vehicle number is required.')
+    reservation = claim_any_spot(lot.id, user_id, vehicle_number)
+    if reservation is None:
+        raise BookingRefused(f'No free spots left at {lot.prime_location_name}.')
+    return reservation
+
+
+def release_quote(reservation, user_id, now):
+    """What releasing the user's active reservation at now costs. Raises BookingRefused if it is not theirs to release."""
+    if reservation.user_id != user_id or reservation.leaving_timestamp is not None:
+        raise BookingRefused(RELEASE_REFUSED)
+    lot = db.session.get(ParkingSpot, reservation.spot_id).parking_lot
+    return billing.quote(lot, reservation.parking_timestamp, now)
+
+
+def release_spot(reservation, user_id, now=None):
+    """Releases the user's active reservation, charged up to now. Returns the cost; raises BookingRefused."""
+    now = now or datetime.utcnow()
+    cost = release_quote(reservation, user_id, now)
+    if not release_reservation(reservation.id, cost, now):
+        raise BookingRefused(RELEASE_REFUSED)
+    return cost
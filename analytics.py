@@ -0,0 +1,229 @@
+"""Hourly and daily occupancy rollups per lot.
+
+Each booking and release adds its contribution to the ``hourly_rollups``
+and ``daily_rollups`` rows it falls in. The rows are upserted in the same
+transaction as the booking or release, so the rollups never drift from
+the reservations. Dashboards read one row per bucket instead of scanning
+reservations, and bucket boundaries are computed in Python rather than
+with backend-specific date functions.
+
+``backfill`` rebuilds the rollups from the reservations table, e.g. after
+a bulk import or when enabling ``ANALYTICS_ROLLUPS`` on an existing
+database. Stays still in progress only count as bookings until they end.
+
+Rollups live in each lot's shard; backfills and all-lot series run on
+every shard concurrently.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import func, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, ParkingLot, ParkingSpot, Reservation, HourlyRollup, DailyRollup
+import shards
+
+
+MEASURES = ('bookings', 'releases', 'occupied_seconds', 'revenue', 'dwell_seconds')
+BACKFILL_BATCH_SIZE = 5000
+UPSERT_BATCH_SIZE = 500
+
+
+def _floor_hour(t):
+    return t.replace(minute=0, second=0, microsecond=0)
+
+
+def _floor_day(t):
+    return t.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+GRANULARITIES = {
+    # name: (model, floor, bucket width)
+    'hour': (HourlyRollup, _floor_hour, timedelta(hours=1)),
+    'day': (DailyRollup, _floor_day, timedelta(days=1)),
+}
+
+
+def rollups_enabled():
+    return bool(current_app.config.get('ANALYTICS_ROLLUPS'))
+
+
+def _split(start, end, floor, width):
+    """Yields (bucket_start, seconds of [start, end) inside that bucket)."""
+    bucket = floor(start)
+    while bucket < end:
+        following = bucket + width
+        yield bucket, (min(end, following) - max(start, bucket)).total_seconds()
+        bucket = following
+
+
+def _upsert(model, rows):
+    """Adds each row's measures to the stored bucket, creating it if needed."""
+    rows = [{"lot_id": row["lot_id"], "bucket_start": row["bucket_start"],
+             **{measure: row.get(measure, 0) for measure in MEASURES}} for row in rows]
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = dialect_insert(model).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['lot_id', 'bucket_start'],
+            set_={measure: getattr(model, measure) + getattr(stmt.excluded, measure) for measure in MEASURES},
+        ))
+        return
+
+    for row in rows:
+        result = db.session.execute(
+            update(model)
+            .where(model.lot_id == row["lot_id"], model.bucket_start == row["bucket_start"])
+            .values({measure: getattr(model, measure) + row[measure] for measure in MEASURES})
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(model).values(row))
+
+
+# Incremental maintenance, staged in the caller's transaction like reports.record_*.
+
+def record_booking(spot_id, parked_at):
+    if not rollups_enabled():
+        return
+    lot_id = select(ParkingSpot.lot_id).where(ParkingSpot.id == spot_id).scalar_subquery()
+    for model, floor, _width in GRANULARITIES.values():
+        _upsert(model, [{"lot_id": lot_id, "bucket_start": floor(parked_at), "bookings": 1}])
+
+
+def _release_rows(lot_id, parked_at, left_at, cost, floor, width):
+    rows = {bucket: {"lot_id": lot_id, "bucket_start": bucket, "occupied_seconds": seconds}
+            for bucket, seconds in _split(parked_at, left_at, floor, width)}
+    last = rows.setdefault(floor(left_at), {"lot_id": lot_id, "bucket_start": floor(left_at)})
+    last.update(releases=1, revenue=cost or 0, dwell_seconds=(left_at - parked_at).total_seconds())
+    return rows.values()
+
+
+def record_release(lot_id, parked_at, left_at, cost):
+    if not rollups_enabled():
+        return
+    for model, floor, width in GRANULARITIES.values():
+        _upsert(model, list(_release_rows(lot_id, parked_at, left_at, cost, floor, width)))
+
+
+def record_activity(bookings, releases):
+    """record_booking and record_release for many stays at once, each bucket upserted once.
+
+    bookings are (lot_id, parked_at) pairs, releases (lot_id, parked_at, left_at, cost) tuples.
+    """
+    if not rollups_enabled():
+        return
+    for model, floor, width in GRANULARITIES.values():
+        totals = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+        for lot_id, parked_at in bookings:
+            totals[lot_id, floor(parked_at)]["bookings"] += 1
+        for release in releases:
+            for row in _release_rows(*release, floor, width):
+                bucket = totals[row["lot_id"], row["bucket_start"]]
+                for measure in MEASURES:
+                    bucket[measure] += row.get(measure, 0)
+        rows = [{"lot_id": lot_id, "bucket_start": bucket_start, **measures}
+                for (lot_id, bucket_start), measures in totals.items()]
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            _upsert(model, rows[start:start + UPSERT_BATCH_SIZE])
+
+
+def record_lot_removed(lot_id):
+    for model, _floor, _width in GRANULARITIES.values():
+        model.query.filter_by(lot_id=lot_id).delete()
+
+
+def backfill(since=None):
+    """Rebuilds every rollup bucket from since (or from the beginning) onwards, in every shard.
+
+    Returns the number of reservations read.
+    """
+    return sum(shards.gather(_backfill_shard, since))
+
+
+def _backfill_shard(since):
+    if since is not None:
+        since = _floor_day(since)
+    totals = {name: defaultdict(lambda: dict.fromkeys(MEASURES, 0)) for name in GRANULARITIES}
+
+    query = db.session.query(
+        ParkingSpot.lot_id, Reservation.parking_timestamp,
+        Reservation.leaving_timestamp, Reservation.parking_cost,
+    ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)
+    if since is not None:
+        query = query.filter(or_(Reservation.parking_timestamp >= since, Reservation.leaving_timestamp >= since))
+
+    count = 0
+    for lot_id, parked_at, left_at, cost in query.yield_per(BACKFILL_BATCH_SIZE):
+        count += 1
+        for name, (_model, floor, width) in GRANULARITIES.items():
+            buckets = totals[name]
+            if since is None or parked_at >= since:
+                buckets[lot_id, floor(parked_at)]["bookings"] += 1
+            if left_at is None:
+                continue
+            for bucket, seconds in _split(max(parked_at, since or parked_at), left_at, floor, width):
+                buckets[lot_id, bucket]["occupied_seconds"] += seconds
+            last = buckets[lot_id, floor(left_at)]
+            last["releases"] += 1
+            last["revenue"] += cost or 0
+            last["dwell_seconds"] += (left_at - parked_at).total_seconds()
+
+    for name, (model, _floor, _width) in GRANULARITIES.items():
+        stale = model.query
+        if since is not None:
+            stale = stale.filter(model.bucket_start >= since)
+        stale.delete(synchronize_session=False)
+        rows = [{"lot_id": lot_id, "bucket_start": bucket, **measures}
+                for (lot_id, bucket), measures in totals[name].items()]
+        for offset in range(0, len(rows), BACKFILL_BATCH_SIZE):
+            db.session.execute(insert(model), rows[offset:offset + BACKFILL_BATCH_SIZE])
+    db.session.commit()
+    return count
+
+
+def _bucket_totals(model, start, end, lot_id):
+    query = db.session.query(
+        model.bucket_start, *(func.sum(getattr(model, measure)) for measure in MEASURES)
+    ).filter(model.bucket_start >= start, model.bucket_start < end)
+    if lot_id is not None:
+        query = query.filter(model.lot_id == lot_id)
+    return query.group_by(model.bucket_start).all()
+
+
+def series(granularity, start, end, lot_id=None):
+    """Chart data for the buckets in [start, end), for one lot or all lots.
+
+    Reads one rollup row per bucket (per lot); buckets without activity are
+    filled in with zeros.
+    """
+    model, floor, width = GRANULARITIES[granularity]
+    start, end = floor(start), floor(end)
+    spots = db.session.query(func.coalesce(func.sum(ParkingLot.maximum_number_of_spots), 0))
+    if lot_id is not None:
+        spots = spots.filter(ParkingLot.id == lot_id)
+        with shards.use(shards.for_lot(lot_id)):
+            results = [_bucket_totals(model, start, end, lot_id)]
+    else:
+        results = shards.gather(_bucket_totals, model, start, end, None)
+    rows = {}
+    for result in results:
+        for bucket, *measures in result:
+            rows[bucket] = [total + value for total, value in zip(rows.get(bucket, [0] * len(MEASURES)), measures)]
+    capacity = spots.scalar() * width.total_seconds()
+
+    data = {"labels": [], "bookings": [], "releases": [], "occupancy": [], "revenue": [], "avg_dwell_minutes": []}
+    label = '%Y-%m-%d %H:00' if granularity == 'hour' else '%Y-%m-%d'
+    bucket = start
+    while bucket < end:
+        bookings, releases, occupied, revenue, dwell = rows.get(bucket, (0, 0, 0, 0, 0))
+        data["labels"].append(bucket.strftime(label))
+        data["bookings"].append(bookings)
+        data["releases"].append(releases)
+        data["occupancy"].append(round(100 * occupied / capacity, 1) if capacity else 0)
+        data["revenue"].append(round(revenue, 2))
+        data["avg_dwell_minutes"].append(round(dwell / releases / 60, 1) if releases else 0)
+        bucket += width
+    return data
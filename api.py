@@ -0,0 +1,270 @@
+"""Versioned JSON API for the gate kiosks and the mobile app, under /api/v1.
+
+The same session cookie as the pages identifies the user (POST /session
+logs in), and booking and releasing go through the rules in allocation,
+so the API and the pages cannot disagree about who may book what.
+
+Lists use keyset pagination: a page ends with an opaque ``next`` cursor
+holding the sort key of its last row, and the next page continues after
+that key on an index (lot names are unique; a user's reservations are
+ordered by ix_reservations_user_parked), so page N costs the same as page
+one, and rows inserted meanwhile do not shift later pages. GET responses
+carry an ETag and answer a matching If-None-Match with 304, so a kiosk
+polling unchanged availability gets an empty reply. Bodies are compact
+JSON without whitespace, and fields that are null are left out.
+"""
+import base64
+import json
+import math
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, Response, request, session
+from sqlalchemy import and_, or_
+
+from models import db, ParkingLot, ParkingSpot, Reservation
+from spot_index import free_spots
+import allocation
+import auth
+import search
+import shards
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+AVAILABILITY_MAX_LOTS = 50
+
+bp = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+def init_app(app):
+    app.register_blueprint(bp)
+
+
+def _json(payload, status=200, headers=None):
+    response = Response(json.dumps(payload, separators=(',', ':')), status, headers, mimetype='application/json')
+    if request.method == 'GET' and status == 200:
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def _error(message, status, headers=None):
+    return _json({'error': message}, status, headers)
+
+
+def _compact(**fields):
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def _timestamp(value):
+    return value.isoformat(timespec='seconds') if value else None
+
+
+def login_required(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if 'user_id' not in session:
+            return _error('Log in first.', 401)
+        return func(*args, **kwargs)
+    return inner
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    """The sort key in cursor, as a list. Raises ValueError if it was not made by encode_cursor."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor.') from e
+    if not isinstance(key, list):
+        raise ValueError('Invalid cursor.')
+    return key
+
+
+def _page_size():
+    return min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+
+def _lot_json(lot_id, name, address, pin_code, price, spots):
+    return _compact(id=lot_id, name=name, address=address, pin=pin_code, price=price, spots=spots,
+                    free=free_spots.free_count(lot_id))
+
+
+def _reservation_json(reservation, spot, **overrides):
+    fields = dict(id=reservation.id, lot=spot.lot_id, spot=spot.id, spot_number=spot.spot_number,
+                  vehicle=reservation.vechile_number, parked=_timestamp(reservation.parking_timestamp),
+                  left=_timestamp(reservation.leaving_timestamp), cost=reservation.parking_cost)
+    fields.update(overrides)
+    for money in ('cost', 'quote'):
+        if fields.get(money) is not None:
+            fields[money] = round(fields[money], 2)
+    return _compact(**fields)
+
+
+@bp.route('/session', methods=['POST'])
+def log_in():
+    body = request.get_json(silent=True) or request.form
+    try:
+        user = auth.authenticate(body.get('username'), body.get('password'))
+    except auth.LoginRefused as e:
+        return _error('Too many failed attempts.', 429, {'Retry-After': str(math.ceil(e.retry_after))})
+    except auth.AuthBusy:
+        return _error('Too many people are logging in right now.', 503, {'Retry-After': '5'})
+    if user is None:
+        return _error('Invalid username or password.', 401)
+    auth.log_in(user)
+    return _json(_compact(id=user.id, username=user.username, name=user.name, admin=user.is_admin))
+
+
+@bp.route('/session', methods=['DELETE'])
+def log_out():
+    auth.log_out()
+    return Response(status=204)
+
+
+@bp.route('/lots')
+@login_required
+def lots():
+    """Lots by name, optionally only those matching ?q= (pin code prefix or name substring)."""
+    limit = _page_size()
+    query = db.session.query(ParkingLot.id, ParkingLot.prime_location_name, ParkingLot.address,
+                             ParkingLot.pin_code, ParkingLot.price, ParkingLot.maximum_number_of_spots)
+    q = request.args.get('q', '').strip()
+    if q:
+        matching = search.matching_lot_ids(q)
+        if not matching:
+            return _json({'lots': []})
+        query = query.filter(ParkingLot.id.in_(matching))
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            (after,) = decode_cursor(cursor)
+        except ValueError as e:
+            return _error(str(e), 400)
+        query = query.filter(ParkingLot.prime_location_name > after)
+    rows = query.order_by(ParkingLot.prime_location_name).limit(limit + 1).all()
+    page = {'lots': [_lot_json(*row) for row in rows[:limit]]}
+    if len(rows) > limit:
+        page['next'] = encode_cursor([rows[limit - 1].prime_location_name])
+    return _json(page)
+
+
+@bp.route('/availability')
+@login_required
+def availability():
+    """Free spots in each of ?lots=1,2,3, as {lot_id: free}."""
+    try:
+        lot_ids = sorted({int(lot_id) for lot_id in request.args.get('lots', '').split(',') if lot_id})
+    except ValueError:
+        return _error('lots must be a comma-separated list of lot ids', 400)
+    if not lot_ids or len(lot_ids) > AVAILABILITY_MAX_LOTS:
+        return _error(f'Pass between 1 and {AVAILABILITY_MAX_LOTS} lot ids.', 400)
+    known = {row[0] for row in db.session.query(ParkingLot.id).filter(ParkingLot.id.in_(lot_ids))}
+    return _json({str(lot_id): free_spots.free_count(lot_id) for lot_id in lot_ids if lot_id in known})
+
+
+@bp.route('/lots/<int:lot_id>/reservations', methods=['POST'])
+@login_required
+def book_lot(lot_id):
+    lot = db.session.get(ParkingLot, lot_id)
+    if lot is None:
+        return _error('No such lot.', 404)
+    body = request.get_json(silent=True) or request.form
+    try:
+        reservation = allocation.book_lot(lot, session['user_id'], body.get('vehicle'))
+    except ValueError as e:
+        return _error(str(e), 400)
+    except allocation.BookingRefused as e:
+        return _error(str(e), 409)
+    return _json(_reservation_json(reservation, db.session.get(ParkingSpot, reservation.spot_id)), 201)
+
+
+@bp.route('/spots/<int:spot_id>/reservations', methods=['POST'])
+@login_required
+def book_spot(spot_id):
+    spot = db.session.get(ParkingSpot, spot_id)
+    if spot is None:
+        return _error('No such spot.', 404)
+    body = request.get_json(silent=True) or request.form
+    try:
+        reservation = allocation.book_spot(spot, session['user_id'], body.get('vehicle'))
+    except ValueError as e:
+        return _error(str(e), 400)
+    except allocation.BookingRefused as e:
+        return _error(str(e), 409)
+    return _json(_reservation_json(reservation, spot), 201)
+
+
+def _history_page(user_id, after, limit):
+    query = db.session.query(Reservation, ParkingSpot)\
+                      .join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
+                      .filter(Reservation.user_id == user_id)
+    if after is not None:
+        parked, reservation_id = after
+        query = query.filter(or_(Reservation.parking_timestamp < parked,
+                                 and_(Reservation.parking_timestamp == parked, Reservation.id < reservation_id)))
+    return query.order_by(Reservation.parking_timestamp.desc(), Reservation.id.desc()).limit(limit).all()
+
+
+@bp.route('/reservations')
+@login_required
+def reservations():
+    """The user's reservations, newest first."""
+    limit = _page_size()
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            parked, reservation_id = decode_cursor(cursor)
+            after = datetime.fromisoformat(parked), int(reservation_id)
+        except (TypeError, ValueError):
+            return _error('Invalid cursor.', 400)
+    # Each shard returns its own first limit + 1 rows after the cursor; the page is the newest of those.
+    rows = sorted((row for result in shards.gather(_history_page, session['user_id'], after, limit + 1) for row in result),
+                  key=lambda row: (row[0].parking_timestamp, row[0].id), reverse=True)
+    page = {'reservations': [_reservation_json(reservation, spot) for reservation, spot in rows[:limit]]}
+    if len(rows) > limit:
+        last = rows[limit - 1][0]
+        page['next'] = encode_cursor([last.parking_timestamp.isoformat(), last.id])
+    return _json(page)
+
+
+def _own_reservation(reservation_id):
+    reservation = allocation.get_reservation(reservation_id)
+    if reservation is None or reservation.user_id != session['user_id']:
+        return None
+    return reservation
+
+
+@bp.route('/reservations/<int:reservation_id>')
+@login_required
+def reservation(reservation_id):
+    """One of the user's reservations; an active one carries what releasing it now would cost."""
+    reservation = _own_reservation(reservation_id)
+    if reservation is None:
+        return _error('No such reservation.', 404)
+    quote = None
+    if reservation.leaving_timestamp is None:
+        quote = allocation.release_quote(reservation, session['user_id'], datetime.utcnow())
+    return _json(_reservation_json(reservation, db.session.get(ParkingSpot, reservation.spot_id), quote=quote))
+
+
+@bp.route('/reservations/<int:reservation_id>/release', methods=['POST'])
+@login_required
+def release(reservation_id):
+    reservation = _own_reservation(reservation_id)
+    if reservation is None:
+        return _error('No such reservation.', 404)
+    now = datetime.utcnow()
+    # Serialized before releasing: the release commits, which would expire the loaded rows.
+    released = _reservation_json(reservation, db.session.get(ParkingSpot, reservation.spot_id), left=_timestamp(now))
+    try:
+        released['cost'] = round(allocation.release_spot(reservation, session['user_id'], now), 2)
+    except allocation.BookingRefused as e:
+        return _error(str(e), 409)
+    return _json(released)
@@ -1,16 +1,35 @@
 # app.py
 
 from flask import Flask
-app=Flask(__name__)
-import os
+import api
+import cache
 import config
-import models 
+import commands
+import instrumentation
+import models
 import routes
+import shards
+import sweeper
+import write_behind
 
 
-
-
+def create_app():
+    app = Flask(__name__)
+    config.init_app(app)
+    models.db.init_app(app)
+    instrumentation.init_app(app)
+    shards.init_app(app)
+    cache.init_app(app)
+    routes.init_app(app)
+    api.init_app(app)
+    commands.init_app(app)
+    sweeper.init_app(app)
+    write_behind.init_app(app)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True,port=5000)
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        models.init_db()
+    app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""Login fast path: session identity, pooled password checks, failed-login limits.
+
+The logged-in user's id, username, role, name and email live in the signed
+session cookie. Pages that only display them read ``current_user()`` and
+never touch the database.
+
+Password hashes (scrypt or PBKDF2) are deliberately expensive. Checks run
+on a small pool of ``AUTH_HASH_WORKERS`` threads; hashlib releases the GIL
+while hashing, so threads are enough. At most that many hashes run at once
+per worker process. When ``AUTH_HASH_MAX_PENDING`` checks are already
+waiting, new logins are turned away with a 503 rather than queued behind
+them. A login storm therefore cannot take every CPU away from booking
+requests.
+
+Failed logins are limited per username with a token bucket: a burst of
+``LOGIN_FAILURE_BURST`` failures, then one more every
+``LOGIN_FAILURE_REFILL_SECONDS``. A username with no tokens left is
+refused before its hash is checked, so guessing costs no CPU. Buckets are
+per process, like the caches.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, session
+from werkzeug.security import check_password_hash
+
+from models import db, User
+
+
+Identity = namedtuple('Identity', 'id username is_admin name email')
+
+SESSION_KEYS = ('user_id', 'username', 'is_admin', 'name', 'email')
+MAX_TRACKED_USERNAMES = 10000
+
+
+class AuthBusy(Exception):
+    """Too many password checks are already waiting."""
+
+
+class LoginRefused(Exception):
+    """The username has used up its failed logins; retry_after is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def log_in(user):
+    session['user_id'] = user.id
+    session['username'] = user.username
+    session['is_admin'] = user.is_admin
+    session['name'] = user.name
+    session['email'] = user.email
+    g.pop('identity', None)
+
+
+def log_out():
+    for key in SESSION_KEYS:
+        session.pop(key, None)
+    g.pop('identity', None)
+
+
+def current_user():
+    """The logged-in user's Identity from the session, or None. Loaded once per request."""
+    if 'identity' in g:
+        return g.identity
+    identity = None
+    if 'user_id' in session:
+        if 'name' not in session:
+            # Logged in before the session carried the full identity; fill it in once.
+            user = db.session.get(User, session['user_id'])
+            if user is None:
+                return None
+            log_in(user)
+        identity = Identity(session['user_id'], session['username'], bool(session['is_admin']),
+                            session['name'], session['email'])
+    g.identity = identity
+    return identity
+
+
+class HashPool:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self.rejected = 0
+
+    def _get_executor(self, workers):
+        # Created on first use so that each forked worker process gets its own threads.
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = _make_executor(workers)
+        return self._executor
+
+    def verify(self, password_hash, password):
+        config = current_app.config
+        if not config['AUTH_HASH_WORKERS']:
+            return check_password_hash(password_hash, password)
+        with self._lock:
+            if self._pending >= config['AUTH_HASH_MAX_PENDING']:
+                self.rejected += 1
+                raise AuthBusy()
+            self._pending += 1
+        try:
+            executor = self._get_executor(config['AUTH_HASH_WORKERS'])
+            return executor.submit(check_password_hash, password_hash, password).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self._pending, "rejected": self.rejected}
+
+
+def _make_executor(workers):
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            # Patched threads are greenlets; hash on gevent's pool of real threads instead.
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor(max_workers=workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+
+hash_pool = HashPool()
+
+
+def verify_password(user, password):
+    """Checks a password on the hash pool. Raises AuthBusy when too many checks are waiting."""
+    return hash_pool.verify(user.password_hash, password)
+
+
+def authenticate(username, password):
+    """The User if the password is right, else None. Raises LoginRefused or AuthBusy before checking it."""
+    wait = login_failures.retry_after(username)
+    if wait:
+        raise LoginRefused(wait)
+    user = User.query.filter_by(username=username).first()
+    if user is None or not verify_password(user, password):
+        login_failures.failed(username)
+        return None
+    login_failures.succeeded(username)
+    return user
+
+
+class FailureLimiter:
+    """Per-key token buckets. A key may fail `burst` times, then once per `refill_seconds`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at), least recently used first
+        self.refused = 0
+
+    def _tokens(self, key, now, burst, refill_seconds):
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        return min(burst, tokens + (now - updated_at) / refill_seconds)
+
+    def retry_after(self, key):
+        """0 if key may try now, else the seconds until it may."""
+        burst, refill_seconds = _limits()
+        if not burst:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now, burst, refill_seconds)
+            if tokens >= 1:
+                return 0
+            self.refused += 1
+            return (1 - tokens) * refill_seconds
+
+    def failed(self, key):
+        burst, refill_seconds = _limits()
+        if not burst:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._buckets[key] = (max(0.0, self._tokens(key, now, burst, refill_seconds) - 1), now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > MAX_TRACKED_USERNAMES:
+                self._buckets.popitem(last=False)
+
+    def succeeded(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"tracked": len(self._buckets), "refused": self.refused}
+
+
+def _limits():
+    config = current_app.config
+    return config['LOGIN_FAILURE_BURST'], config['LOGIN_FAILURE_REFILL_SECONDS']
+
+
+login_failures = FailureLimiter()
@@ -0,0 +1,143 @@
+"""Live free-spot counts for Server-Sent Events subscribers.
+
+Bookings and releases call ``hub.publish(lot_id)``, which only marks the
+lot dirty. A single flusher thread per process wakes every
+``SSE_COALESCE_INTERVAL`` seconds and reads the dirty lots' counts in one
+grouped query. Only counts that actually changed are published, so a
+burst of bookings becomes one update per interval. Every
+``SSE_POLL_INTERVAL`` seconds it also re-reads all watched lots, which
+picks up bookings made by other worker processes.
+
+Subscribers share one condition variable and keep no per-client state
+beyond the version they last saw, so an idle subscriber costs a blocked
+wait. Under a gevent worker each subscriber is a greenlet, so one worker
+holds thousands of streams. Under gunicorn's default gthread worker every
+stream would pin a worker thread, so ``streams_supported`` turns streams
+off there and the dashboard shows the counts as of page load, unless
+SSE_STREAMS says a separate gevent server answers the stream URL
+(gunicorn.conf.py explains why the app itself does not run under gevent).
+"""
+import threading
+import time
+from collections import Counter, deque
+
+import reports
+
+
+HISTORY = 256  # published versions kept for subscribers that fall behind
+
+
+def streams_offered(app, environ):
+    """Whether a page served by this request may open availability streams."""
+    return app.config['SSE_STREAMS'] or streams_supported(environ)
+
+
+def streams_supported(environ):
+    """Whether the server handling this request can hold a stream open without tying up a worker thread.
+
+    True under gevent, and for the development server and test client; False for gunicorn's other workers.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            return True
+    except ImportError:
+        pass
+    return not environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+
+
+class AvailabilityHub:
+
+    def __init__(self):
+        self._start_lock = threading.Lock()
+        self._lock = None  # created on first use, after gevent (if used) has patched threading
+        self._changed = None
+        self._thread = None
+        self.subscribers = 0
+        self._dirty = set()
+        self._poll_all = False
+        self._watched = Counter()  # lot_id -> number of subscribers
+        self._counts = {}          # lot_id -> last published free count
+        self._history = deque(maxlen=HISTORY)  # (version, {lot_id: count})
+        self.version = 0
+
+    def _start(self, app):
+        with self._start_lock:
+            if self._thread is None:
+                self._lock = threading.Lock()
+                self._changed = threading.Condition(self._lock)
+                self._thread = threading.Thread(target=self._run, args=(app,), daemon=True)
+                self._thread.start()
+
+    def publish(self, lot_id=None):
+        """Notes that a lot's free count may have changed; None means "some lot", re-read them all."""
+        if self._lock is None:
+            return  # nobody has subscribed in this process yet
+        with self._lock:
+            if lot_id is None:
+                self._poll_all = True
+            elif lot_id in self._watched:
+                self._dirty.add(lot_id)
+
+    def subscribe(self, app, lot_ids):
+        self._start(app)
+        with self._lock:
+            self._watched.update(lot_ids)
+            self.subscribers += 1
+
+    def unsubscribe(self, lot_ids):
+        with self._lock:
+            self._watched.subtract(lot_ids)
+            self._watched += Counter()  # drop lots nobody watches any more
+            self.subscribers -= 1
+
+    def wait(self, version, lot_ids, timeout):
+        """Blocks until there is news for lot_ids after version, or timeout.
+
+        Returns (latest version, {lot_id: free count}); the dict is empty on timeout.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version > version, timeout)
+            if self.version == version:
+                return version, {}
+            if not self._history or self._history[0][0] > version + 1:
+                # Too far behind to replay the changes; send the current counts.
+                return self.version, {lot_id: self._counts[lot_id] for lot_id in lot_ids if lot_id in self._counts}
+            changes = {}
+            for published, counts in self._history:
+                if published > version:
+                    changes.update((lot_id, count) for lot_id, count in counts.items() if lot_id in lot_ids)
+            return self.version, changes
+
+    def _run(self, app):
+        next_poll = 0
+        while True:
+            time.sleep(app.config['SSE_COALESCE_INTERVAL'])
+            with self._lock:
+                watched = set(self._watched)
+                lots = self._dirty & watched
+                if self._poll_all or time.monotonic() >= next_poll:
+                    lots = watched
+                    next_poll = time.monotonic() + app.config['SSE_POLL_INTERVAL']
+                self._dirty.clear()
+                self._poll_all = False
+            if not lots:
+                continue
+
+            try:
+                with app.app_context():
+                    rows = reports.lot_occupancy(sorted(lots))
+            except Exception:
+                app.logger.exception('Could not read lot availability')
+                continue
+            with self._lock:
+                changes = {lot_id: available for lot_id, _name, _occupied, available in rows
+                           if self._counts.get(lot_id) != available}
+                if changes:
+                    self._counts.update(changes)
+                    self.version += 1
+                    self._history.append((self.version, changes))
+                    self._changed.notify_all()
+
+
+hub = AvailabilityHub()
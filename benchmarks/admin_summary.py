@@ -0,0 +1,111 @@
+"""Query count and latency of /admin/summary as the number of lots grows.
+
+Seeds N lots and M completed reservations into a throwaway SQLite file,
+then times the page with the grouped aggregate queries, with the
+materialized summary table, and with the old one-query-per-lot approach.
+
+    python benchmarks/admin_summary.py --lots 10 100 400 --spots 50 --reservations 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def legacy_summary(db, ParkingLot, ParkingSpot, Reservation):
+    """The per-lot queries admin_summary used to issue, kept for comparison."""
+    all_lots = ParkingLot.query.all()
+    [ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count() for lot in all_lots]
+    [ParkingSpot.query.filter_by(lot_id=lot.id, status='A').count() for lot in all_lots]
+    for lot in all_lots:
+        db.session.query(db.func.sum(Reservation.parking_cost))\
+                  .join(ParkingSpot)\
+                  .filter(ParkingSpot.lot_id == lot.id)\
+                  .scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lots', type=int, nargs='+', default=[10, 100, 400])
+    parser.add_argument('--spots', type=int, default=50, help='spots per lot')
+    parser.add_argument('--reservations', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from sqlalchemy import event, insert
+    from app import create_app
+    from models import db, init_db, User, ParkingLot, ParkingSpot, Reservation
+    import reports
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+        admin_id = User.query.filter_by(is_admin=True).first().id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin_id
+        sess['is_admin'] = True
+
+    def measure(label, n_lots, func):
+        timings = []
+        for _ in range(args.repeat):
+            statements.clear()
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        print(f'{n_lots:>6} {label:<12} queries={len(statements):<6} '
+              f'latency={min(timings) * 1000:8.1f}ms')
+
+    seeded = 0
+    for n_lots in sorted(args.lots):
+        with app.app_context():
+            db.session.execute(insert(ParkingLot), [
+                dict(prime_location_name=f'Lot {i}', address='-', pin_code=f'{i:06d}',
+                     price=10, maximum_number_of_spots=args.spots)
+                for i in range(seeded, n_lots)])
+            lot_ids = [row[0] for row in db.session.query(ParkingLot.id).filter(ParkingLot.id > seeded)]
+            db.session.execute(insert(ParkingSpot), [
+                dict(lot_id=lot_id, spot_number=n, status=random.choice('AO'))
+                for lot_id in lot_ids for n in range(1, args.spots + 1)])
+            spot_ids = [row[0] for row in db.session.query(ParkingSpot.id)]
+            now = datetime.utcnow()
+            db.session.execute(insert(Reservation), [
+                dict(user_id=admin_id, spot_id=random.choice(spot_ids),
+                     parking_timestamp=now - timedelta(hours=3), leaving_timestamp=now,
+                     parking_cost=random.uniform(5, 50))
+                for _ in range(args.reservations // len(args.lots))])
+            db.session.commit()
+            seeded = n_lots
+
+        app.config['SUMMARY_TABLE'] = False
+        measure('grouped', n_lots, lambda: client.get('/admin/summary'))
+
+        app.config['SUMMARY_TABLE'] = True
+        with app.app_context():
+            reports.refresh_lot_summaries()
+        measure('materialized', n_lots, lambda: client.get('/admin/summary'))
+        app.config['SUMMARY_TABLE'] = False
+
+        def legacy():
+            with app.app_context():
+                legacy_summary(db, ParkingLot, ParkingSpot, Reservation)
+        measure('per-lot', n_lots, legacy)
+
+
+if __name__ == '__main__':
+    main()
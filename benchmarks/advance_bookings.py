@@ -0,0 +1,143 @@
+"""Advance-booking conflict checks: interval index versus database and linear scans.
+
+Seeds one lot with tens of thousands of future bookings into a throwaway
+SQLite file. It then times "is this spot free from T1 to T2" and "find a
+spot free from T1 to T2" through the in-memory interval index, through
+the indexed overlap query, and through a scan of every booking, and the
+walk-in check "which spots are booked in the next hours" through the
+lot's start-sorted windows and through a check of every spot.
+
+    python benchmarks/advance_bookings.py --spots 200 --bookings 50000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--spots', type=int, default=200)
+    parser.add_argument('--bookings', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from sqlalchemy import and_, exists, insert, select
+    from app import create_app
+    from models import db, init_db, ParkingLot, ParkingSpot, AdvanceBooking
+    from provisioning import provision_spots
+    import bookings
+
+    app = create_app()
+    random.seed(7)
+    now = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        admin = init_db()
+        lot = ParkingLot(prime_location_name='Bench', address='-', pin_code='000000', price=10,
+                         maximum_number_of_spots=args.spots)
+        db.session.add(lot)
+        db.session.flush()
+        spot_ids = provision_spots(lot.id, args.spots)
+
+        # Back-to-back windows with random gaps, so every spot has its share of the bookings.
+        rows, per_spot = [], args.bookings // args.spots
+        for spot_id in spot_ids:
+            cursor = now + timedelta(minutes=random.randint(0, 120))
+            for _ in range(per_spot):
+                start = cursor + timedelta(minutes=random.choice((0, 0, 30, 60, 240)))
+                end = start + timedelta(minutes=random.randint(30, 600))
+                rows.append(dict(user_id=admin.id, spot_id=spot_id, start_time=start, end_time=end, status='B'))
+                cursor = end
+        db.session.execute(insert(AdvanceBooking), rows)
+        db.session.commit()
+        horizon = max(row["end_time"] for row in rows)
+        print(f'spots={args.spots} bookings={len(rows)} horizon={(horizon - now).days} days')
+
+        load, _ = best_of(1, lambda: bookings.booking_index._load_lot(lot.id))
+        print(f'  index load            {load * 1000:9.1f}ms')
+
+        windows = []
+        for _ in range(args.queries):
+            start = now + timedelta(minutes=random.randint(0, int((horizon - now).total_seconds() // 60)))
+            windows.append((random.choice(spot_ids), start, start + timedelta(hours=random.randint(1, 8))))
+
+        def index_checks():
+            return sum(bookings.booking_index.is_free(*window) for window in windows)
+
+        def db_checks():
+            return sum(not bookings._overlapping(*window) for window in windows)
+
+        all_rows = [(r["spot_id"], r["start_time"], r["end_time"]) for r in rows]
+
+        def scan_checks():
+            return sum(not any(s == spot and b_start < end and b_end > start for s, b_start, b_end in all_rows)
+                       for spot, start, end in windows)
+
+        for name, func in (('index', index_checks), ('indexed SQL', db_checks), ('linear scan', scan_checks)):
+            repeat = 1 if name == 'linear scan' else args.repeat
+            elapsed, free = best_of(repeat, func)
+            print(f'  is_free  {name:<12} {elapsed / len(windows) * 1e6:9.1f}us/query  ({free}/{len(windows)} free)')
+
+        def index_find():
+            return [bookings.booking_index.free_spots(lot.id, start, end, limit=1) for _spot, start, end in windows]
+
+        def sql_find():
+            return [db.session.execute(
+                select(ParkingSpot.id).where(
+                    ParkingSpot.lot_id == lot.id,
+                    ~exists().where(and_(AdvanceBooking.spot_id == ParkingSpot.id,
+                                         AdvanceBooking.status.in_(bookings.ACTIVE_STATUSES),
+                                         AdvanceBooking.end_time > start,
+                                         AdvanceBooking.start_time < end)))
+                .order_by(ParkingSpot.spot_number).limit(1)).all() for _spot, start, end in windows]
+
+        for name, func in (('index', index_find), ('SQL NOT EXISTS', sql_find)):
+            elapsed, found = best_of(args.repeat, func)
+            print(f'  find     {name:<14} {elapsed / len(windows) * 1e6:7.1f}us/query  '
+                  f'({sum(bool(f) for f in found)}/{len(windows)} found)')
+
+        def index_held():
+            return [bookings.booking_index.held(lot.id, start, start + timedelta(hours=3)) for _spot, start, _end in windows]
+
+        def per_spot_held():
+            return [{spot_id for spot_id in spot_ids
+                     if not bookings.booking_index.is_free(spot_id, start, start + timedelta(hours=3))}
+                    for _spot, start, _end in windows]
+
+        for name, func in (('index', index_held), ('every spot', per_spot_held)):
+            elapsed, held = best_of(args.repeat, func)
+            print(f'  held     {name:<14} {elapsed / len(windows) * 1e6:7.1f}us/query  '
+                  f'({sum(map(len, held)) / len(windows):.0f} spots held on average)')
+
+        def book_all():
+            booked = 0
+            for _spot, start, end in windows[:50]:
+                booked += bookings.book(lot.id, admin.id, start, end, 'BENCH') is not None
+            return booked
+
+        elapsed, booked = best_of(1, book_all)
+        print(f'  book()                {elapsed / 50 * 1000:9.2f}ms/booking  ({booked}/50 booked)')
+
+
+if __name__ == '__main__':
+    main()
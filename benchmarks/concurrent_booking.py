@@ -0,0 +1,102 @@
+"""Concurrency harness for the spot allocation engine.
+
+Fires many simultaneous "book any spot in lot X" requests at a single lot
+through the Flask test client (one thread per client) and checks that no
+spot was double booked.
+
+    python benchmarks/concurrent_booking.py --clients 300 --spots 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=300, help='number of concurrent bookers')
+    parser.add_argument('--spots', type=int, default=200, help='spots in the contested lot')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from app import create_app
+    from models import db, init_db, User, ParkingLot, ParkingSpot, Reservation
+    from werkzeug.security import generate_password_hash
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+
+    with app.app_context():
+        lot = ParkingLot(prime_location_name='Bench Lot', address='-', pin_code='000000',
+                         price=10, maximum_number_of_spots=args.spots)
+        db.session.add(lot)
+        db.session.commit()
+        db.session.add_all(ParkingSpot(lot_id=lot.id, spot_number=i, status='A')
+                           for i in range(1, args.spots + 1))
+        password_hash = generate_password_hash('bench')
+        users = [User(username=f'bench{i}', password_hash=password_hash) for i in range(args.clients)]
+        db.session.add_all(users)
+        db.session.commit()
+        lot_id = lot.id
+        user_ids = [user.id for user in users]
+
+    clients = []
+    for user_id in user_ids:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['is_admin'] = False
+        clients.append(client)
+
+    barrier = threading.Barrier(len(clients))
+    latencies = []
+    errors = []
+
+    def book(index, client):
+        barrier.wait()
+        start = time.perf_counter()
+        response = client.post(f'/book/lot/{lot_id}', data={'vehicle_number': f'V{index}'})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 302:
+            errors.append(response.status_code)
+
+    threads = [threading.Thread(target=book, args=(i, c)) for i, c in enumerate(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        reservations = Reservation.query.filter_by(leaving_timestamp=None).all()
+        booked_spots = [r.spot_id for r in reservations]
+        occupied = ParkingSpot.query.filter_by(lot_id=lot_id, status='O').count()
+
+    double_booked = len(booked_spots) - len(set(booked_spots))
+    expected = min(args.clients, args.spots)
+    latencies.sort()
+
+    print(f'clients={args.clients} spots={args.spots}')
+    print(f'reservations={len(reservations)} occupied={occupied} expected={expected}')
+    print(f'double_booked={double_booked} http_errors={len(errors)}')
+    print(f'elapsed={elapsed:.3f}s throughput={len(clients) / elapsed:.1f} req/s')
+    print(f'p50={latencies[len(latencies) // 2] * 1000:.1f}ms '
+          f'p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms')
+
+    ok = double_booked == 0 and len(reservations) == occupied == expected and not errors
+    print('OK' if ok else 'FAILED')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
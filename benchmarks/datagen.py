@@ -0,0 +1,135 @@
+"""Synthetic dataset generator for benchmarks.
+
+Fills the configured database with lots, spots, users and a reservation
+history spread over the past ``--days``. A share of the spots are left
+occupied by active reservations. Every generated user logs in with
+``PASSWORD``. Costs are priced through billing.py, and the lot summaries
+and analytics rollups are rebuilt afterwards, so every page sees
+consistent data. With ``LOT_SHARDS`` set the lots are spread evenly over
+the shards.
+
+    python benchmarks/datagen.py --db /tmp/bench.db --lots 200 --spots 50 --users 5000 --reservations 200000
+
+Other benchmarks import generate() and call it inside an app context.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'bench-password'
+CHUNK_SIZE = 10000
+WORDS = ['central', 'market', 'station', 'airport', 'mall', 'tower', 'park', 'plaza', 'gate', 'square']
+
+
+def _chunked_insert(db, model, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(model), rows[start:start + CHUNK_SIZE])
+
+
+def generate(lots=50, spots_per_lot=40, users=1000, reservations=50000, days=180, occupancy=0.3, seed=7):
+    """Seeds an initialized, empty database. Needs an app context; returns the generated usernames."""
+    import numpy as np
+    from werkzeug.security import generate_password_hash
+    from models import db, User, ParkingLot, ParkingSpot, Reservation
+    import analytics
+    import billing
+    import reports
+    import shards
+
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    _chunked_insert(db, ParkingLot, [
+        dict(prime_location_name=f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}',
+             address=f'{i} Bench Road', pin_code=str(rng.randint(100000, 999999)),
+             price=rng.choice((10, 20, 30, 40, 50)), maximum_number_of_spots=spots_per_lot)
+        for i in range(lots)])
+    lot_ids = [row[0] for row in db.session.query(ParkingLot.id).order_by(ParkingLot.id)]
+    placed = shards.assign(lot_ids)
+    spots = []
+    for name in shards.names():
+        with shards.use(name):
+            _chunked_insert(db, ParkingSpot, [dict(lot_id=lot_id, spot_number=n, status='A')
+                                              for lot_id in lot_ids if placed[lot_id] == name
+                                              for n in range(1, spots_per_lot + 1)])
+            spots += db.session.query(ParkingSpot.id, ParkingSpot.lot_id).all()
+
+    # One hash shared by every user: hashing is deliberately slow and would dominate seeding.
+    password_hash = generate_password_hash(PASSWORD)
+    usernames = [f'bench{i}' for i in range(users)]
+    _chunked_insert(db, User, [dict(username=username, password_hash=password_hash, is_admin=False,
+                                    name=f'Bench User {i}', email=f'{username}@bench.invalid')
+                               for i, username in enumerate(usernames)])
+    user_ids = [row[0] for row in db.session.query(User.id).filter(User.is_admin.is_(False))]
+
+    # Completed history: parked at a random time in the window, for half an hour to half a day.
+    picked = [rng.choice(spots) for _ in range(reservations)]
+    parked = [now - timedelta(seconds=rng.randint(3600, days * 86400)) for _ in picked]
+    left = [p + timedelta(minutes=rng.randint(30, 720)) for p in parked]
+    costs = billing.price(np.array(parked, dtype='datetime64[us]'), np.array(left, dtype='datetime64[us]'),
+                          **billing.lot_parameters(np.array([lot_id for _spot, lot_id in picked])))
+    rows = [dict(user_id=rng.choice(user_ids), spot_id=spot_id, vechile_number=f'KA{rng.randint(1, 99):02d}',
+                 parking_timestamp=p, leaving_timestamp=min(l, now), parking_cost=cost)
+            for (spot_id, _lot), p, l, cost in zip(picked, parked, left, costs.tolist())]
+
+    # Currently parked cars, at most one per spot.
+    occupied = rng.sample(spots, int(len(spots) * occupancy))
+    rows += [dict(user_id=rng.choice(user_ids), spot_id=spot_id, vechile_number=f'KA{rng.randint(1, 99):02d}',
+                  parking_timestamp=now - timedelta(minutes=rng.randint(5, 600)))
+             for spot_id, _lot in occupied]
+    occupied_ids = [spot_id for spot_id, _lot in occupied]
+    for name in shards.names():
+        with shards.use(name):
+            _chunked_insert(db, Reservation, [row for row in rows if shards.for_id(row["spot_id"]) == name])
+            in_shard = [spot_id for spot_id in occupied_ids if shards.for_id(spot_id) == name]
+            for start in range(0, len(in_shard), CHUNK_SIZE):
+                db.session.query(ParkingSpot).filter(ParkingSpot.id.in_(in_shard[start:start + CHUNK_SIZE]))\
+                          .update({ParkingSpot.status: 'O'}, synchronize_session=False)
+    db.session.commit()
+
+    reports.refresh_lot_summaries()
+    if analytics.rollups_enabled():
+        analytics.backfill()
+    return usernames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='SQLite file to create')
+    parser.add_argument('--lots', type=int, default=50)
+    parser.add_argument('--spots', type=int, default=40, help='spots per lot')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--reservations', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=180, help='length of the reservation history')
+    parser.add_argument('--occupancy', type=float, default=0.3, help='share of spots currently occupied')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        parser.error(f'{args.db} already exists')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{os.path.abspath(args.db)}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SWEEP_INTERVAL'] = ''
+
+    from app import create_app
+    from models import init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        started = time.perf_counter()
+        generate(args.lots, args.spots, args.users, args.reservations, args.days, args.occupancy, args.seed)
+    print(f'{args.db}: {args.lots} lots x {args.spots} spots, {args.users} users, '
+          f'{args.reservations} reservations in {time.perf_counter() - started:.1f}s (password {PASSWORD!r})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""HTTP load test against a running instance.
+
+Each virtual user registers, logs in, searches for a lot, books a spot and
+releases it, in a loop. Reports requests per second and p50/p99 latency
+per step.
+
+    gunicorn -c gunicorn.conf.py wsgi:app &
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --users 50 --duration 30
+"""
+import argparse
+import http.cookiejar
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+LOT_NAME = 'Load Test Lot'
+
+
+def make_opener():
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+
+def request(opener, url, data=None):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    with opener.open(url, data=body, timeout=30) as response:
+        return response.read().decode()
+
+
+def ensure_lot(base, admin_user, admin_password, spots):
+    admin = make_opener()
+    request(admin, f'{base}/login', {'username': admin_user, 'password': admin_password})
+    request(admin, f'{base}/admin/parking_lot/add', {
+        'prime_location_name': LOT_NAME, 'address': 'Load test', 'pin_code': '999999',
+        'price': '10', 'maximum_number_of_spots': str(spots),
+    })
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--spots', type=int, default=500)
+    parser.add_argument('--admin-user', default='admin')
+    parser.add_argument('--admin-password', default='admin')
+    args = parser.parse_args()
+    base = args.url.rstrip('/')
+
+    ensure_lot(base, args.admin_user, args.admin_password, args.spots)
+
+    latencies = {step: [] for step in ('login', 'search', 'book', 'release')}
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def timed(step, func):
+        start = time.perf_counter()
+        try:
+            result = func()
+        except (urllib.error.URLError, OSError) as e:
+            with lock:
+                errors.append(f'{step}: {e}')
+            return None
+        with lock:
+            latencies[step].append(time.perf_counter() - start)
+        return result
+
+    def virtual_user():
+        opener = make_opener()
+        username = f'load-{uuid.uuid4().hex[:12]}'
+        request(opener, f'{base}/register', {
+            'name': username, 'email': f'{username}@example.com', 'username': username,
+            'password': 'loadtest', 'confirm_password': 'loadtest',
+        })
+        timed('login', lambda: request(opener, f'{base}/login', {'username': username, 'password': 'loadtest'}))
+        while time.monotonic() < deadline:
+            page = timed('search', lambda: request(opener, f'{base}/dashboard?q={urllib.parse.quote(LOT_NAME)}'))
+            match = page and re.search(r'/book/lot/(\d+)', page)
+            if not match:
+                continue
+            page = timed('book', lambda: request(opener, f'{base}/book/lot/{match.group(1)}',
+                                                 {'vehicle_number': 'LT-0001'}))
+            release = page and re.search(r'/release/(\d+)', page)
+            if release:
+                timed('release', lambda: request(opener, f'{base}/release/{release.group(1)}', {}))
+
+    threads = [threading.Thread(target=virtual_user) for _ in range(args.users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(samples) for samples in latencies.values())
+    print(f'users={args.users} elapsed={elapsed:.1f}s requests={total} '
+          f'rps={total / elapsed:.1f} errors={len(errors)}')
+    for step, samples in latencies.items():
+        if samples:
+            print(f'  {step:<8} n={len(samples):<6} p50={percentile(samples, 0.50) * 1000:7.1f}ms '
+                  f'p99={percentile(samples, 0.99) * 1000:7.1f}ms')
+    for error in errors[:5]:
+        print(f'  error: {error}')
+
+
+if __name__ == '__main__':
+    main()
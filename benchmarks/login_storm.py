@@ -0,0 +1,121 @@
+"""Login storm: booking latency while many users log in at once.
+
+Seeds users and lots into a throwaway SQLite file. For --duration seconds,
+--logins threads then post correct passwords to /login while --bookers
+threads load the dashboard and book and release spots. This runs twice:
+once with every request thread hashing its own password (inline), and
+once with checks on the bounded hash pool. The second phase floods one
+username with wrong passwords, to show the failed-login limit refusing
+guesses without hashing them.
+
+    python benchmarks/login_storm.py --logins 32 --bookers 4 --duration 10 --workers 1
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from datagen import PASSWORD, generate  # noqa: E402
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else float('nan')
+
+
+def storm(app, usernames, lot_ids, user_ids, args):
+    stop = threading.Event()
+    login_statuses, login_latencies, booking_latencies = [], [], []
+    lock = threading.Lock()
+
+    def log_in_loop(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            status = client.post('/login', data={'username': rng.choice(usernames), 'password': PASSWORD}).status_code
+            with lock:
+                login_statuses.append(status)
+                login_latencies.append(time.perf_counter() - started)
+
+    def book_loop(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_ids[seed]
+            sess['is_admin'] = False
+        while not stop.is_set():
+            for send in (lambda: client.get('/dashboard'),
+                         lambda: client.post(f'/book/lot/{rng.choice(lot_ids)}', data={'vehicle_number': 'STORM'})):
+                started = time.perf_counter()
+                send()
+                with lock:
+                    booking_latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=log_in_loop, args=(i,)) for i in range(args.logins)]
+    threads += [threading.Thread(target=book_loop, args=(i,)) for i in range(args.bookers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    logged_in = sum(status == 302 for status in login_statuses)
+    shed = sum(status == 503 for status in login_statuses)
+    print(f'  logins    {logged_in / args.duration:7.1f}/s  p50={percentile(login_latencies, 0.5) * 1000:7.0f}ms  '
+          f'p99={percentile(login_latencies, 0.99) * 1000:7.0f}ms  turned away={shed}')
+    print(f'  bookings  {len(booking_latencies) / args.duration:7.1f}/s  '
+          f'p50={percentile(booking_latencies, 0.5) * 1000:7.1f}ms  p99={percentile(booking_latencies, 0.99) * 1000:7.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=32, help='threads logging in')
+    parser.add_argument('--bookers', type=int, default=4, help='threads booking while the storm runs')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1, help='AUTH_HASH_WORKERS for the pooled run')
+    parser.add_argument('--guesses', type=int, default=200, help='wrong passwords tried for one username')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SWEEP_INTERVAL'] = ''
+
+    from app import create_app
+    from models import init_db, User, ParkingLot
+    import auth
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        usernames = generate(lots=20, spots_per_lot=500, users=500, reservations=5000, occupancy=0)
+        lot_ids = [row[0] for row in ParkingLot.query.with_entities(ParkingLot.id)]
+        user_ids = [row[0] for row in User.query.with_entities(User.id).filter_by(is_admin=False)]
+
+    app.config['AUTH_HASH_MAX_PENDING'] = args.logins  # measure queueing, not shedding
+    for label, workers in (('inline', 0), (f'pool of {args.workers}', args.workers)):
+        app.config['AUTH_HASH_WORKERS'] = workers
+        print(f'{label}: {args.logins} threads logging in, {args.bookers} booking')
+        storm(app, usernames, lot_ids, user_ids, args)
+
+    client = app.test_client()
+    started = time.perf_counter()
+    statuses = [client.post('/login', data={'username': usernames[0], 'password': 'wrong'}).status_code
+                for _ in range(args.guesses)]
+    elapsed = time.perf_counter() - started
+    with app.app_context():
+        refused = auth.login_failures.stats()["refused"]
+    print(f'{args.guesses} wrong passwords for one user: {elapsed / args.guesses * 1000:.1f}ms each, '
+          f'{refused} refused by the limit, {statuses.count(302)} hashed')
+
+
+if __name__ == '__main__':
+    main()
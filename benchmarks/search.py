@@ -0,0 +1,81 @@
+"""In-process search indexes versus leading-wildcard ILIKE.
+
+Seeds users and lots into a throwaway SQLite file, then times a set of
+queries through the old ILIKE filters and through search.py.
+
+    python benchmarks/search.py --users 100000 --lots 10000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ['central', 'market', 'station', 'airport', 'mall', 'tower', 'park', 'plaza', 'gate', 'square']
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--lots', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from sqlalchemy import insert, or_
+    from app import create_app
+    from models import db, init_db, User, ParkingLot
+    import search
+
+    app = create_app()
+    random.seed(7)
+    with app.app_context():
+        init_db()
+        db.session.execute(insert(User), [
+            dict(username=''.join(random.choices(string.ascii_lowercase, k=random.randint(6, 12))) + str(i),
+                 password_hash='-')
+            for i in range(args.users)])
+        db.session.execute(insert(ParkingLot), [
+            dict(prime_location_name=f'{random.choice(WORDS).title()} {random.choice(WORDS).title()} {i}',
+                 address='-', pin_code=str(random.randint(100000, 999999)), price=10, maximum_number_of_spots=1)
+            for i in range(args.lots)])
+        db.session.commit()
+
+        build, _ = best_of(1, lambda: (search.usernames.rebuild(), search.lot_names.rebuild(), search.pin_codes.rebuild()))
+        print(f'users={args.users} lots={args.lots} index build={build * 1000:.0f}ms')
+
+        user_queries = ['abc', 'qz', 'xyzq', 'mno1']
+        lot_queries = ['plaza', 'gate sq', '4110', '56']
+        for query in user_queries:
+            ilike, rows = best_of(args.repeat, lambda: User.query.filter(User.username.ilike(f'%{query}%')).all())
+            indexed, (_page, total) = best_of(args.repeat, lambda: search.search_users(query))
+            print(f'  user  {query!r:<10} ilike={ilike * 1000:7.2f}ms ({len(rows)} rows)  '
+                  f'index={indexed * 1000:7.2f}ms ({total} matches)')
+        for query in lot_queries:
+            ilike, rows = best_of(args.repeat, lambda: ParkingLot.query.filter(or_(
+                ParkingLot.prime_location_name.ilike(f'%{query}%'),
+                ParkingLot.pin_code.ilike(f'%{query}%'))).all())
+            indexed, (_page, total) = best_of(args.repeat, lambda: search.search_lots(query))
+            print(f'  lot   {query!r:<10} ilike={ilike * 1000:7.2f}ms ({len(rows)} rows)  '
+                  f'index={indexed * 1000:7.2f}ms ({total} matches)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Lot sharding: booking throughput and admin fan-out on one database vs N SQLite shards.
+
+For each --shards count (0 is a single database) a fresh set of SQLite
+files is seeded with datagen, with the lots spread over the shards. Then
+--threads threads book and release spots in random lots for --duration
+seconds, calling the allocation engine directly, and the admin
+aggregates (occupancy, revenue, the analytics series) are timed. Each
+configuration runs in its own process, so per-process indexes and caches
+start empty.
+
+    python benchmarks/sharding.py --shards 0,2,4 --threads 8 --duration 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else float('nan')
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(shard_count, options):
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    directory = tempfile.mkdtemp()
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{os.path.join(directory, "main.db")}'
+    os.environ['LOT_SHARDS'] = ','.join(f'shard{i}=sqlite:///{os.path.join(directory, f"shard{i}.db")}'
+                                        for i in range(shard_count))
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SWEEP_INTERVAL'] = ''
+    os.environ['SUMMARY_TABLE'] = 'False'
+
+    from datagen import generate
+    from app import create_app
+    from models import init_db, User, ParkingLot
+    from allocation import claim_any_spot, release_reservation
+    import analytics
+    import reports
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        generate(lots=options['lots'], spots_per_lot=options['spots'], users=200,
+                 reservations=options['reservations'], occupancy=0.2)
+        lot_ids = [row[0] for row in ParkingLot.query.with_entities(ParkingLot.id)]
+        user_ids = [row[0] for row in User.query.with_entities(User.id).filter_by(is_admin=False)]
+
+    stop = threading.Event()
+    latencies, failures = [], []
+    lock = threading.Lock()
+
+    def book_and_release(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            started = time.perf_counter()
+            with app.app_context():
+                reservation = claim_any_spot(rng.choice(lot_ids), rng.choice(user_ids), 'BENCH')
+                released = reservation is not None and release_reservation(reservation.id, 1.0)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                if not released:
+                    failures.append(seed)
+
+    threads = [threading.Thread(target=book_and_release, args=(i,)) for i in range(options['threads'])]
+    for thread in threads:
+        thread.start()
+    time.sleep(options['duration'])
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    now = datetime.utcnow()
+    with app.app_context():
+        aggregates = {
+            'occupancy': best_of(5, reports.lot_occupancy),
+            'revenue': best_of(5, reports.lot_revenue),
+            'series': best_of(5, lambda: analytics.series('day', now - timedelta(days=30), now)),
+        }
+    return {
+        'cycles_per_second': len(latencies) / options['duration'],
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'failures': len(failures),
+        'aggregates_ms': {name: seconds * 1000 for name, seconds in aggregates.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', default='0,4', help='comma-separated shard counts; 0 is a single database')
+    parser.add_argument('--threads', type=int, default=8, help='threads booking and releasing')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--lots', type=int, default=40)
+    parser.add_argument('--spots', type=int, default=50, help='spots per lot')
+    parser.add_argument('--reservations', type=int, default=100000, help='reservation history to seed')
+    args = parser.parse_args()
+
+    # A fresh interpreter per configuration: indexes, caches and the lot -> shard map are per process.
+    context = multiprocessing.get_context('spawn')
+    for count in [int(count) for count in args.shards.split(',')]:
+        with context.Pool(1) as pool:
+            result = pool.apply(run, (count, vars(args)))
+        label = f'{count} shards' if count else 'single database'
+        aggregates = '  '.join(f'{name}={ms:.1f}ms' for name, ms in result['aggregates_ms'].items())
+        print(f'{label:16} {result["cycles_per_second"]:7.1f} book+release/s  p50={result["p50_ms"]:6.1f}ms  '
+              f'p99={result["p99_ms"]:6.1f}ms  failed={result["failures"]}  {aggregates}')
+
+
+if __name__ == '__main__':
+    main()
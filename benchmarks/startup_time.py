@@ -0,0 +1,83 @@
+"""Cold import-to-first-request latency.
+
+Each sample runs in a fresh interpreter: import the app, build it, and
+serve one GET /login through the test client, against a database that has
+already been initialised. Pass --ref to measure another commit as well
+(checked out into a temporary git worktree), e.g. the tree before the app
+factory:
+
+    python benchmarks/startup_time.py --ref HEAD~1
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Works against both the app-factory layout and the older module-level `app`.
+PROBE = '''
+import time
+start = time.perf_counter()
+import app as module
+app = module.create_app() if hasattr(module, 'create_app') else module.app
+imported = time.perf_counter()
+response = app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(f'{imported - start} {done - start}')
+'''
+
+INIT = '''
+import app as module
+if hasattr(module, 'create_app'):
+    import models
+    app = module.create_app()
+    with app.app_context():
+        models.init_db()
+'''
+
+
+def measure(tree, runs, env):
+    subprocess.run([sys.executable, '-c', INIT], cwd=tree, env=env, check=True, capture_output=True)
+    imports, firsts = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE], cwd=tree, env=env,
+                             check=True, capture_output=True, text=True).stdout
+        imported, first = map(float, out.split()[-2:])
+        imports.append(imported)
+        firsts.append(first)
+    return statistics.median(imports), statistics.median(firsts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--ref', help='git ref to compare against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ, SECRET_KEY='bench', sqlalchemy_database_uri=f"sqlite:///{os.path.join(workdir, 'startup.db')}")
+
+    trees = [('working tree', ROOT)]
+    if args.ref:
+        worktree = os.path.join(workdir, 'ref')
+        subprocess.run(['git', 'worktree', 'add', '--detach', worktree, args.ref],
+                       cwd=ROOT, check=True, capture_output=True)
+        trees.insert(0, (args.ref, worktree))
+
+    try:
+        for label, tree in trees:
+            imported, first = measure(tree, args.runs, env)
+            print(f'{label:<14} import+create={imported * 1000:7.1f}ms  first request={first * 1000:7.1f}ms')
+    finally:
+        if args.ref:
+            subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=ROOT, capture_output=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""Route benchmark suite: latency, query count and peak memory for every page.
+
+Generates a synthetic dataset (datagen.py) into a throwaway SQLite file,
+then drives each route through the Flask test client as an anonymous
+visitor, a user or the admin. Per route it records the latency
+percentiles, the SQL statements per request and the peak Python memory
+allocated while handling one. The results are written as JSON, so runs
+on two commits can be compared:
+
+    python benchmarks/suite.py --output before.json
+    git checkout my-branch
+    python benchmarks/suite.py --output after.json --compare before.json
+
+--compare exits with status 1 when a route's median latency grows by
+more than --threshold, or when it issues more queries than before.
+Untimed setup (claiming a spot to release, creating a lot to delete)
+runs before each iteration. The Server-Sent Events stream never ends and
+is left out; benchmarks/load_test.py covers HTTP-level throughput.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from datagen import PASSWORD, WORDS, generate  # noqa: E402
+
+OK_STATUSES = (200, 201, 302, 304)
+MEMORY_ITERATIONS = 3
+
+
+class Scenario:
+
+    def __init__(self, name, role, request, setup=None):
+        self.name = name
+        self.role = role          # 'anon', 'user' or 'admin': which client sends the request
+        self.request = request    # (client, prepared) -> response
+        self.setup = setup        # () -> prepared, run untimed before every iteration
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def build_scenarios(app, lot_ids, spot_ids, usernames, bench_user_id, log_in_user, rng):
+    from models import db, ParkingLot
+    from allocation import claim_any_spot
+    from provisioning import provision_spots
+
+    def in_app(func):
+        def wrapper():
+            with app.app_context():
+                return func()
+        return wrapper
+
+    @in_app
+    def claimed_reservation():
+        for lot_id in rng.sample(lot_ids, len(lot_ids)):
+            reservation = claim_any_spot(lot_id, bench_user_id, 'BENCH')
+            if reservation:
+                return reservation.id
+        raise RuntimeError('every lot is full; lower --occupancy or run fewer --iterations')
+
+    @in_app
+    def new_lot():
+        lot = ParkingLot(prime_location_name='Scratch Lot', address='-', pin_code='000000', price=10,
+                         maximum_number_of_spots=10)
+        db.session.add(lot)
+        db.session.flush()
+        provision_spots(lot.id, 10)
+        db.session.commit()
+        return lot.id
+
+    def future_window():
+        start = datetime.utcnow() + timedelta(days=rng.randint(1, 60), hours=rng.randint(0, 23))
+        end = start + timedelta(hours=rng.randint(1, 8))
+        return {'start_time': start.strftime('%Y-%m-%dT%H:%M'), 'end_time': end.strftime('%Y-%m-%dT%H:%M'),
+                'vehicle_number': 'BENCH'}
+
+    etags = {}
+
+    def conditional_get(client, url):
+        response = client.get(url, headers={'If-None-Match': etags.get(url, '')})
+        etags[url] = response.headers.get('ETag', '')
+        return response
+
+    lot = lambda: rng.choice(lot_ids)  # noqa: E731
+    word = lambda: rng.choice(WORDS)  # noqa: E731
+    counter = iter(range(10 ** 9))
+
+    return [
+        Scenario('login_form', 'anon', lambda c, _: c.get('/login')),
+        Scenario('login', 'anon', lambda c, _: c.post('/login', data={'username': rng.choice(usernames),
+                                                                    'password': PASSWORD})),
+        Scenario('register', 'anon', lambda c, n: c.post('/register', data={
+            'name': 'New User', 'email': f'new{n}@bench.invalid', 'username': f'new{n}',
+            'password': PASSWORD, 'confirm_password': PASSWORD}), setup=lambda: next(counter)),
+        Scenario('dashboard', 'user', lambda c, _: c.get('/dashboard')),
+        Scenario('dashboard_search', 'user', lambda c, _: c.get(f'/dashboard?q={word()}')),
+        Scenario('dashboard_search_page2', 'user', lambda c, _: c.get(f'/dashboard?q={word()}&page=2')),
+        Scenario('book_form', 'user', lambda c, _: c.get(f'/book/lot/{lot()}')),
+        Scenario('book', 'user', lambda c, _: c.post(f'/book/lot/{lot()}', data={'vehicle_number': 'BENCH'})),
+        Scenario('release_form', 'user', lambda c, rid: c.get(f'/release/{rid}'), setup=claimed_reservation),
+        Scenario('release', 'user', lambda c, rid: c.post(f'/release/{rid}'), setup=claimed_reservation),
+        Scenario('book_ahead', 'user', lambda c, _: c.post(f'/book/lot/{lot()}/ahead', data=future_window())),
+        Scenario('api_lots', 'user', lambda c, _: c.get('/api/v1/lots')),
+        Scenario('api_lots_search', 'user', lambda c, _: c.get(f'/api/v1/lots?q={word()}')),
+        Scenario('api_availability', 'user', lambda c, _: c.get(f'/api/v1/availability?lots={lot()},{lot()},{lot()}')),
+        Scenario('api_availability_304', 'user',
+                 lambda c, _: conditional_get(c, f'/api/v1/availability?lots={",".join(map(str, lot_ids[:20]))}')),
+        Scenario('api_book', 'user', lambda c, _: c.post(f'/api/v1/lots/{lot()}/reservations', json={'vehicle': 'BENCH'})),
+        Scenario('api_release', 'user', lambda c, rid: c.post(f'/api/v1/reservations/{rid}/release'),
+                 setup=claimed_reservation),
+        Scenario('api_reservations', 'user', lambda c, _: c.get('/api/v1/reservations')),
+        Scenario('user_summary', 'user', lambda c, _: c.get('/summary')),
+        Scenario('profile', 'user', lambda c, _: c.get('/profile')),
+        Scenario('admin_grid', 'admin', lambda c, _: c.get('/admin')),
+        Scenario('admin_grid_page2', 'admin', lambda c, _: c.get('/admin?page=2')),
+        Scenario('admin_lot_spots', 'admin', lambda c, _: c.get(f'/admin/parking_lot/{lot()}/spots')),
+        Scenario('admin_summary', 'admin', lambda c, _: c.get('/admin/summary')),
+        Scenario('admin_analytics_day', 'admin', lambda c, _: c.get('/admin/analytics?granularity=day')),
+        Scenario('admin_analytics_hour', 'admin', lambda c, _: c.get(f'/admin/analytics?granularity=hour&lot_id={lot()}')),
+        Scenario('admin_users', 'admin', lambda c, _: c.get('/admin/users')),
+        Scenario('admin_search_lots', 'admin', lambda c, _: c.post('/admin/search', data={
+            'search_by': 'location', 'search_string': word()})),
+        Scenario('admin_search_users', 'admin', lambda c, _: c.post('/admin/search', data={
+            'search_by': 'user_username', 'search_string': f'bench{rng.randint(1, 99)}'})),
+        Scenario('admin_spot_details', 'admin', lambda c, _: c.get(f'/admin/spot/details/{rng.choice(spot_ids)}')),
+        Scenario('admin_add_lot_form', 'admin', lambda c, _: c.get('/admin/parking_lot/add')),
+        Scenario('admin_add_lot', 'admin', lambda c, n: c.post('/admin/parking_lot/add', data={
+            'prime_location_name': f'Added Lot {n}', 'address': '-', 'pin_code': '000000', 'price': '10',
+            'maximum_number_of_spots': '20'}), setup=lambda: next(counter)),
+        Scenario('admin_edit_lot_form', 'admin', lambda c, _: c.get(f'/admin/parking_lot/edit/{lot()}')),
+        Scenario('admin_delete_lot', 'admin', lambda c, lot_id: c.post(f'/admin/parking_lot/delete/{lot_id}'),
+                 setup=new_lot),
+        Scenario('admin_export_csv', 'admin', lambda c, _: c.get(f'/admin/export/reservations.csv?lot_id={lot()}')),
+        Scenario('admin_cache', 'admin', lambda c, _: c.get('/admin/cache')),
+        Scenario('admin_profile', 'admin', lambda c, _: c.get('/admin/profile')),
+        Scenario('metrics', 'anon', lambda c, _: c.get('/metrics')),
+        Scenario('logout', 'user', lambda c, _: c.get('/logout'), setup=log_in_user),
+    ]
+
+
+def run_scenario(scenario, client, iterations):
+    from instrumentation import count_queries
+
+    def once():
+        prepared = scenario.setup() if scenario.setup else None
+        with count_queries() as counter:
+            started = time.perf_counter()
+            response = scenario.request(client, prepared)
+            response.get_data()  # streamed bodies (the exports) are generated here
+            elapsed = time.perf_counter() - started
+        return elapsed, counter.count, response.status_code
+
+    once()  # warm-up: first-use index loads and template compilation
+    latencies, queries, errors = [], [], 0
+    for _ in range(iterations):
+        elapsed, count, status = once()
+        latencies.append(elapsed)
+        queries.append(count)
+        errors += status not in OK_STATUSES
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(MEMORY_ITERATIONS):
+        tracemalloc.reset_peak()
+        once()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "min_ms": min(latencies) * 1000,
+        "queries": statistics.median(queries),
+        "queries_max": max(queries),
+        "peak_kib": max(peaks) / 1024,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Prints old -> new per route. Returns the names of routes that regressed."""
+    regressed = []
+    print(f'\n{"route":<24} {"p50 before":>11} {"p50 after":>10} {"change":>8} {"queries":>12}')
+    for name, new in results["routes"].items():
+        old = baseline["routes"].get(name)
+        if old is None:
+            print(f'{name:<24} {"-":>11} {new["p50_ms"]:9.2f}ms {"new":>8}')
+            continue
+        change = new["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        slower = change > threshold
+        more_queries = new["queries"] > old["queries"]
+        if slower or more_queries:
+            regressed.append(name)
+        print(f'{name:<24} {old["p50_ms"]:9.2f}ms {new["p50_ms"]:9.2f}ms {change:+7.0%} '
+              f'{old["queries"]:>5g} -> {new["queries"]:<4g}{"  REGRESSED" if slower or more_queries else ""}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lots', type=int, default=50)
+    parser.add_argument('--spots', type=int, default=40, help='spots per lot')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--reservations', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=180, help='length of the reservation history')
+    parser.add_argument('--occupancy', type=float, default=0.3, help='share of spots occupied at the start')
+    parser.add_argument('--iterations', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--only', nargs='+', metavar='ROUTE', help='run just these scenarios')
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative p50 slowdown counted as a regression (default 0.25)')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SWEEP_INTERVAL'] = ''  # no background writes while timing
+
+    from app import create_app
+    from models import init_db, User, ParkingLot, ParkingSpot
+
+    app = create_app()
+    rng = random.Random(args.seed)
+    with app.app_context():
+        admin = init_db()
+        started = time.perf_counter()
+        usernames = generate(args.lots, args.spots, args.users, args.reservations, args.days, args.occupancy,
+                             args.seed)
+        print(f'seeded {args.lots} lots x {args.spots} spots, {args.users} users, {args.reservations} '
+              f'reservations in {time.perf_counter() - started:.1f}s')
+        lot_ids = [row[0] for row in ParkingLot.query.with_entities(ParkingLot.id)]
+        spot_ids = [row[0] for row in ParkingSpot.query.with_entities(ParkingSpot.id)]
+        bench_user = User.query.filter_by(username=usernames[0]).one()
+        admin_id, bench_user_id = admin.id, bench_user.id
+
+    clients = {'anon': app.test_client(), 'user': app.test_client(), 'admin': app.test_client()}
+
+    def log_in(role, user_id, is_admin):
+        with clients[role].session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['is_admin'] = is_admin
+
+    log_in('user', bench_user_id, False)
+    log_in('admin', admin_id, True)
+
+    scenarios = build_scenarios(app, lot_ids, spot_ids, usernames, bench_user_id,
+                                lambda: log_in('user', bench_user_id, False), rng)
+    if args.only:
+        unknown = set(args.only) - {s.name for s in scenarios}
+        if unknown:
+            parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+        scenarios = [s for s in scenarios if s.name in args.only]
+
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.utcnow().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": {key: getattr(args, key) for key in
+                  ('lots', 'spots', 'users', 'reservations', 'days', 'occupancy', 'iterations', 'seed')},
+        "routes": {},
+    }
+
+    print(f'{"route":<24} {"p50":>9} {"p95":>9} {"queries":>8} {"peak":>10} {"errors":>7}')
+    for scenario in scenarios:
+        stats = run_scenario(scenario, clients[scenario.role], args.iterations)
+        results["routes"][scenario.name] = stats
+        print(f'{scenario.name:<24} {stats["p50_ms"]:7.2f}ms {stats["p95_ms"]:7.2f}ms {stats["queries"]:>8g} '
+              f'{stats["peak_kib"]:7.0f}KiB {stats["errors"]:>7}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'\nwrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != results["scale"]:
+            print('warning: the baseline was run at a different scale', file=sys.stderr)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f'\n{len(regressed)} route(s) regressed: {", ".join(regressed)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Write-behind bookings: bookings per second against a commit per booking.
+
+Each mode seeds a fresh SQLite database with datagen, then --threads
+threads book and release spots in random lots for --duration seconds,
+calling the allocation engine directly. The modes are:
+
+    commit        a transaction per booking, as shipped (WAL, synchronous=NORMAL: no fsync per commit)
+    commit-full   the same with synchronous=FULL, i.e. an fsync per booking
+    write-behind  WRITE_BEHIND_LOG set: an fsync of the event log shared by concurrent bookings
+    write-behind-nofsync  the same with WRITE_BEHIND_FSYNC=False
+
+For the write-behind modes the time the writer then needs to catch up is
+reported too, and the database is checked against the bookings made.
+Each mode runs in its own process, so per-process state starts empty.
+
+    python benchmarks/write_behind.py --threads 8 --duration 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ('commit', 'commit-full', 'write-behind', 'write-behind-nofsync')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else float('nan')
+
+
+def run(mode, options):
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    directory = tempfile.mkdtemp()
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{os.path.join(directory, "bench.db")}'
+    os.environ['LOT_SHARDS'] = ''
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SWEEP_INTERVAL'] = ''
+    os.environ['WRITE_BEHIND_LOG'] = os.path.join(directory, 'events.log') if mode.startswith('write-behind') else ''
+    os.environ['WRITE_BEHIND_FSYNC'] = str(mode != 'write-behind-nofsync')
+    os.environ['WRITE_BEHIND_BATCH_SIZE'] = str(options['batch_size'])
+    os.environ['WRITE_BEHIND_INTERVAL'] = str(options['interval'])
+
+    from sqlalchemy import event, func
+    from sqlalchemy.engine import Engine
+    from datagen import generate
+    from app import create_app
+    from models import db, init_db, User, ParkingLot, ParkingSpot, Reservation
+    from allocation import claim_any_spot, release_reservation
+    import write_behind
+
+    if mode == 'commit-full':
+        @event.listens_for(Engine, 'connect')
+        def full_sync(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA synchronous=FULL')
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        generate(lots=options['lots'], spots_per_lot=options['spots'], users=200,
+                 reservations=options['reservations'], occupancy=0.2)
+        lot_ids = [row[0] for row in ParkingLot.query.with_entities(ParkingLot.id)]
+        user_ids = [row[0] for row in User.query.with_entities(User.id).filter_by(is_admin=False)]
+
+    stop = threading.Event()
+    latencies, failures = [], []
+    lock = threading.Lock()
+
+    def book_and_release(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            started = time.perf_counter()
+            with app.app_context():
+                reservation = claim_any_spot(rng.choice(lot_ids), rng.choice(user_ids), 'BENCH')
+                released = reservation is not None and release_reservation(reservation.id, 1.0)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                if not released:
+                    failures.append(seed)
+
+    threads = [threading.Thread(target=book_and_release, args=(i,)) for i in range(options['threads'])]
+    for thread in threads:
+        thread.start()
+    time.sleep(options['duration'])
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    catch_up, batches = 0.0, None
+    with app.app_context():
+        if write_behind.enabled():
+            started = time.perf_counter()
+            write_behind.drain()
+            catch_up = time.perf_counter() - started
+            batches = write_behind.stats()['batches']
+        active = db.session.query(func.count(Reservation.id)).filter(Reservation.leaving_timestamp.is_(None)).scalar()
+        occupied = db.session.query(func.count(ParkingSpot.id)).filter_by(status='O').scalar()
+    return {
+        'per_second': len(latencies) / options['duration'],
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'failures': len(failures),
+        'catch_up_ms': catch_up * 1000,
+        'batches': batches,
+        'consistent': active == occupied,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma-separated, from {", ".join(MODES)}')
+    parser.add_argument('--threads', type=int, default=8, help='threads booking and releasing')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--lots', type=int, default=40)
+    parser.add_argument('--spots', type=int, default=500, help='spots per lot')
+    parser.add_argument('--reservations', type=int, default=20000, help='reservation history to seed')
+    parser.add_argument('--batch-size', type=int, default=500, help='WRITE_BEHIND_BATCH_SIZE')
+    parser.add_argument('--interval', type=float, default=0.05, help='WRITE_BEHIND_INTERVAL')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for mode in args.modes.split(','):
+        with context.Pool(1) as pool:
+            result = pool.apply(run, (mode, vars(args)))
+        line = (f'{mode:21} {result["per_second"]:8.1f} book+release/s  p50={result["p50_ms"]:6.1f}ms  '
+                f'p99={result["p99_ms"]:6.1f}ms  failed={result["failures"]}')
+        if result['batches'] is not None:
+            line += f'  caught up in {result["catch_up_ms"]:.0f}ms, {result["batches"]} batches'
+        print(line + ('' if result['consistent'] else '  DATABASE INCONSISTENT'))
+
+
+if __name__ == '__main__':
+    main()
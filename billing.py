@@ -0,0 +1,184 @@
+"""Parking charges: a lot's hourly price plus optional tariff rules.
+
+A ``Tariff`` can add a minimum charge, a night rate for hours inside the
+night window, and a cap on what any 24 hours of parking costs. Lots
+without a tariff are charged ``hours * price`` as before.
+
+Pricing is vectorized with NumPy, so one code path prices a single
+release and re-prices months of history. Night hours are counted with a
+cumulative function (night hours since the epoch up to t), and the
+overlap of a stay with the night window is N(end) - N(start). This needs
+no per-day loop. Every full 24 hours of a stay contains exactly one night
+window, so the daily cap is applied per full day plus once to the
+remainder.
+"""
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, update
+
+from models import db, ParkingLot, ParkingSpot, Reservation, Tariff
+import analytics
+import reports
+import shards
+
+
+EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+HOUR = np.timedelta64(1, 'h')
+REPRICE_BATCH_SIZE = 5000
+
+
+def _night_hours_within_day(h, night_start, night_end):
+    """Night hours in [0, h) of a day, where h is an hour of the day in [0, 24]."""
+    wrapping = night_start > night_end  # e.g. 22 -> 6 spans midnight
+    return np.where(
+        wrapping,
+        np.minimum(h, night_end) + np.maximum(h - night_start, 0),
+        np.clip(h - night_start, 0, np.maximum(night_end - night_start, 0)),
+    )
+
+
+def _night_hours_before(t, night_start, night_end):
+    """Night hours between the epoch and t (in hours since the epoch)."""
+    days = np.floor(t / 24)
+    per_day = _night_hours_within_day(24, night_start, night_end)
+    return days * per_day + _night_hours_within_day(t - days * 24, night_start, night_end)
+
+
+def price(parked, left, hourly, night_price=np.nan, minimum_charge=np.nan, daily_cap=np.nan,
+          night_start=22, night_end=6):
+    """Charges for stays from parked to left (datetime64 arrays).
+
+    The tariff arguments broadcast against the timestamps, so they can be
+    scalars or one value per stay. NaN means the rule does not apply.
+    """
+    start = (np.asarray(parked, dtype='datetime64[us]') - EPOCH) / HOUR
+    end = (np.asarray(left, dtype='datetime64[us]') - EPOCH) / HOUR
+    hourly = np.asarray(hourly, dtype=float)
+    night_price = np.where(np.isnan(night_price), hourly, night_price)
+    daily_cap = np.where(np.isnan(daily_cap), np.inf, daily_cap)
+
+    hours = np.maximum(end - start, 0)
+    full_days = np.floor(hours / 24)
+    night_per_day = _night_hours_within_day(24, night_start, night_end)
+    day_cost = (24 - night_per_day) * hourly + night_per_day * night_price
+
+    remainder_start = start + full_days * 24
+    remainder_night = (_night_hours_before(start + hours, night_start, night_end)
+                       - _night_hours_before(remainder_start, night_start, night_end))
+    remainder_cost = (hours - full_days * 24 - remainder_night) * hourly + remainder_night * night_price
+
+    cost = full_days * np.minimum(day_cost, daily_cap) + np.minimum(remainder_cost, daily_cap)
+    return np.where(np.isnan(minimum_charge), cost, np.maximum(cost, minimum_charge))
+
+
+def _tariff_args(tariff):
+    if tariff is None:
+        return {}
+    return dict(
+        night_price=np.nan if tariff.night_price is None else tariff.night_price,
+        minimum_charge=np.nan if tariff.minimum_charge is None else tariff.minimum_charge,
+        daily_cap=np.nan if tariff.daily_cap is None else tariff.daily_cap,
+        night_start=tariff.night_start_hour,
+        night_end=tariff.night_end_hour,
+    )
+
+
+def quote(lot, parked_at, left_at=None):
+    """The charge for one stay in lot, up to now if left_at is not given."""
+    left_at = left_at or datetime.utcnow()
+    return float(price([parked_at], [left_at], lot.price, **_tariff_args(lot.tariff))[0])
+
+
+def lot_parameters(lot_ids):
+    """Per-stay tariff arrays for an array of lot ids."""
+    lots, positions = np.unique(lot_ids, return_inverse=True)
+    hourly = dict(db.session.execute(
+        select(ParkingLot.id, ParkingLot.price).where(ParkingLot.id.in_(lots.tolist()))
+    ).all())
+    tariffs = {t.lot_id: _tariff_args(t) for t in Tariff.query.filter(Tariff.lot_id.in_(lots.tolist()))}
+
+    def column(key, default):
+        return np.array([tariffs.get(lot, {}).get(key, default) for lot in lots.tolist()], dtype=float)[positions]
+
+    return dict(
+        hourly=np.array([hourly[lot] for lot in lots.tolist()], dtype=float)[positions],
+        night_price=column('night_price', np.nan),
+        minimum_charge=column('minimum_charge', np.nan),
+        daily_cap=column('daily_cap', np.nan),
+        night_start=column('night_start', 22),
+        night_end=column('night_end', 6),
+    )
+
+
+class RepriceResult:
+
+    def __init__(self, ids, old, new):
+        self.ids = ids
+        self.old = old
+        self.new = new
+        self.changed = ~np.isclose(np.nan_to_num(old, nan=-1), new, rtol=0, atol=0.005)
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def summary(self):
+        return (f'{self.count} reservations, {int(self.changed.sum())} changed; '
+                f'total {np.nansum(self.old):.2f} -> {self.new.sum():.2f}')
+
+
+def _completed(lot_id, start, end):
+    query = select(
+        Reservation.id, ParkingSpot.lot_id, Reservation.parking_timestamp,
+        Reservation.leaving_timestamp, Reservation.parking_cost,
+    ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
+     .where(Reservation.leaving_timestamp.isnot(None))
+    if lot_id is not None:
+        query = query.where(ParkingSpot.lot_id == lot_id)
+    if start is not None:
+        query = query.where(Reservation.parking_timestamp >= start)
+    if end is not None:
+        query = query.where(Reservation.parking_timestamp < end)
+    return db.session.execute(query).all()
+
+
+def reprice(lot_id=None, start=None, end=None, apply=False):
+    """Prices completed reservations under the current tariffs.
+
+    Without apply this is an audit: it only compares the stored costs with
+    the recomputed ones. With apply the changed costs are written back in
+    batches and lot summaries are rebuilt. Every shard is read (concurrently)
+    unless lot_id narrows it to one.
+    """
+    if lot_id is not None:
+        with shards.use(shards.for_lot(lot_id)):
+            rows = _completed(lot_id, start, end)
+    else:
+        rows = [row for result in shards.gather(_completed, None, start, end) for row in result]
+    if not rows:
+        empty = np.array([], dtype=float)
+        return RepriceResult(np.array([], dtype=int), empty, empty)
+
+    ids, lot_ids, parked, left, old = zip(*rows)
+    ids = np.array(ids)
+    old = np.array(old, dtype=float)  # NULL costs become NaN
+    new = price(np.array(parked, dtype='datetime64[us]'), np.array(left, dtype='datetime64[us]'),
+                **lot_parameters(np.array(lot_ids)))
+    result = RepriceResult(ids, old, new)
+
+    if apply and result.changed.any():
+        changed = {}
+        for i, c in zip(ids[result.changed].tolist(), new[result.changed].tolist()):
+            changed.setdefault(shards.for_id(i), []).append({"id": i, "parking_cost": c})
+        for name, costs in changed.items():
+            with shards.use(name):
+                for offset in range(0, len(costs), REPRICE_BATCH_SIZE):
+                    db.session.execute(update(Reservation), costs[offset:offset + REPRICE_BATCH_SIZE])
+                db.session.commit()
+        if reports.summary_table_enabled():
+            reports.refresh_lot_summaries()
+        if analytics.rollups_enabled():
+            # Revenue is rolled up in the bucket where each stay ended.
+            analytics.backfill(since=min(left[i] for i in np.flatnonzero(result.changed)))
+    return result
@@ -0,0 +1,172 @@
+"""In-memory index of advance-booking windows.
+
+Each spot keeps its upcoming windows as a sorted list of non-overlapping
+``(start, end, booking_id)`` intervals. Because they never overlap,
+sorting by start also sorts them by end. A conflict check for
+[start, end) is then a single bisect: find the last interval starting
+before ``end`` and test whether it ends after ``start``. "Find a spot
+free from T1 to T2" runs that check once per spot in the lot and never
+scans reservations. Each lot also keeps all its windows sorted by start,
+so "which spots are booked from T1 to T2" (``held``, asked on every
+walk-in) bisects to the windows starting between T1 minus the lot's
+longest window and T2, instead of checking every spot.
+
+The index is only a hint; bookings.py re-checks the database before
+writing a booking. Each worker reloads a lot's intervals once they are
+older than ``BOOKING_INDEX_MAX_AGE`` seconds.
+
+A checked-in booking's window ends when its reservation is released
+(``end_checked_in``), so leaving early frees the rest of the window.
+"""
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+
+from models import db, ParkingSpot, AdvanceBooking
+import shards
+
+
+ACTIVE_STATUSES = ('B', 'U')  # windows that block other bookings
+
+
+class BookingIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spots = {}      # lot_id -> spot ids in spot_number order
+        self._windows = {}    # spot_id -> sorted [(start, end, booking_id)]
+        self._spot_lot = {}   # spot_id -> lot_id
+        self._starts = {}     # lot_id -> sorted [(start, end, spot_id, booking_id)]
+        self._longest = {}    # lot_id -> longest window in _starts
+        self._loaded_at = {}  # lot_id -> time.monotonic() of the last load
+
+    def _load_lot(self, lot_id):
+        with shards.use(shards.for_lot(lot_id)):
+            spots = [row[0] for row in db.session.query(ParkingSpot.id)
+                     .filter_by(lot_id=lot_id).order_by(ParkingSpot.spot_number)]
+            rows = db.session.query(AdvanceBooking.spot_id, AdvanceBooking.start_time,
+                                    AdvanceBooking.end_time, AdvanceBooking.id)\
+                             .join(ParkingSpot, ParkingSpot.id == AdvanceBooking.spot_id)\
+                             .filter(ParkingSpot.lot_id == lot_id,
+                                     AdvanceBooking.status.in_(ACTIVE_STATUSES),
+                                     AdvanceBooking.end_time > datetime.utcnow()).all()
+        windows = {spot_id: [] for spot_id in spots}
+        for spot_id, start, end, booking_id in rows:
+            windows.setdefault(spot_id, []).append((start, end, booking_id))
+        starts = sorted((start, end, spot_id, booking_id) for spot_id, start, end, booking_id in rows)
+        with self._lock:
+            for spot_id in self._spots.get(lot_id, ()):
+                self._windows.pop(spot_id, None)
+                self._spot_lot.pop(spot_id, None)
+            for spot_id, intervals in windows.items():
+                intervals.sort()
+                self._windows[spot_id] = intervals
+                self._spot_lot[spot_id] = lot_id
+            self._spots[lot_id] = spots
+            self._starts[lot_id] = starts
+            self._longest[lot_id] = max((end - start for start, end, _spot_id, _booking_id in starts),
+                                        default=timedelta(0))
+            self._loaded_at[lot_id] = time.monotonic()
+
+    def _refresh_if_stale(self, lot_id):
+        max_age = current_app.config.get('BOOKING_INDEX_MAX_AGE')
+        loaded_at = self._loaded_at.get(lot_id)
+        if loaded_at is None or (max_age is not None and time.monotonic() - loaded_at >= max_age):
+            self._load_lot(lot_id)
+
+    def invalidate(self, lot_id):
+        """Forces a reload of the lot on next use, e.g. after its spots changed."""
+        with self._lock:
+            self._loaded_at.pop(lot_id, None)
+
+    @staticmethod
+    def _overlaps(intervals, start, end):
+        position = bisect.bisect_left(intervals, (end,))  # first interval starting at or after end
+        return position > 0 and intervals[position - 1][1] > start
+
+    def is_free(self, spot_id, start, end, lot_id=None):
+        """Whether no booking of the spot overlaps [start, end). Pass the spot's lot_id to load the lot on first use."""
+        lot_id = lot_id or self._spot_lot.get(spot_id)
+        if lot_id is not None:
+            self._refresh_if_stale(lot_id)
+        with self._lock:
+            return not self._overlaps(self._windows.get(spot_id, []), start, end)
+
+    def free_spots(self, lot_id, start, end, limit=None):
+        """Spot ids of the lot with no booking overlapping [start, end), in spot_number order."""
+        self._refresh_if_stale(lot_id)
+        found = []
+        with self._lock:
+            for spot_id in self._spots.get(lot_id, ()):
+                if not self._overlaps(self._windows[spot_id], start, end):
+                    found.append(spot_id)
+                    if len(found) == limit:
+                        break
+        return found
+
+    def held(self, lot_id, start, end):
+        """Ids of the lot's spots with a booking overlapping [start, end), which walk-ins leave alone."""
+        self._refresh_if_stale(lot_id)
+        with self._lock:
+            starts = self._starts.get(lot_id, [])
+            # A window overlapping [start, end) starts before end, and no earlier than start minus the longest one.
+            first = bisect.bisect_left(starts, (start - self._longest.get(lot_id, timedelta(0)),))
+            last = bisect.bisect_left(starts, (end,))
+            return {spot_id for _start, window_end, spot_id, _booking_id in starts[first:last] if window_end > start}
+
+    def add(self, spot_id, start, end, booking_id):
+        with self._lock:
+            intervals = self._windows.get(spot_id)
+            if intervals is not None:
+                bisect.insort(intervals, (start, end, booking_id))
+                lot_id = self._spot_lot[spot_id]
+                bisect.insort(self._starts[lot_id], (start, end, spot_id, booking_id))
+                self._longest[lot_id] = max(self._longest[lot_id], end - start)
+
+    def remove(self, spot_id, start, end, booking_id):
+        with self._lock:
+            intervals = self._windows.get(spot_id)
+            if intervals is None:
+                return
+            position = bisect.bisect_left(intervals, (start, end, booking_id))
+            if position < len(intervals) and intervals[position] == (start, end, booking_id):
+                del intervals[position]
+            starts = self._starts[self._spot_lot[spot_id]]
+            position = bisect.bisect_left(starts, (start, end, spot_id, booking_id))
+            if position < len(starts) and starts[position] == (start, end, spot_id, booking_id):
+                del starts[position]
+
+
+booking_index = BookingIndex()
+
+
+def end_checked_in(leaving):
+    """Ends checked-in bookings at the time their reservation was released, in the current transaction.
+
+    leaving maps reservation id -> leaving timestamp. Returns the (spot_id, start, end, booking_id)
+    windows to remove from booking_index once the transaction commits.
+    """
+    # Filtered on status here rather than in SQL, so the lookup stays on ix_advance_bookings_reservation.
+    windows = db.session.query(AdvanceBooking.spot_id, AdvanceBooking.start_time, AdvanceBooking.end_time,
+                               AdvanceBooking.id, AdvanceBooking.reservation_id, AdvanceBooking.status)\
+                        .filter(AdvanceBooking.reservation_id.in_(list(leaving))).all()
+    ended = [(spot_id, start, end, booking_id, max(start, leaving[reservation_id]))
+             for spot_id, start, end, booking_id, reservation_id, status in windows
+             if status == 'U' and end > leaving[reservation_id]]
+    if ended:
+        db.session.execute(update(AdvanceBooking), [{"id": booking_id, "end_time": end_time}
+                                                    for _spot_id, _start, _end, booking_id, end_time in ended])
+    return [window[:4] for window in ended]
+
+
+def has_active_bookings(spot_ids, now=None):
+    """Whether any of the spots has a booking that is not over, cancelled or expired."""
+    return db.session.query(AdvanceBooking.id).filter(
+        AdvanceBooking.spot_id.in_(spot_ids),
+        AdvanceBooking.status.in_(ACTIVE_STATUSES),
+        AdvanceBooking.end_time > (now or datetime.utcnow()),
+    ).first() is not None
@@ -0,0 +1,207 @@
+"""Advance bookings: reserving a spot for a future time window.
+
+Free windows are found with the interval index in booking_index.py. As
+with the free-spot index, it is only a hint: a booking is written after
+locking the spot row and re-checking for overlaps with an indexed range
+query, so two workers can never book overlapping windows.
+
+Walk-ins leave alone spots whose booking starts within the next
+``WALK_IN_STAY_HOURS`` (see allocation.claim_any_spot). If a booker's spot
+is still occupied at check-in, e.g. by a walk-in who stayed longer, they
+are moved to another spot in the lot that is free for their whole window.
+Check-in first flips the booking from 'B' to 'U' with a conditional
+UPDATE, so a booking submitted twice claims one spot, not two.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+
+from models import db, ParkingSpot, Reservation, AdvanceBooking
+from allocation import backoff, claim_spot, MAX_CLAIM_ATTEMPTS
+from booking_index import booking_index, ACTIVE_STATUSES
+import shards
+import write_behind
+
+
+MAX_BOOKING_DURATION = timedelta(days=7)
+MAX_DAYS_AHEAD = 90
+CHECK_IN_EARLY = timedelta(minutes=15)
+
+
+def validate_window(start, end, now=None):
+    """Raises ValueError with a user-facing message if the window cannot be booked."""
+    now = now or datetime.utcnow()
+    if end <= start:
+        raise ValueError('The end time must be after the start time.')
+    if end <= now:
+        raise ValueError('The booking window is already over.')
+    if end - start > MAX_BOOKING_DURATION:
+        raise ValueError(f'Bookings can be at most {MAX_BOOKING_DURATION.days} days long.')
+    if start > now + timedelta(days=MAX_DAYS_AHEAD):
+        raise ValueError(f'Bookings can be made at most {MAX_DAYS_AHEAD} days ahead.')
+
+
+def _overlapping(spot_id, start, end):
+    return db.session.query(AdvanceBooking.id).filter(
+        AdvanceBooking.spot_id == spot_id,
+        AdvanceBooking.status.in_(ACTIVE_STATUSES),
+        AdvanceBooking.start_time < end,
+        AdvanceBooking.end_time > start,
+    ).first() is not None
+
+
+def _try_book(spot_id, user_id, start, end, vehicle_number):
+    """Books one spot if nothing overlaps. Returns the AdvanceBooking or None."""
+    # A no-op UPDATE takes the spot's row lock (the database lock on SQLite),
+    # so concurrent bookings of one spot are checked one after the other.
+    locked = db.session.execute(
+        update(ParkingSpot)
+        .where(ParkingSpot.id == spot_id)
+        .values(status=ParkingSpot.status)
+        .execution_options(synchronize_session=False)
+    )
+    if locked.rowcount != 1 or _overlapping(spot_id, start, end):
+        db.session.rollback()
+        return None
+    booking = AdvanceBooking(user_id=user_id, spot_id=spot_id, start_time=start, end_time=end,
+                             vehicle_number=vehicle_number)
+    db.session.add(booking)
+    db.session.commit()
+    booking_index.add(spot_id, start, end, booking.id)
+    return booking
+
+
+def book(lot_id, user_id, start, end, vehicle_number):
+    """Books any spot in the lot for [start, end). Returns the AdvanceBooking, or None if none is free."""
+    validate_window(start, end)
+    with shards.use(shards.for_lot(lot_id)):
+        return _book(lot_id, user_id, start, end, vehicle_number)
+
+
+def _book(lot_id, user_id, start, end, vehicle_number):
+    for attempt in range(MAX_CLAIM_ATTEMPTS):
+        candidates = booking_index.free_spots(lot_id, start, end, limit=MAX_CLAIM_ATTEMPTS)
+        if not candidates:
+            return None
+        try:
+            for spot_id in candidates:
+                booking = _try_book(spot_id, user_id, start, end, vehicle_number)
+                if booking:
+                    return booking
+        except OperationalError:
+            db.session.rollback()
+            backoff(attempt)
+        # Another worker booked the candidates; reload the lot before the next round.
+        booking_index.invalidate(lot_id)
+    return None
+
+
+def cancel(booking_id, user_id):
+    """Cancels a booking that has not been checked in. Returns False if there was nothing to cancel."""
+    with shards.use(shards.for_id(booking_id)):
+        return _cancel(booking_id, user_id)
+
+
+def _cancel(booking_id, user_id):
+    booking = db.session.get(AdvanceBooking, booking_id)
+    if booking is None or booking.user_id != user_id:
+        return False
+    result = db.session.execute(
+        update(AdvanceBooking)
+        .where(AdvanceBooking.id == booking_id, AdvanceBooking.status == 'B')
+        .values(status='C')
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return False
+    booking_index.remove(booking.spot_id, booking.start_time, booking.end_time, booking.id)
+    return True
+
+
+def check_in(booking, now=None):
+    """Starts parking for a booking. Returns the Reservation, or None if no spot could be claimed.
+
+    Raises ValueError if the booking cannot be checked in yet (or any more).
+    """
+    now = now or datetime.utcnow()
+    if booking.status != 'B':
+        raise ValueError('This booking has already been used or cancelled.')
+    if now < booking.start_time - CHECK_IN_EARLY:
+        raise ValueError(f'Check-in opens {int(CHECK_IN_EARLY.total_seconds() // 60)} minutes before the booking starts.')
+    if now >= booking.end_time:
+        raise ValueError('This booking has expired.')
+    with shards.use(shards.for_id(booking.id)):
+        return _check_in(booking, now)
+
+
+def _set_status(booking_id, old, new):
+    """Compare-and-swap of the booking's status. Returns False if it was no longer old."""
+    result = db.session.execute(
+        update(AdvanceBooking)
+        .where(AdvanceBooking.id == booking_id, AdvanceBooking.status == old)
+        .values(status=new)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _claim_elsewhere(booking, now):
+    """Claims another spot of the booking's lot that is free for its whole window, or returns None."""
+    start = min(now, booking.start_time)
+    lot_id = db.session.query(ParkingSpot.lot_id).filter_by(id=booking.spot_id).scalar()
+    for spot_id in booking_index.free_spots(lot_id, start, booking.end_time):
+        if spot_id == booking.spot_id or _overlapping(spot_id, start, booking.end_time):
+            continue  # the index was stale
+        reservation = claim_spot(spot_id, booking.user_id, booking.vehicle_number)
+        if reservation:
+            return reservation
+    return None
+
+
+def _check_in(booking, now):
+    # Whoever flips the booking to 'U' first checks it in; a second submission stops here.
+    if not _set_status(booking.id, 'B', 'U'):
+        raise ValueError('This booking has already been used or cancelled.')
+    reservation = claim_spot(booking.spot_id, booking.user_id, booking.vehicle_number)
+    if reservation is None:
+        # The spot is still occupied; use another one free for the whole window.
+        reservation = _claim_elsewhere(booking, now)
+    if reservation is None:
+        _set_status(booking.id, 'U', 'B')
+        return None
+
+    moved = reservation.spot_id != booking.spot_id
+    write_behind.drain()  # the booking refers to the reservation's row
+    db.session.execute(
+        update(AdvanceBooking)
+        .where(AdvanceBooking.id == booking.id)
+        .values(reservation_id=reservation.id, spot_id=reservation.spot_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if moved:
+        booking_index.remove(booking.spot_id, booking.start_time, booking.end_time, booking.id)
+        booking_index.add(reservation.spot_id, booking.start_time, booking.end_time, booking.id)
+    # Loaded in its shard, like claim_spot; under write-behind claim_spot returns a transient one.
+    return db.session.get(Reservation, reservation.id)
+
+
+def _upcoming(user_id, now):
+    # The lot comes from the default database, so it is loaded with a second query rather than joined.
+    return AdvanceBooking.query.filter(
+        AdvanceBooking.user_id == user_id,
+        AdvanceBooking.status == 'B',
+        AdvanceBooking.end_time > now,
+    ).options(joinedload(AdvanceBooking.parking_spot).selectinload(ParkingSpot.parking_lot))\
+     .order_by(AdvanceBooking.start_time).all()
+
+
+def upcoming(user_id, now=None):
+    """The user's bookings that are not over, cancelled or used, soonest first, across shards."""
+    now = now or datetime.utcnow()
+    found = [booking for result in shards.gather(_upcoming, user_id, now) for booking in result]
+    return sorted(found, key=lambda booking: booking.start_time)
@@ -0,0 +1,347 @@
+"""Bulk loading of lots, users and historical reservations.
+
+Input files are CSV (with a header row), NDJSON/JSON Lines, or a JSON
+array. CSV and NDJSON are read and validated one row at a time. Valid
+rows are inserted with executemany in chunks, one transaction per chunk.
+Invalid rows, including NDJSON lines that are not JSON and entries that
+are not objects, are skipped and reported with their line number.
+
+Running servers pick imported rows up on their own: the free-spot and
+search indexes reload stale entries, and caches expire. Imported lots are
+spread over the lot shards like lots added by hand, and spots and
+reservations are written to their lot's shard.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from models import db, User, ParkingLot, ParkingSpot, Reservation
+import analytics
+import billing
+import reports
+import shards
+
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = []  # (line number, reason)
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def reject(self, line, reason):
+        self.rejected.append((line, reason))
+
+    def summary(self):
+        rate = self.inserted / self.elapsed if self.elapsed else 0
+        return (f'{self.inserted} rows inserted, {len(self.rejected)} rejected '
+                f'in {self.elapsed:.1f}s ({rate:.0f} rows/s)')
+
+
+class UnreadableRow:
+    """Stands in for a row that could not be parsed; _validated rejects it with reason."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def _json_row(text):
+    try:
+        row = json.loads(text)
+    except ValueError as e:
+        return UnreadableRow(f'not valid JSON: {e}')
+    return row if isinstance(row, dict) else UnreadableRow('each row must be a JSON object')
+
+
+def read_rows(path):
+    """Yields (line number, dict or UnreadableRow) from a CSV, NDJSON/JSONL or JSON array file."""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                yield line, row
+        elif extension in ('.ndjson', '.jsonl'):
+            for line, text in enumerate(f, start=1):
+                if text.strip():
+                    yield line, _json_row(text)
+        elif extension == '.json':
+            for line, row in enumerate(json.load(f), start=1):
+                yield line, row if isinstance(row, dict) else UnreadableRow('each entry must be a JSON object')
+        else:
+            raise ValueError(f'Unsupported file type "{extension}"; use .csv, .ndjson, .jsonl or .json')
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _required(row, field):
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        raise ValueError(f'{field} is required')
+    return str(value).strip()
+
+
+def _positive(row, field, cast):
+    try:
+        value = cast(_required(row, field))
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a number')
+    if value <= 0:
+        raise ValueError(f'{field} must be positive')
+    return value
+
+
+def _timestamp(row, field, required=True):
+    value = row.get(field)
+    if not value:
+        if required:
+            raise ValueError(f'{field} is required')
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f'{field} must be an ISO 8601 timestamp')
+
+
+def _validated(rows, validate, result):
+    for line, row in rows:
+        if isinstance(row, UnreadableRow):
+            result.reject(line, row.reason)
+            continue
+        try:
+            yield line, validate(row)
+        except ValueError as e:
+            result.reject(line, str(e))
+        except (TypeError, AttributeError):
+            # e.g. a JSON number or list where the validator expects text
+            result.reject(line, 'a field has the wrong type')
+
+
+# Lots
+
+def _validate_lot(row):
+    return {
+        "prime_location_name": _required(row, 'prime_location_name'),
+        "address": _required(row, 'address'),
+        "pin_code": _required(row, 'pin_code'),
+        "price": _positive(row, 'price', float),
+        "maximum_number_of_spots": _positive(row, 'maximum_number_of_spots', int),
+    }
+
+
+def import_lots(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Creates lots and all their (free) spots."""
+    result = ImportResult()
+    seen = set()
+    for chunk in _chunks(_validated(read_rows(path), _validate_lot, result), chunk_size):
+        names = [lot["prime_location_name"] for _line, lot in chunk]
+        existing = {name for (name,) in db.session.query(ParkingLot.prime_location_name)
+                    .filter(ParkingLot.prime_location_name.in_(names))}
+        lots = []
+        for line, lot in chunk:
+            name = lot["prime_location_name"]
+            if name in existing or name in seen:
+                result.reject(line, f'a parking lot named "{name}" already exists')
+                continue
+            seen.add(name)
+            lots.append(lot)
+        if not lots:
+            continue
+
+        db.session.execute(insert(ParkingLot), lots)
+        lot_ids = dict(db.session.query(ParkingLot.prime_location_name, ParkingLot.id)
+                       .filter(ParkingLot.prime_location_name.in_([lot["prime_location_name"] for lot in lots])))
+        placed = shards.assign(lot_ids.values())
+        for name in set(placed.values()):
+            with shards.use(name):
+                db.session.execute(insert(ParkingSpot), [
+                    {"lot_id": lot_ids[lot["prime_location_name"]], "spot_number": number, "status": 'A'}
+                    for lot in lots if placed[lot_ids[lot["prime_location_name"]]] == name
+                    for number in range(1, lot["maximum_number_of_spots"] + 1)
+                ])
+        db.session.commit()
+        result.inserted += len(lots)
+
+    if reports.summary_table_enabled():
+        reports.refresh_lot_summaries()
+    return result
+
+
+# Users
+
+def _validate_user(row):
+    password = row.get('password')
+    password_hash = row.get('password_hash')
+    if not password and not password_hash:
+        raise ValueError('password or password_hash is required')
+    if password and len(password) < 6:
+        raise ValueError('password must be at least 6 characters')
+    return {
+        "username": _required(row, 'username'),
+        "name": (row.get('name') or '').strip() or None,
+        "email": (row.get('email') or '').strip() or None,
+        "is_admin": str(row.get('is_admin', '')).lower() in ('1', 'true', 'yes'),
+        "password": password,
+        "password_hash": password_hash,
+    }
+
+
+def import_users(path, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+    """Creates users, hashing plain-text passwords across a process pool.
+
+    workers=1 hashes in this process; None uses one worker per CPU.
+    """
+    result = ImportResult()
+    seen_usernames, seen_emails = set(), set()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        for chunk in _chunks(_validated(read_rows(path), _validate_user, result), chunk_size):
+            usernames = [user["username"] for _line, user in chunk]
+            emails = [user["email"] for _line, user in chunk if user["email"]]
+            taken_usernames = {name for (name,) in db.session.query(User.username).filter(User.username.in_(usernames))}
+            taken_emails = {email for (email,) in db.session.query(User.email).filter(User.email.in_(emails))}
+
+            users = []
+            for line, user in chunk:
+                if user["username"] in taken_usernames or user["username"] in seen_usernames:
+                    result.reject(line, f'username "{user["username"]}" already exists')
+                    continue
+                if user["email"] and (user["email"] in taken_emails or user["email"] in seen_emails):
+                    result.reject(line, f'email "{user["email"]}" already exists')
+                    continue
+                seen_usernames.add(user["username"])
+                if user["email"]:
+                    seen_emails.add(user["email"])
+                users.append(user)
+            if not users:
+                continue
+
+            to_hash = [user for user in users if not user["password_hash"]]
+            passwords = [user["password"] for user in to_hash]
+            hashes = pool.map(generate_password_hash, passwords, chunksize=64) if pool else map(generate_password_hash, passwords)
+            for user, password_hash in zip(to_hash, hashes):
+                user["password_hash"] = password_hash
+
+            db.session.execute(insert(User), [
+                {key: user[key] for key in ('username', 'name', 'email', 'is_admin', 'password_hash')}
+                for user in users
+            ])
+            db.session.commit()
+            result.inserted += len(users)
+    finally:
+        if pool:
+            pool.shutdown()
+    return result
+
+
+# Historical reservations
+
+def _validate_reservation(row):
+    parking_timestamp = _timestamp(row, 'parking_timestamp')
+    leaving_timestamp = _timestamp(row, 'leaving_timestamp')
+    if leaving_timestamp < parking_timestamp:
+        raise ValueError('leaving_timestamp is before parking_timestamp')
+    cost = row.get('parking_cost')
+    try:
+        cost = float(cost) if cost not in (None, '') else None
+    except ValueError:
+        raise ValueError('parking_cost must be a number')
+    return {
+        "username": _required(row, 'username'),
+        "lot": _required(row, 'lot'),
+        "spot_number": _positive(row, 'spot_number', int),
+        "vechile_number": (row.get('vehicle_number') or '').strip() or None,
+        "parking_timestamp": parking_timestamp,
+        "leaving_timestamp": leaving_timestamp,
+        "parking_cost": cost,
+    }
+
+
+def import_reservations(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Loads completed reservations; `lot` is the lot's prime_location_name.
+
+    A missing parking_cost is worked out with the lot's tariff by
+    billing.price, as release_spot does, one vectorised call per chunk.
+    """
+    result = ImportResult()
+    earliest = None
+    lots = {}  # lot name -> (lot id, {spot_number: spot_id}), loaded on first use
+
+    def lot_spots(name):
+        if name not in lots:
+            lot = ParkingLot.query.filter_by(prime_location_name=name).first()
+            lots[name] = None
+            if lot:
+                with shards.use(shards.for_lot(lot.id)):
+                    lots[name] = (lot.id, dict(db.session.query(ParkingSpot.spot_number, ParkingSpot.id)
+                                                  .filter_by(lot_id=lot.id)))
+        return lots[name]
+
+    for chunk in _chunks(_validated(read_rows(path), _validate_reservation, result), chunk_size):
+        user_ids = dict(db.session.query(User.username, User.id)
+                        .filter(User.username.in_({r["username"] for _line, r in chunk})))
+        reservations, unpriced = [], []  # unpriced: (row, lot id) still needing a parking_cost
+        for line, reservation in chunk:
+            user_id = user_ids.get(reservation["username"])
+            lot = lot_spots(reservation["lot"])
+            spot_id = lot and lot[1].get(reservation["spot_number"])
+            if user_id is None:
+                result.reject(line, f'unknown user "{reservation["username"]}"')
+                continue
+            if spot_id is None:
+                result.reject(line, f'unknown spot {reservation["spot_number"]} in lot "{reservation["lot"]}"')
+                continue
+            row = {
+                "user_id": user_id,
+                "spot_id": spot_id,
+                "vechile_number": reservation["vechile_number"],
+                "parking_timestamp": reservation["parking_timestamp"],
+                "leaving_timestamp": reservation["leaving_timestamp"],
+                "parking_cost": reservation["parking_cost"],
+            }
+            reservations.append(row)
+            if row["parking_cost"] is None:
+                unpriced.append((row, lot[0]))
+        if unpriced:
+            costs = billing.price([row["parking_timestamp"] for row, _lot_id in unpriced],
+                                  [row["leaving_timestamp"] for row, _lot_id in unpriced],
+                                  **billing.lot_parameters([lot_id for _row, lot_id in unpriced]))
+            for (row, _lot_id), cost in zip(unpriced, costs.tolist()):
+                row["parking_cost"] = cost
+        if reservations:
+            by_shard = {}
+            for reservation in reservations:
+                by_shard.setdefault(shards.for_id(reservation["spot_id"]), []).append(reservation)
+            for name, rows in by_shard.items():
+                with shards.use(name):
+                    db.session.execute(insert(Reservation), rows)
+            db.session.commit()
+            result.inserted += len(reservations)
+            first = min(r["parking_timestamp"] for r in reservations)
+            earliest = first if earliest is None else min(earliest, first)
+
+    if reports.summary_table_enabled():
+        reports.refresh_lot_summaries()
+    if earliest is not None and analytics.rollups_enabled():
+        analytics.backfill(since=earliest)
+    return result
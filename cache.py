@@ -0,0 +1,113 @@
+"""Small in-process TTL + LRU caches.
+
+Used for lot search results and the admin/user summary chart data. Entries
+expire after ``CACHE_TTL`` seconds and the least recently used entry is
+evicted once a cache holds ``CACHE_MAX_ENTRIES``. Writes invalidate the
+affected entries explicitly; the TTL only bounds how stale another worker
+process's copy can get. A value is computed outside the lock, so an
+invalidation can land while it is being computed; the value is then
+returned to its caller but not stored.
+
+Per-lot availability counts are not cached here: they already come from
+the in-memory free-spot index in O(1).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+
+    def __init__(self, name, maxsize=1024, ttl=60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._computing = {}           # key -> number of get_or_set calls computing it right now
+        self._generations = {}         # key -> invalidations while it was being computed
+        self._epoch = 0                # bumped by clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def get_or_set(self, key, compute):
+        """Returns the cached value for key, calling compute() to fill it on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            self._computing[key] = self._computing.get(key, 0) + 1
+            started = (self._epoch, self._generations.get(key, 0))
+
+        stored = False
+        try:
+            value = compute()
+            stored = True
+        finally:
+            with self._lock:
+                # Stored only if nothing invalidated the key while it was being computed.
+                if stored and started == (self._epoch, self._generations.get(key, 0)):
+                    self._entries[key] = (now + self.ttl, value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+                self._computing[key] -= 1
+                if not self._computing[key]:
+                    del self._computing[key]
+                    self._generations.pop(key, None)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._computing:
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+ADMIN_SUMMARY_KEY = 'admin'
+
+lot_search = TTLCache('lot_search')
+summaries = TTLCache('summaries')
+all_caches = (lot_search, summaries)
+
+
+def init_app(app):
+    for cache in all_caches:
+        cache.maxsize = app.config['CACHE_MAX_ENTRIES']
+        cache.ttl = app.config['CACHE_TTL']
+
+
+def user_summary_key(user_id):
+    return f'user:{user_id}'
+
+
+def invalidate_bookings(user_id):
+    """A booking or release changes occupancy, revenue and the user's monthly counts."""
+    summaries.invalidate(ADMIN_SUMMARY_KEY)
+    summaries.invalidate(user_summary_key(user_id))
+
+
+def invalidate_lots():
+    """Lot names, prices and spot counts changed: drop search results and the admin summary."""
+    lot_search.clear()
+    summaries.invalidate(ADMIN_SUMMARY_KEY)
@@ -0,0 +1,128 @@
+import time
+
+import click
+
+from models import init_db
+import analytics
+import billing
+import bulk_import
+import reports
+import sweeper
+import write_behind
+
+
+@click.command('init-db')
+@click.option('--admin-password', default='admin', show_default=True,
+              help='Password for the default admin, if one has to be created.')
+def init_db_command(admin_password):
+    """Creates tables and indexes and seeds the default admin user."""
+    admin = init_db(admin_password)
+    click.echo('Database tables created successfully.')
+    if admin:
+        click.echo('No admin user found. Created a default admin user.')
+    if reports.summary_table_enabled():
+        reports.refresh_lot_summaries()
+        click.echo('Lot summaries rebuilt.')
+
+
+@click.group('import')
+def import_group():
+    """Bulk-loads lots, users and historical reservations from CSV or JSON."""
+
+
+def _report(result):
+    for line, reason in result.rejected[:50]:
+        click.echo(f'  line {line}: {reason}', err=True)
+    if len(result.rejected) > 50:
+        click.echo(f'  ... and {len(result.rejected) - 50} more rejected rows', err=True)
+    click.echo(result.summary())
+
+
+_path = click.argument('path', type=click.Path(exists=True, dir_okay=False))
+_chunk_size = click.option('--chunk-size', default=bulk_import.DEFAULT_CHUNK_SIZE, show_default=True,
+                           help='Rows inserted per transaction.')
+
+
+@import_group.command('lots')
+@_path
+@_chunk_size
+def import_lots_command(path, chunk_size):
+    """Columns: prime_location_name, address, pin_code, price, maximum_number_of_spots."""
+    _report(bulk_import.import_lots(path, chunk_size))
+
+
+@import_group.command('users')
+@_path
+@_chunk_size
+@click.option('--workers', type=int, default=None,
+              help='Processes used to hash passwords (default: one per CPU; 1 hashes inline).')
+def import_users_command(path, chunk_size, workers):
+    """Columns: username, password or password_hash, and optional name, email, is_admin."""
+    _report(bulk_import.import_users(path, chunk_size, workers))
+
+
+@import_group.command('reservations')
+@_path
+@_chunk_size
+def import_reservations_command(path, chunk_size):
+    """Columns: username, lot, spot_number, parking_timestamp, leaving_timestamp,
+    and optional vehicle_number, parking_cost."""
+    _report(bulk_import.import_reservations(path, chunk_size))
+
+
+@click.group('billing')
+def billing_group():
+    """Audits and re-prices reservation history under the current tariffs."""
+
+
+@billing_group.command('reprice')
+@click.option('--lot-id', type=int, default=None, help='Only reservations in this lot.')
+@click.option('--since', type=click.DateTime(), default=None, help='Only reservations parked at or after this time.')
+@click.option('--until', type=click.DateTime(), default=None, help='Only reservations parked before this time.')
+@click.option('--apply', is_flag=True, help='Write the new costs back; without it nothing is changed.')
+def reprice_command(lot_id, since, until, apply):
+    """Recomputes the cost of completed reservations and reports the difference."""
+    result = billing.reprice(lot_id, since, until, apply)
+    click.echo(result.summary())
+    if result.changed.any():
+        click.echo('Costs updated.' if apply else 'Dry run; pass --apply to update the stored costs.')
+
+
+@click.group('analytics')
+def analytics_group():
+    """Maintains the hourly and daily occupancy rollups."""
+
+
+@analytics_group.command('backfill')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='Only rebuild buckets from this day on; by default everything is rebuilt.')
+def backfill_command(since):
+    """Rebuilds the rollups from the reservations table."""
+    start = time.perf_counter()
+    count = analytics.backfill(since)
+    click.echo(f'Rollups rebuilt from {count} reservations in {time.perf_counter() - start:.1f}s.')
+
+
+@click.command('sweep')
+def sweep_command():
+    """Runs one overstay sweep now, e.g. from cron when SWEEP_INTERVAL is empty."""
+    counts = sweeper.sweep()
+    click.echo(f'Released {counts["released"]}, flagged {counts["flagged"]} overstayed reservations; '
+               f'expired {counts["expired_bookings"]} bookings in {sweeper.stats.last_duration:.2f}s.')
+
+
+@click.command('replay-log')
+def replay_log_command():
+    """Applies the write-behind event log to the database, e.g. before a backup. Stop the web worker first."""
+    if not write_behind.enabled():
+        raise click.ClickException('WRITE_BEHIND_LOG is not set.')
+    click.echo(f'Write-behind log applied up to event {write_behind.replay()}.')
+
+
+def init_app(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(import_group)
+    app.cli.add_command(billing_group)
+    app.cli.add_command(analytics_group)
+    app.cli.add_command(sweep_command)
+    app.cli.add_command(replay_log_command)
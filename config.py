@@ -1,8 +1,108 @@
 from dotenv import load_dotenv
 import os
-from app import app
-load_dotenv()
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('sqlalchemy_database_uri')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('sqlalchemy_track_modifications')
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['DEBUG'] = os.getenv('FLASK_DEBUG') == 'True'
\ No newline at end of file
+
+
+def _engine_options(uri):
+    # Connection pool. pool_size/max_overflow only apply to pooled backends, so they are opt-in.
+    engine_options = {
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'True') == 'True',
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+    if os.getenv('DB_POOL_SIZE'):
+        engine_options['pool_size'] = int(os.getenv('DB_POOL_SIZE'))
+        engine_options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    if (uri or '').startswith('sqlite'):
+        # Writers wait for the lock instead of failing straight away with "database is locked".
+        engine_options['connect_args'] = {'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')) / 1000}
+    return engine_options
+
+
+def _lot_shards(value):
+    """Parses LOT_SHARDS, e.g. "north=sqlite:///north.db,south=sqlite:///south.db", into (name, uri) pairs."""
+    shards = []
+    for item in filter(None, (item.strip() for item in (value or '').split(','))):
+        name, _, uri = item.partition('=')
+        if not name.strip() or not uri.strip():
+            raise ValueError(f'LOT_SHARDS entries must look like name=database_uri, got "{item}"')
+        shards.append((name.strip(), uri.strip()))
+    if len({name for name, _uri in shards}) != len(shards):
+        raise ValueError('LOT_SHARDS names must be unique')
+    return shards
+
+
+def init_app(app):
+    load_dotenv()
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('sqlalchemy_database_uri')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('sqlalchemy_track_modifications')
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['DEBUG'] = os.getenv('FLASK_DEBUG') == 'True'
+    app.config['SUMMARY_TABLE'] = os.getenv('SUMMARY_TABLE') == 'True'
+    app.config['ANALYTICS_ROLLUPS'] = os.getenv('ANALYTICS_ROLLUPS', 'True') == 'True'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # Lot shards (shards.py): name=uri pairs, each a database for the spots and reservations of its lots.
+    # Empty keeps everything in the one database. Only append new shards: a shard's position fixes its id range.
+    lot_shards = _lot_shards(os.getenv('LOT_SHARDS'))
+    app.config['LOT_SHARDS'] = [name for name, _uri in lot_shards]
+    app.config['SQLALCHEMY_BINDS'] = {f'shard:{name}': {'url': uri, **_engine_options(uri)} for name, uri in lot_shards}
+
+    # Seconds before a worker reloads a lot's entry in its in-memory free-spot index; empty disables reloads.
+    max_age = os.getenv('FREE_SPOT_INDEX_MAX_AGE', '5')
+    app.config['FREE_SPOT_INDEX_MAX_AGE'] = float(max_age) if max_age else None
+
+    # Same, for the advance-booking interval index (bookings.py).
+    booking_max_age = os.getenv('BOOKING_INDEX_MAX_AGE', '5')
+    app.config['BOOKING_INDEX_MAX_AGE'] = float(booking_max_age) if booking_max_age else None
+    # Hours a walk-in is expected to stay: they are not given spots booked ahead within that time. Empty disables.
+    walk_in_stay = os.getenv('WALK_IN_STAY_HOURS', '3')
+    app.config['WALK_IN_STAY_HOURS'] = float(walk_in_stay) if walk_in_stay else None
+
+    # Overstay sweeper (sweeper.py). An empty limit disables overstay handling, an empty interval the thread.
+    overstay_limit = os.getenv('OVERSTAY_LIMIT_HOURS', '24')
+    app.config['OVERSTAY_LIMIT_HOURS'] = float(overstay_limit) if overstay_limit else None
+    # 'flag' only lists overstays for an admin. Set OVERSTAY_ACTION=release to have the sweeper release them
+    # and charge them by the lot's tariff; any other value flags.
+    app.config['OVERSTAY_ACTION'] = os.getenv('OVERSTAY_ACTION', 'flag')
+    sweep_interval = os.getenv('SWEEP_INTERVAL', '60')
+    app.config['SWEEP_INTERVAL'] = float(sweep_interval) if sweep_interval else None
+    app.config['SWEEP_BATCH_SIZE'] = int(os.getenv('SWEEP_BATCH_SIZE', '200'))
+
+    app.config['CACHE_TTL'] = float(os.getenv('CACHE_TTL', '30'))
+    app.config['CACHE_MAX_ENTRIES'] = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+
+    # Seconds before a worker rebuilds its in-memory search indexes, which is how long a lot or user added
+    # through another worker can be missing from its searches; empty disables rebuilds.
+    search_max_age = os.getenv('SEARCH_INDEX_MAX_AGE', '5')
+    app.config['SEARCH_INDEX_MAX_AGE'] = float(search_max_age) if search_max_age else None
+
+    # Live availability stream: updates are coalesced per interval, other workers' changes polled.
+    app.config['SSE_COALESCE_INTERVAL'] = float(os.getenv('SSE_COALESCE_INTERVAL', '1'))
+    app.config['SSE_POLL_INTERVAL'] = float(os.getenv('SSE_POLL_INTERVAL', '5'))
+    app.config['SSE_HEARTBEAT'] = float(os.getenv('SSE_HEARTBEAT', '15'))
+    app.config['SSE_MAX_SUBSCRIBERS'] = int(os.getenv('SSE_MAX_SUBSCRIBERS', '1000'))
+    # True when a separate gevent server answers /events/availability (gunicorn.conf.py), so pages served
+    # by workers that cannot hold streams still open them.
+    app.config['SSE_STREAMS'] = os.getenv('SSE_STREAMS') == 'True'
+
+    # Password checks (auth.py): hashing threads per process (0 hashes inline), checks allowed to wait,
+    # and the failed-login token bucket per username (an empty burst disables it).
+    app.config['AUTH_HASH_WORKERS'] = int(os.getenv('AUTH_HASH_WORKERS', '2'))
+    app.config['AUTH_HASH_MAX_PENDING'] = int(os.getenv('AUTH_HASH_MAX_PENDING', '32'))
+    failure_burst = os.getenv('LOGIN_FAILURE_BURST', '5')
+    app.config['LOGIN_FAILURE_BURST'] = int(failure_burst) if failure_burst else None
+    app.config['LOGIN_FAILURE_REFILL_SECONDS'] = float(os.getenv('LOGIN_FAILURE_REFILL_SECONDS', '60'))
+
+    # Request profiling (instrumentation.py): Server-Timing/X-Query-Count headers on every response,
+    # and a bearer token /metrics requires when set.
+    app.config['PROFILE_HEADERS'] = os.getenv('PROFILE_HEADERS') == 'True'
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN') or None
+
+    # Write-behind bookings (write_behind.py): a path for the event log turns them on. The log is owned by one
+    # process, so run a single worker (WEB_WORKERS=1, any number of threads). The writer commits up to
+    # WRITE_BEHIND_BATCH_SIZE events at a time, gathering for WRITE_BEHIND_INTERVAL seconds first; with
+    # WRITE_BEHIND_FSYNC=False the log is only flushed to the OS, which survives a crash but not a power cut.
+    app.config['WRITE_BEHIND_LOG'] = os.getenv('WRITE_BEHIND_LOG') or None
+    app.config['WRITE_BEHIND_BATCH_SIZE'] = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '500'))
+    app.config['WRITE_BEHIND_INTERVAL'] = float(os.getenv('WRITE_BEHIND_INTERVAL', '0.05'))
+    app.config['WRITE_BEHIND_FSYNC'] = os.getenv('WRITE_BEHIND_FSYNC', 'True') == 'True'
+    app.config['WRITE_BEHIND_SEGMENT_BYTES'] = int(os.getenv('WRITE_BEHIND_SEGMENT_BYTES', str(64 * 1024 * 1024)))
\ No newline at end of file
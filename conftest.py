@@ -0,0 +1,79 @@
+"""Shared pytest fixtures: one app on a throwaway SQLite database, and logged-in clients.
+
+The free-spot, booking and search indexes and the caches are per process,
+so the whole session shares one database rather than a fresh one per test.
+"""
+import os
+
+import pytest
+
+pytest_plugins = ['pytest_query_budget']
+collect_ignore = ['benchmarks']  # scripts, not tests (load_test.py matches *_test.py)
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    os.environ['sqlalchemy_database_uri'] = f'sqlite:///{tmp_path_factory.mktemp("db") / "test.db"}'
+    os.environ['SECRET_KEY'] = 'test'
+    for name in ('SWEEP_INTERVAL', 'LOT_SHARDS', 'WRITE_BEHIND_LOG', 'METRICS_TOKEN'):
+        os.environ[name] = ''
+
+    from app import create_app
+    from models import init_db
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        init_db()
+    return app
+
+
+@pytest.fixture(scope='session')
+def admin_client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    for number in range(1, 4):
+        client.post('/admin/parking_lot/add', data={
+            'prime_location_name': f'Lot {number}', 'address': f'{number} Main Road', 'pin_code': f'56000{number}',
+            'price': '10', 'maximum_number_of_spots': '5'})
+    return client
+
+
+@pytest.fixture(scope='session')
+def add_lot(app, admin_client):
+    """Adds a lot through the admin page: add_lot(name, spots) returns its id."""
+    from models import db, ParkingLot
+
+    def add(name, spots):
+        admin_client.post('/admin/parking_lot/add', data={
+            'prime_location_name': name, 'address': f'{name} Road', 'pin_code': '560099',
+            'price': '10', 'maximum_number_of_spots': str(spots)})
+        with app.app_context():
+            return db.session.query(ParkingLot.id).filter_by(prime_location_name=name).scalar()
+    return add
+
+
+@pytest.fixture(scope='session')
+def add_user(app):
+    """Registers a user: add_user(username) returns (logged-in client, user id)."""
+    from models import db, User
+
+    def add(username):
+        client = app.test_client()
+        client.post('/register', data={'name': username, 'email': f'{username}@example.com', 'username': username,
+                                       'password': 'secret1', 'confirm_password': 'secret1'})
+        client.post('/login', data={'username': username, 'password': 'secret1'})
+        with app.app_context():
+            return client, db.session.query(User.id).filter_by(username=username).scalar()
+    return add
+
+
+@pytest.fixture(scope='session')
+def user_client(app, admin_client):
+    client = app.test_client()
+    client.post('/register', data={'name': 'Test User', 'email': 'user@example.com', 'username': 'user1',
+                                   'password': 'secret1', 'confirm_password': 'secret1'})
+    client.post('/login', data={'username': 'user1', 'password': 'secret1'})
+    for lot_id in (1, 2, 3):
+        client.post(f'/book/lot/{lot_id}', data={'vehicle_number': f'KA01-{lot_id}'})
+    client.post('/release/1')
+    return client
@@ -0,0 +1,41 @@
+"""Gunicorn settings for wsgi:app. Every value can be overridden from the environment."""
+import multiprocessing
+import os
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:8000')
+# Write-behind bookings (write_behind.py) keep spot state in one process, so they default to one worker.
+workers = int(os.getenv('WEB_WORKERS', 1 if os.getenv('WRITE_BEHIND_LOG') else multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', '4'))
+# gthread workers do not serve availability streams (availability.py): a stream would hold a worker thread
+# for its lifetime. gevent serves each stream as a greenlet, but only if the database driver is gevent-safe
+# (sqlite3 is not, nor is psycopg2 without psycogreen): otherwise every query and every busy wait blocks
+# the whole worker, and WEB_THREADS and the shard fan-out no longer run in parallel. To offer streams with
+# sqlite, run a second server for them only, e.g. WEB_WORKER_CLASS=gevent WEB_BIND=0.0.0.0:8001, route
+# /events/availability to it at the proxy, and set SSE_STREAMS=True for the pages.
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', '2000'))
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+
+# Build the app once in the master and fork workers from it, so each worker
+# starts serving without re-importing anything. Schema creation and admin
+# seeding are not part of startup; run `flask init-db` before deploying.
+# gevent has to patch the standard library before the app is imported, so
+# it loads the app in each worker instead.
+preload_app = worker_class != 'gevent'
+
+
+def post_fork(server, worker):
+    # Connections opened by the master during preload must not be shared with forked workers.
+    if not server.cfg.preload_app:
+        return
+    from wsgi import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():  # the default database and every lot shard
+            engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # Replay the write-behind log as the worker boots, not when the first booking arrives.
+    import write_behind
+    write_behind.start(worker.wsgi)
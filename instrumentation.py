@@ -0,0 +1,294 @@
+"""Request profiling and SQL instrumentation.
+
+SQLAlchemy cursor events time every statement. Flask request hooks and
+the template signals time each request and its template rendering. For
+every request this records the query count, total SQL time, template
+time, handler time and the slowest statements. The totals are aggregated
+per endpoint and served in the Prometheus text format at ``/metrics``.
+
+With ``PROFILE_HEADERS`` on, each response also carries a
+``Server-Timing`` header (browser dev tools show it in the network panel)
+and ``X-Query-Count``.
+
+Tests can check a route's query budget with ``count_queries()``, or with
+the ``query_budget`` fixture in pytest_query_budget.py.
+
+Metrics are kept per worker process, like the caches and sweeper counters.
+Scrape each worker, or run a single worker when an exact total matters.
+"""
+import bisect
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SLOWEST_PER_REQUEST = 3
+MAX_TRACKED_STATEMENTS = 500
+STATEMENT_PREVIEW_LENGTH = 300
+
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|:\w+|\$\d+')
+_EXPANDED_LIST = re.compile(r'\(\?(?:, \?)+\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_statement(statement):
+    """One line per statement shape: placeholders unified and expanded IN lists collapsed."""
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    statement = _EXPANDED_LIST.sub('(?...)', _PLACEHOLDER.sub('?', statement))
+    return statement[:STATEMENT_PREVIEW_LENGTH]
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestProfile:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_started = None
+        self.slowest = []  # [(seconds, statement)], slowest first
+
+    def add_query(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if len(self.slowest) < SLOWEST_PER_REQUEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOWEST_PER_REQUEST:]
+
+
+class QueryCounter:
+    """What count_queries() saw: the number of statements, their text and total time."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self.durations = []
+
+    def add_query(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+        self.durations.append(seconds)
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, method, status) -> count
+        self.durations = defaultdict(lambda: Histogram(REQUEST_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.statements = {}  # normalized statement -> [count, total seconds, max seconds]
+
+    def observe_request(self, endpoint, method, status, profile, seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.durations[endpoint].observe(seconds)
+            self.queries[endpoint].observe(profile.queries)
+            self.sql_seconds[endpoint] += profile.sql_seconds
+            self.template_seconds[endpoint] += profile.template_seconds
+
+    def observe_statement(self, statement, seconds):
+        with self._lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                if len(self.statements) >= MAX_TRACKED_STATEMENTS:
+                    return
+                entry = self.statements[statement] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def slowest_statements(self, limit=20):
+        """The statements with the most total time, for /admin/profile."""
+        with self._lock:
+            rows = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [{"statement": statement, "count": count, "total_seconds": total, "max_seconds": slowest}
+                for statement, (count, total, slowest) in rows]
+
+    def endpoint_stats(self):
+        with self._lock:
+            return {endpoint: {
+                "requests": histogram.count,
+                "mean_seconds": histogram.sum / histogram.count,
+                "mean_queries": self.queries[endpoint].sum / histogram.count,
+                "mean_sql_seconds": self.sql_seconds[endpoint] / histogram.count,
+                "mean_template_seconds": self.template_seconds[endpoint] / histogram.count,
+            } for endpoint, histogram in self.durations.items() if histogram.count}
+
+    def render(self, extra=()):
+        """Prometheus text exposition. extra is more (name, type, help, [(labels, value)]) families."""
+        with self._lock:
+            lines = _family('http_requests_total', 'counter', 'Requests handled, by endpoint, method and status.',
+                            [({"endpoint": e, "method": m, "status": s}, n)
+                             for (e, m, s), n in sorted(self.requests.items())])
+            lines += _histogram('http_request_duration_seconds', 'Handler time per request.', self.durations)
+            lines += _histogram('db_queries_per_request', 'SQL statements executed per request.', self.queries)
+            lines += _family('db_query_seconds_total', 'counter', 'Time spent in SQL, by endpoint.',
+                             [({"endpoint": e}, v) for e, v in sorted(self.sql_seconds.items())])
+            lines += _family('template_render_seconds_total', 'counter', 'Time spent rendering templates, by endpoint.',
+                             [({"endpoint": e}, v) for e, v in sorted(self.template_seconds.items())])
+        for family in extra:
+            lines += _family(*family)
+        return '\n'.join(lines) + '\n'
+
+
+def _family(name, kind, help_text, samples):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    lines += [f'{name}{_labels(labels)} {_number(value)}' for labels, value in samples]
+    return lines
+
+
+def _histogram(name, help_text, histograms):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for endpoint, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels({"endpoint": endpoint, "le": bound})} {cumulative}')
+        lines.append(f'{name}_sum{_labels({"endpoint": endpoint})} {_number(histogram.sum)}')
+        lines.append(f'{name}_count{_labels({"endpoint": endpoint})} {histogram.count}')
+    return lines
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+metrics = Metrics()
+
+_counters = threading.local()
+
+
+@contextmanager
+def count_queries():
+    """Counts the statements this thread executes inside the block, including Flask test client requests."""
+    counter = QueryCounter()
+    active = getattr(_counters, 'active', None)
+    if active is None:
+        active = _counters.active = []
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+
+
+def add_counted(counter):
+    """Attributes statements another thread counted (e.g. a shard fan-out) to this thread's request and counters."""
+    for statement, seconds in zip(counter.statements, counter.durations):
+        _attribute(statement, seconds)
+
+
+def _attribute(statement, seconds):
+    if has_request_context():
+        profile = g.get('profile')
+        if profile is not None:
+            profile.add_query(statement, seconds)
+    for counter in getattr(_counters, 'active', ()):
+        counter.add_query(statement, seconds)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    statement = normalize_statement(statement)
+    metrics.observe_statement(statement, seconds)
+    _attribute(statement, seconds)
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time.
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def _template_started(sender, template, context, **extra):
+    profile = g.get('profile')
+    if profile is not None:
+        profile.template_started = time.perf_counter()
+
+
+def _template_finished(sender, template, context, **extra):
+    profile = g.get('profile')
+    if profile is not None and profile.template_started is not None:
+        profile.template_seconds += time.perf_counter() - profile.template_started
+        profile.template_started = None
+
+
+def _server_timing(profile, seconds):
+    return ', '.join((
+        f'db;dur={profile.sql_seconds * 1000:.1f};desc="{profile.queries} queries"',
+        f'tpl;dur={profile.template_seconds * 1000:.1f}',
+        f'app;dur={seconds * 1000:.1f}',
+    ))
+
+
+def init_app(app):
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    @app.before_request
+    def start_profile():
+        g.profile = RequestProfile()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        seconds = time.perf_counter() - profile.started
+        metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                                profile, seconds)
+        if app.config['PROFILE_HEADERS']:
+            response.headers['Server-Timing'] = _server_timing(profile, seconds)
+            response.headers['X-Query-Count'] = str(profile.queries)
+            if profile.slowest:
+                response.headers['X-Slowest-Query'] = f'{profile.slowest[0][0] * 1000:.1f}ms {profile.slowest[0][1][:200]}'
+        return response
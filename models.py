@@ -1,10 +1,70 @@
+import sqlite3
+from contextvars import ContextVar
 from datetime import datetime
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from app import app
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import declared_attr
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.util import find_tables
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
-db=SQLAlchemy(app)
+# Lot sharding (see shards.py). Spots and everything hanging off them live in
+# the lot's shard; users, lots and tariffs stay in the default database.
+SHARD_BIND_PREFIX = 'shard:'
+SHARDED_TABLES = frozenset({
+    'parking_spots', 'reservations', 'advance_bookings', 'overstay_flags',
+    'lot_summaries', 'hourly_rollups', 'daily_rollups', 'write_behind_checkpoints',
+})
+# Shard n allocates spot, reservation and booking ids from n * SHARD_ID_SPAN + 1,
+# so an id alone tells which shard holds the row and ids stay unique across shards.
+SHARD_ID_SPAN = 100_000_000
+SHARD_ID_TABLES = ('parking_spots', 'reservations', 'advance_bookings')
+
+current_shard = ContextVar('current_shard', default=None)
+
+
+class ShardedSession(Session):
+    """Sends statements on sharded tables to the engine of ``current_shard``.
+
+    With no current shard they go to the default database, as does
+    everything else.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = current_shard.get()
+        if bind is None and shard is not None and _is_sharded(mapper, clause):
+            try:
+                return self._db.engines[SHARD_BIND_PREFIX + shard]
+            except KeyError:
+                raise sa.exc.UnboundExecutionError(f'Unknown shard "{shard}"; check LOT_SHARDS.') from None
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_sharded(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in SHARDED_TABLES
+    if clause is not None:
+        return any(table.name in SHARDED_TABLES for table in find_tables(clause, include_crud=True))
+    return False
+
+
+db=SQLAlchemy(session_options={'class_': ShardedSession})
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the booking writer. The busy timeout is set through connect_args."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
 
 
 
@@ -34,6 +94,8 @@ class User(db.Model):
 
 class ParkingLot(db.Model):
     __tablename__ = 'parking_lots'
+    # Never reuse a deleted lot's id: workers cache which shard a lot id lives in.
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = db.Column(db.Integer, primary_key=True)
     prime_location_name = db.Column(db.String(100), unique=True, nullable=False)
@@ -44,6 +106,8 @@ class ParkingLot(db.Model):
     
 
     spots = db.relationship('ParkingSpot', backref='parking_lot', lazy=True, cascade="all, delete-orphan")
+    tariff = db.relationship('Tariff', uselist=False, lazy=True, cascade="all, delete-orphan")
+    lot_shard = db.relationship('LotShard', uselist=False, lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<ParkingLot {self.prime_location_name}>'
@@ -58,8 +122,14 @@ class ParkingSpot(db.Model):
     spot_number = db.Column(db.Integer, nullable=False) 
 
     
-    __table_args__ = (db.UniqueConstraint('lot_id', 'spot_number', name='_lot_spot_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('lot_id', 'spot_number', name='_lot_spot_uc'),
+        # Free-spot lookups: filter by lot and status, pick the lowest spot number.
+        db.Index('ix_parking_spots_lot_status', 'lot_id', 'status', 'spot_number'),
+        {'sqlite_autoincrement': True},
+    )
     reservations = db.relationship('Reservation', backref='parking_spot', lazy=True,cascade="all, delete-orphan")
+    advance_bookings = db.relationship('AdvanceBooking', backref='parking_spot', lazy=True, cascade="all, delete-orphan")
 
 
     def __repr__(self):
@@ -77,29 +147,232 @@ class Reservation(db.Model):
     leaving_timestamp = db.Column(db.DateTime, nullable=True) 
     parking_cost = db.Column(db.Float, nullable=True) 
     vechile_number = db.Column(db.String(20), nullable=True)
+
+    __table_args__ = (
+        # A user's history, newest first.
+        db.Index('ix_reservations_user_parked', 'user_id', 'parking_timestamp'),
+        # Date-range exports and reports.
+        db.Index('ix_reservations_parked', 'parking_timestamp'),
+        # Revenue joins, cascades from parking_spots, and a spot's active reservation.
+        db.Index('ix_reservations_spot', 'spot_id'),
+        # Oldest active reservations first, for the overstay sweeper.
+        db.Index('ix_reservations_active_parked', 'parking_timestamp',
+                 sqlite_where=db.text('leaving_timestamp IS NULL'),
+                 postgresql_where=db.text('leaving_timestamp IS NULL')),
+        {'sqlite_autoincrement': True},
+    )
     
 
     def __repr__(self):
         return f'<Reservation {self.id} for User {self.user_id} on Spot {self.spot_id}>'
     
 
-with app.app_context():
+class AdvanceBooking(db.Model):
+    """A spot booked ahead for [start_time, end_time); see bookings.py.
+
+    status: 'B' booked, 'U' checked in (reservation_id is set; end_time is
+    cut to the release time if the reservation ends early), 'C' cancelled,
+    'E' expired without a check-in.
+    """
+    __tablename__ = 'advance_bookings'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    spot_id = db.Column(db.Integer, db.ForeignKey('parking_spots.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    vehicle_number = db.Column(db.String(20), nullable=True)
+    status = db.Column(db.String(1), default='B', nullable=False)
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservations.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    user = db.relationship('User', backref=db.backref('advance_bookings', lazy=True))
+
+    __table_args__ = (
+        # Overlap checks on one spot: ranging on end_time skips the spot's past bookings.
+        db.Index('ix_advance_bookings_spot_window', 'spot_id', 'end_time', 'start_time'),
+        # A user's upcoming bookings.
+        db.Index('ix_advance_bookings_user', 'user_id', 'start_time'),
+        # No-shows whose window has passed, for the sweeper.
+        db.Index('ix_advance_bookings_status_end', 'status', 'end_time'),
+        # The booking checked in as a reservation, ended when the reservation is released.
+        db.Index('ix_advance_bookings_reservation', 'reservation_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return f'<AdvanceBooking {self.id}: spot {self.spot_id} {self.start_time} - {self.end_time}>'
+
+
+class OverstayFlag(db.Model):
+    """An active reservation the sweeper found past OVERSTAY_LIMIT_HOURS (with OVERSTAY_ACTION=flag)."""
+    __tablename__ = 'overstay_flags'
+
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservations.id'), primary_key=True)
+    flagged_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    reservation = db.relationship('Reservation', backref=db.backref('overstay_flag', uselist=False,
+                                                                    cascade="all, delete-orphan"))
+
+    def __repr__(self):
+        return f'<OverstayFlag {self.reservation_id}>'
+
+
+class LotSummary(db.Model):
+    """Materialized per-lot occupancy and revenue, maintained incrementally by reports.py."""
+    __tablename__ = 'lot_summaries'
+
+    lot_id = db.Column(db.Integer, db.ForeignKey('parking_lots.id'), primary_key=True)
+    occupied = db.Column(db.Integer, default=0, nullable=False)
+    available = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+
+    def __repr__(self):
+        return f'<LotSummary {self.lot_id}: {self.occupied} occupied, {self.available} available>'
+
+
+class LotShard(db.Model):
+    """The shard holding a lot's spots and reservations. Lots without a row live in the default database."""
+    __tablename__ = 'lot_shards'
+
+    lot_id = db.Column(db.Integer, db.ForeignKey('parking_lots.id'), primary_key=True)
+    shard = db.Column(db.String(50), nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<LotShard {self.lot_id}: {self.shard}>'
+
+
+class WriteBehindCheckpoint(db.Model):
+    """The last write-behind event (see write_behind.py) applied to this database. One row, id 1, per shard."""
+    __tablename__ = 'write_behind_checkpoints'
+
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<WriteBehindCheckpoint {self.seq}>'
+
+
+class Tariff(db.Model):
+    """Optional pricing rules on top of a lot's hourly price; see billing.py.
+
+    Night hours are in the same clock as the stored timestamps (UTC).
+    """
+    __tablename__ = 'tariffs'
+
+    lot_id = db.Column(db.Integer, db.ForeignKey('parking_lots.id'), primary_key=True)
+    minimum_charge = db.Column(db.Float, nullable=True)
+    daily_cap = db.Column(db.Float, nullable=True)
+    night_price = db.Column(db.Float, nullable=True)
+    night_start_hour = db.Column(db.Integer, default=22, nullable=False)
+    night_end_hour = db.Column(db.Integer, default=6, nullable=False)
+
+    def __repr__(self):
+        return f'<Tariff {self.lot_id}>'
+
+
+class _RollupColumns:
+    """Per-lot activity in one time bucket, maintained by analytics.py.
+
+    Bookings count in the bucket where the stay started, and releases,
+    revenue and dwell time in the bucket where it ended. Occupied seconds
+    are spread over every bucket the stay overlaps, once it has ended.
+    """
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    bookings = db.Column(db.Integer, default=0, nullable=False)
+    releases = db.Column(db.Integer, default=0, nullable=False)
+    occupied_seconds = db.Column(db.Float, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    dwell_seconds = db.Column(db.Float, default=0, nullable=False)
+
+    @declared_attr
+    def lot_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('parking_lots.id'), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            # One lot's series is a range scan of the primary key.
+            db.PrimaryKeyConstraint('lot_id', 'bucket_start'),
+            # All-lot dashboards filter on the bucket alone.
+            db.Index(f'ix_{cls.__tablename__}_bucket', 'bucket_start'),
+        )
+
+
+class HourlyRollup(_RollupColumns, db.Model):
+    __tablename__ = 'hourly_rollups'
+
+
+class DailyRollup(_RollupColumns, db.Model):
+    __tablename__ = 'daily_rollups'
+
+
+def ensure_indexes():
+    """Creates any declared index missing from an existing database.
+
+    db.create_all() only creates missing tables, so indexes added to a model
+    after its table exists would otherwise never reach older databases.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def _create_shard_schema(engine, index):
+    """Creates the sharded tables and their indexes in one shard and reserves its id range.
+
+    Foreign keys to the default database's tables are left out; they cannot
+    be enforced across databases.
+    """
+    with engine.begin() as connection:
+        existing = set(sa.inspect(connection).get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in SHARDED_TABLES:
+                continue
+            if table.name not in existing:
+                local_keys = [fk for fk in table.foreign_key_constraints if fk.referred_table.name in SHARDED_TABLES]
+                connection.execute(CreateTable(table, include_foreign_key_constraints=local_keys))
+            for table_index in table.indexes:
+                table_index.create(connection, checkfirst=True)
+        for name in SHARD_ID_TABLES:
+            reserve_id_range(connection, name, index * SHARD_ID_SPAN)
+
+
+def reserve_id_range(connection, table, start):
+    """Makes the table's next generated id start + 1, unless ids are already past it."""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        connection.execute(sa.text(
+            'INSERT INTO sqlite_sequence (name, seq) SELECT :name, :start '
+            'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'
+        ), {"name": table, "start": start})
+    elif dialect == 'postgresql':
+        connection.execute(sa.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"GREATEST(:start, (SELECT COALESCE(MAX(id), 0) FROM {table})))"
+        ), {"start": start})
+    else:
+        raise RuntimeError(f'Cannot reserve shard id ranges on {dialect}; use SQLite or PostgreSQL shards.')
+
+
+def init_db(admin_password='admin'):
+    """Creates missing tables and indexes and seeds the default admin.
+
+    Returns the admin User if one had to be created, otherwise None. Needs an
+    app context; run it through `flask init-db` rather than at import time.
+    """
     db.create_all()
-    print("Database tables created successfully.")
-    admin = User.query.filter_by(is_admin=True).first()       
-    if not admin:
-        print("No admin user found. Creating a default admin user...")
-        password_for_admin = 'admin' 
-            
-
-            
-        hashed_password = generate_password_hash(password_for_admin)
-
-            
-        admin = User(
-            username='admin',
-            password_hash=hashed_password,
-            is_admin=True
-            )
-        db.session.add(admin)
-        db.session.commit()
\ No newline at end of file
+    ensure_indexes()
+    for index, name in enumerate(current_app.config.get('LOT_SHARDS', []), start=1):
+        _create_shard_schema(db.engines[SHARD_BIND_PREFIX + name], index)
+    if User.query.filter_by(is_admin=True).first():
+        return None
+
+    admin = User(
+        username='admin',
+        password_hash=generate_password_hash(admin_password),
+        is_admin=True
+        )
+    db.session.add(admin)
+    db.session.commit()
+    return admin
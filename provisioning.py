@@ -0,0 +1,106 @@
+"""Bulk spot provisioning and lot resizing.
+
+Spots are created and removed with set-based statements (one executemany
+INSERT, one DELETE) instead of one ORM object per spot, so provisioning a
+10,000-spot lot is a single statement batch. Both work in the lot's shard.
+"""
+from sqlalchemy import delete, func, insert, select
+
+from models import db, ParkingSpot, Reservation, AdvanceBooking, OverstayFlag
+from spot_index import free_spots
+from booking_index import has_active_bookings
+import reports
+import shards
+import write_behind
+
+
+def provision_spots(lot_id, count):
+    """Appends `count` free spots after the lot's highest spot number.
+
+    Stages the inserts in the current transaction and returns the new spot
+    ids in spot_number order; the caller commits and then registers them
+    with the free-spot index.
+    """
+    with shards.use(shards.for_lot(lot_id)):
+        return _provision_spots(lot_id, count)
+
+
+def _provision_spots(lot_id, count):
+    last_number = db.session.query(func.max(ParkingSpot.spot_number)).filter_by(lot_id=lot_id).scalar() or 0
+    first_number = last_number + 1
+    db.session.execute(insert(ParkingSpot), [
+        {"lot_id": lot_id, "spot_number": number, "status": 'A'}
+        for number in range(first_number, first_number + count)
+    ])
+    reports.record_spots_added(lot_id, count)
+    return [row[0] for row in db.session.query(ParkingSpot.id)
+            .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.spot_number >= first_number)
+            .order_by(ParkingSpot.spot_number)]
+
+
+def resize_lot(lot, new_size):
+    """Grows or shrinks a lot to `new_size` spots and commits.
+
+    Growth bulk-inserts new spots at the end; shrinking bulk-deletes the
+    trailing spots. Raises ValueError, leaving the lot untouched, if any of
+    the spots that would be removed is occupied or has an upcoming advance
+    booking.
+    """
+    with shards.use(shards.for_lot(lot.id)), write_behind.exclusive(lot.id):
+        _resize_lot(lot, new_size)
+
+
+def _resize_lot(lot, new_size):
+    current_size = db.session.query(func.count(ParkingSpot.id)).filter_by(lot_id=lot.id).scalar()
+
+    if new_size > current_size:
+        new_ids = provision_spots(lot.id, new_size - current_size)
+        lot.maximum_number_of_spots = new_size
+        db.session.commit()
+        free_spots.add_lot(lot.id, new_ids)
+        return
+
+    if new_size < current_size:
+        trailing = db.session.query(ParkingSpot.id)\
+                             .filter_by(lot_id=lot.id)\
+                             .order_by(ParkingSpot.spot_number.desc())\
+                             .limit(current_size - new_size).all()
+        spot_ids = [row[0] for row in trailing]
+
+        reports.record_spots_removed(lot.id, spot_ids)
+        # Only free spots are deleted; a spot booked since the lookup makes the counts disagree.
+        result = db.session.execute(
+            delete(ParkingSpot)
+            .where(ParkingSpot.id.in_(spot_ids), ParkingSpot.status == 'A')
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != len(spot_ids):
+            db.session.rollback()
+            raise ValueError('Cannot shrink the lot: some of the spots to be removed are occupied.')
+        # Checked after the delete, which holds the spots' row locks, so no booking can slip in between.
+        if has_active_bookings(spot_ids):
+            db.session.rollback()
+            raise ValueError('Cannot shrink the lot: some of the spots to be removed have upcoming bookings.')
+
+        db.session.execute(
+            delete(AdvanceBooking)
+            .where(AdvanceBooking.spot_id.in_(spot_ids))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            delete(OverstayFlag)
+            .where(OverstayFlag.reservation_id.in_(select(Reservation.id).where(Reservation.spot_id.in_(spot_ids))))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            delete(Reservation)
+            .where(Reservation.spot_id.in_(spot_ids))
+            .execution_options(synchronize_session=False)
+        )
+        lot.maximum_number_of_spots = new_size
+        db.session.commit()
+        for spot_id in spot_ids:
+            free_spots.remove_spot(spot_id)
+        return
+
+    lot.maximum_number_of_spots = new_size
@@ -0,0 +1,29 @@
+"""Pytest fixture that fails a test when a block issues more SQL than its budget.
+
+The repository's conftest.py registers it (``pytest_plugins = ['pytest_query_budget']``);
+tests/test_query_budgets.py uses it for the admin grid, admin summary and user dashboard:
+
+    def test_dashboard_queries(client, query_budget):
+        with query_budget(8):
+            client.get('/dashboard')
+
+The failure lists every statement that ran, so an N+1 shows up as the same
+SELECT repeated.
+"""
+from contextlib import contextmanager
+
+import pytest
+
+from instrumentation import count_queries
+
+
+@pytest.fixture
+def query_budget():
+    @contextmanager
+    def budget(limit):
+        with count_queries() as counter:
+            yield counter
+        if counter.count > limit:
+            statements = '\n'.join(f'  {statement}' for statement in counter.statements)
+            pytest.fail(f'{counter.count} queries, budget is {limit}:\n{statements}', pytrace=False)
+    return budget
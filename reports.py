@@ -0,0 +1,228 @@
+"""Reporting queries for the admin and user summaries.
+
+Occupancy and revenue for every lot are computed with grouped aggregate
+queries (one per metric) instead of one query per lot. With
+``SUMMARY_TABLE`` enabled the figures are served from the materialized
+``lot_summaries`` table, which bookings, releases and lot/spot changes
+update incrementally.
+
+With lot shards each shard is queried concurrently and the rows are
+merged with the lot names from the default database.
+"""
+from flask import current_app
+from sqlalchemy import case, extract, func, select, update
+
+from models import db, ParkingLot, ParkingSpot, Reservation, LotSummary
+import shards
+
+
+def summary_table_enabled():
+    return bool(current_app.config.get('SUMMARY_TABLE'))
+
+
+def _lot_names(lot_ids=None):
+    query = db.session.query(ParkingLot.id, ParkingLot.prime_location_name)
+    if lot_ids is not None:
+        query = query.filter(ParkingLot.id.in_(lot_ids))
+    return query.order_by(ParkingLot.id).all()
+
+
+def _spot_counts(lot_ids=None):
+    query = db.session.query(
+        ParkingSpot.lot_id,
+        func.sum(case((ParkingSpot.status == 'O', 1), else_=0)),
+        func.sum(case((ParkingSpot.status == 'A', 1), else_=0)),
+    )
+    if lot_ids is not None:
+        query = query.filter(ParkingSpot.lot_id.in_(lot_ids))
+    return query.group_by(ParkingSpot.lot_id).all()
+
+
+def _merged(results):
+    return {row[0]: tuple(row[1:]) for rows in results for row in rows}
+
+
+def lot_occupancy(lot_ids=None):
+    """Returns [(lot_id, name, occupied, available)] for every lot (or just lot_ids), one grouped query per shard."""
+    counts = _merged(shards.gather(_spot_counts, lot_ids))
+    return [(lot_id, name, *counts.get(lot_id, (0, 0))) for lot_id, name in _lot_names(lot_ids)]
+
+
+def _lot_revenue():
+    return db.session.query(ParkingSpot.lot_id, func.sum(Reservation.parking_cost))\
+                     .join(Reservation, Reservation.spot_id == ParkingSpot.id)\
+                     .group_by(ParkingSpot.lot_id).all()
+
+
+def lot_revenue():
+    """Returns {lot_id: total parking_cost} for every lot with revenue, one grouped query per shard."""
+    return {lot_id: total or 0 for lot_id, (total,) in _merged(shards.gather(_lot_revenue)).items()}
+
+
+def _lot_summaries():
+    return db.session.query(LotSummary.lot_id, LotSummary.occupied, LotSummary.available, LotSummary.revenue).all()
+
+
+def _summary_rows():
+    if summary_table_enabled():
+        summaries = _merged(shards.gather(_lot_summaries))
+        return [(lot_id, name, *summaries.get(lot_id, (0, 0, 0))) for lot_id, name in _lot_names()]
+
+    revenue = lot_revenue()
+    return [(lot_id, name, occupied, available, revenue.get(lot_id, 0))
+            for lot_id, name, occupied, available in lot_occupancy()]
+
+
+def admin_summary_data():
+    """Returns (occupancy_data, revenue_data) in the shape admin_summary.html expects."""
+    rows = _summary_rows()
+    labels = [row[1] for row in rows]
+    occupancy_data = {
+        "labels": labels,
+        "occupied": [row[2] for row in rows],
+        "available": [row[3] for row in rows],
+    }
+    revenue_data = {
+        "labels": labels,
+        "values": [row[4] for row in rows],
+    }
+    return occupancy_data, revenue_data
+
+
+def lot_spot_grid(lot_id):
+    """Compact encoding of a lot's spots, in spot_number order.
+
+    ``status`` is run-length encoded, e.g. ``"12A3O5A"``. ``ids`` lists runs of
+    ``[first_spot_id, first_spot_number, length]`` over which both the id and
+    the spot number go up by one, so a lot created in one go is a single run.
+    """
+    status_runs, id_runs = [], []
+    rows = db.session.query(ParkingSpot.id, ParkingSpot.spot_number, ParkingSpot.status)\
+                     .filter_by(lot_id=lot_id)\
+                     .order_by(ParkingSpot.spot_number)
+    prev_id = prev_number = None
+    for spot_id, spot_number, status in rows:
+        if status_runs and status_runs[-1][0] == status:
+            status_runs[-1][1] += 1
+        else:
+            status_runs.append([status, 1])
+        if id_runs and spot_id == prev_id + 1 and spot_number == prev_number + 1:
+            id_runs[-1][2] += 1
+        else:
+            id_runs.append([spot_id, spot_number, 1])
+        prev_id, prev_number = spot_id, spot_number
+
+    return {
+        "lot_id": lot_id,
+        "status": ''.join(f'{count}{status}' for status, count in status_runs),
+        "ids": id_runs,
+    }
+
+
+def _monthly_counts(user_id):
+    year = extract('year', Reservation.parking_timestamp)
+    month = extract('month', Reservation.parking_timestamp)
+    return db.session.query(year, month, func.count(Reservation.id))\
+                     .filter_by(user_id=user_id)\
+                     .group_by(year, month).all()
+
+
+def user_monthly_counts(user_id):
+    """Chart data for user_summary.html: reservations per month for one user, across shards."""
+    counts = {}
+    for rows in shards.gather(_monthly_counts, user_id):
+        for year, month, count in rows:
+            counts[int(year), int(month)] = counts.get((int(year), int(month)), 0) + count
+    months = sorted(counts)
+    return {
+        "labels": [f'{y:04d}-{m:02d}' for y, m in months],
+        "values": [counts[month] for month in months]
+    }
+
+
+def _refresh_shard_summaries():
+    counts = {lot_id: (occupied, available) for lot_id, occupied, available in _spot_counts()}
+    revenue = {lot_id: total or 0 for lot_id, total in _lot_revenue()}
+    LotSummary.query.delete()
+    for lot_id in shards.lot_ids(shards.current()):
+        occupied, available = counts.get(lot_id, (0, 0))
+        db.session.add(LotSummary(lot_id=lot_id, occupied=occupied, available=available,
+                                  revenue=revenue.get(lot_id, 0)))
+    db.session.commit()
+
+
+def refresh_lot_summaries():
+    """Rebuilds lot_summaries from the base tables, in every shard. Run at startup when the table is enabled."""
+    shards.gather(_refresh_shard_summaries)
+
+
+# Incremental maintenance. Each helper only stages an UPDATE in the caller's
+# transaction, so the summary commits (or rolls back) together with the change.
+
+def _spot_lot(spot_id):
+    return select(ParkingSpot.lot_id).where(ParkingSpot.id == spot_id).scalar_subquery()
+
+
+def record_claim(spot_id):
+    if summary_table_enabled():
+        db.session.execute(
+            update(LotSummary)
+            .where(LotSummary.lot_id == _spot_lot(spot_id))
+            .values(occupied=LotSummary.occupied + 1, available=LotSummary.available - 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def record_release(spot_id, cost):
+    if summary_table_enabled():
+        db.session.execute(
+            update(LotSummary)
+            .where(LotSummary.lot_id == _spot_lot(spot_id))
+            .values(occupied=LotSummary.occupied - 1, available=LotSummary.available + 1,
+                    revenue=LotSummary.revenue + (cost or 0))
+            .execution_options(synchronize_session=False)
+        )
+
+
+def record_changes(changes):
+    """record_claim and record_release for many spots at once: changes maps lot_id -> (net claims, revenue)."""
+    if summary_table_enabled():
+        for lot_id, (claimed, revenue) in changes.items():
+            db.session.execute(
+                update(LotSummary)
+                .where(LotSummary.lot_id == lot_id)
+                .values(occupied=LotSummary.occupied + claimed, available=LotSummary.available - claimed,
+                        revenue=LotSummary.revenue + revenue)
+                .execution_options(synchronize_session=False)
+            )
+
+
+def record_spots_added(lot_id, count):
+    if summary_table_enabled():
+        result = db.session.execute(
+            update(LotSummary)
+            .where(LotSummary.lot_id == lot_id)
+            .values(available=LotSummary.available + count)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            db.session.add(LotSummary(lot_id=lot_id, occupied=0, available=count, revenue=0))
+
+
+def record_spots_removed(lot_id, spot_ids):
+    """Call before deleting spots: their reservations (and revenue) go with them."""
+    if summary_table_enabled():
+        lost_revenue = select(func.coalesce(func.sum(Reservation.parking_cost), 0))\
+            .where(Reservation.spot_id.in_(spot_ids)).scalar_subquery()
+        db.session.execute(
+            update(LotSummary)
+            .where(LotSummary.lot_id == lot_id)
+            .values(available=LotSummary.available - len(spot_ids),
+                    revenue=LotSummary.revenue - lost_revenue)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def record_lot_removed(lot_id):
+    if summary_table_enabled():
+        LotSummary.query.filter_by(lot_id=lot_id).delete()
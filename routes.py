@@ -1,11 +1,52 @@
-from app import app
-from flask import  render_template, redirect, url_for, request, flash, session
-from models import db, User, ParkingLot, ParkingSpot, Reservation
+from flask import  render_template, redirect, url_for, request, flash, session, jsonify, Response, stream_with_context, current_app, abort
+from models import db, User, ParkingLot, ParkingSpot, Reservation, Tariff, AdvanceBooking
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-from datetime import datetime
-from sqlalchemy import or_
-
+import json
+import math
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
+from allocation import get_reservation
+from spot_index import free_spots
+from availability import hub, streams_offered, streams_supported
+from booking_index import has_active_bookings
+from provisioning import provision_spots, resize_lot
+import allocation
+import analytics
+import auth
+import billing
+import bookings
+import cache
+import instrumentation
+import reports
+import search
+import shards
+import sweeper
+import write_behind
+from exports import EXPORT_FORMATS, reservation_rows
+
+
+ADMIN_LOTS_PER_PAGE = 12
+LOGIN_BUSY_RETRY_AFTER = 5
+SEARCH_RESULTS_PER_PAGE = 20
+
+LotSearchResult = namedtuple('LotSearchResult', 'id prime_location_name price')
+
+_routes = []
+
+
+def route(rule, **options):
+    """Records a view to be registered on the app by init_app(), keeping endpoint names unprefixed."""
+    def decorator(func):
+        _routes.append((rule, func, options))
+        return func
+    return decorator
+
+
+def init_app(app):
+    for rule, func, options in _routes:
+        app.add_url_rule(rule, view_func=func, **options)
 
 
 def auth_required(func):
@@ -29,23 +70,30 @@ def admin_required(func):
     return inner
 
 
-@app.route('/login')
+@route('/login')
 def login():
     return render_template('login.html')
 
-@app.route('/login', methods=['POST'])
+@route('/login', methods=['POST'])
 def login_post():
     username = request.form.get('username')
     password = request.form.get('password')
-    user = User.query.filter_by(username=username).first()
 
-    if not user or not user.check_password(password):
+    try:
+        user = auth.authenticate(username, password)
+    except auth.LoginRefused as e:
+        wait = math.ceil(e.retry_after)
+        flash(f'Too many failed attempts. Please try again in {wait} seconds.', 'danger')
+        return render_template('login.html'), 429, {'Retry-After': str(wait)}
+    except auth.AuthBusy:
+        flash('Too many people are logging in right now. Please try again in a moment.', 'warning')
+        return render_template('login.html'), 503, {'Retry-After': str(LOGIN_BUSY_RETRY_AFTER)}
+
+    if user is None:
         flash('Invalid username or password.', 'danger')
         return redirect(url_for('login'))
 
-    session['user_id'] = user.id
-    session['is_admin'] = user.is_admin
-    session['username'] = user.username
+    auth.log_in(user)
 
     flash('Login successful!', 'success')
 
@@ -54,11 +102,11 @@ def login_post():
     else:
         return redirect(url_for('user_dashboard'))
 
-@app.route('/register')
+@route('/register')
 def register():
     return render_template('register.html')
 
-@app.route('/register', methods=['POST'])
+@route('/register', methods=['POST'])
 def register_post():
     name = request.form.get('name')
     email = request.form.get('email')
@@ -87,38 +135,36 @@ def register_post():
     new_user.set_password(password)
     db.session.add(new_user)
     db.session.commit()
+    search.index_user(new_user)
 
     flash('Registration successful! Please login.', 'success')
     return redirect(url_for('login'))
 
-@app.route('/logout')
+@route('/logout')
 @auth_required
 def logout():
-    session.pop('user_id', None)
-    session.pop('is_admin', None)
-    session.pop('username', None)
+    auth.log_out()
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))
 
 
-@app.route('/')
+@route('/')
 @auth_required
 def index():
     if session.get('is_admin'):
         return redirect(url_for('admin'))
     return render_template('user_dashboard.html')
 
-@app.route('/profile')
+@route('/profile')
 @auth_required
 def profile():
-    user = User.query.get(session['user_id'])
-    return render_template('profile.html', user=user)
+    return render_template('profile.html', user=auth.current_user())
 
-@app.route('/profile', methods=['POST'])
+@route('/profile', methods=['POST'])
 @auth_required
 def profile_post():
     current_user_id = session.get('user_id')
-    user = User.query.get(current_user_id)
+    user = db.session.get(User, current_user_id)
     if not user:
         flash('User not found.', 'danger')
         return redirect(url_for('login'))
@@ -131,7 +177,17 @@ def profile_post():
         flash('All fields are required to update profile.', 'danger')
         return redirect(url_for('profile'))
 
-    if not user.check_password(cpassword):
+    wait = auth.login_failures.retry_after(user.username)
+    if wait:
+        flash(f'Too many failed attempts. Please try again in {math.ceil(wait)} seconds.', 'danger')
+        return redirect(url_for('profile'))
+    try:
+        valid = auth.verify_password(user, cpassword)
+    except auth.AuthBusy:
+        flash('The server is busy. Please try again in a moment.', 'warning')
+        return redirect(url_for('profile'))
+    if not valid:
+        auth.login_failures.failed(user.username)
         flash('Current password is incorrect.', 'danger')
         return redirect(url_for('profile'))
 
@@ -147,18 +203,31 @@ def profile_post():
     user.username = username
     user.set_password(new_password)
     db.session.commit()
-    session['username'] = user.username
+    search.index_user(user)
+    auth.log_in(user)
     flash('Profile updated successfully.', 'success')
     return redirect(url_for('profile'))
 
 
-@app.route('/admin')
+@route('/admin')
 @admin_required
 def admin():
-    parking_lots = ParkingLot.query.all()
-    return render_template('admin.html', parking_lots=parking_lots)
+    page = request.args.get('page', 1, type=int)
+    pagination = ParkingLot.query.order_by(ParkingLot.id)\
+                                 .paginate(page=page, per_page=ADMIN_LOTS_PER_PAGE, error_out=False)
+    counts = {
+        lot_id: (occupied, occupied + available)
+        for lot_id, _name, occupied, available in reports.lot_occupancy([lot.id for lot in pagination.items])
+    }
+    return render_template('admin.html', parking_lots=pagination.items, pagination=pagination, counts=counts)
+
+@route('/admin/parking_lot/<int:lot_id>/spots')
+@admin_required
+def lot_spot_grid(lot_id):
+    """Spot statuses for one lot, fetched on demand by the admin grid."""
+    return jsonify(reports.lot_spot_grid(lot_id))
 
-@app.route('/admin/parking_lot/add', methods=['GET', 'POST'])
+@route('/admin/parking_lot/add', methods=['GET', 'POST'])
 @admin_required
 def add_parking_lot():
     if request.method == 'POST':
@@ -195,19 +264,60 @@ def add_parking_lot():
             maximum_number_of_spots=maximum_number_of_spots,
         )
         db.session.add(new_lot)
-        db.session.commit()
+        db.session.flush()
+        try:
+            shards.assign([new_lot.id], request.form.get('shard') or None)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return render_template('parking_lot_form.html', parking_lot=None)
 
-        for i in range(1, new_lot.maximum_number_of_spots + 1):
-            new_spot = ParkingSpot(lot_id=new_lot.id, spot_number=i, status='A')
-            db.session.add(new_spot)
+        new_spot_ids = provision_spots(new_lot.id, new_lot.maximum_number_of_spots)
         db.session.commit()
+        free_spots.add_lot(new_lot.id, new_spot_ids)
+        search.index_lot(new_lot)
+        cache.invalidate_lots()
 
         flash('Parking Lot added successfully!', 'success')
         return redirect(url_for('admin'))
 
     return render_template('parking_lot_form.html', parking_lot=None)
 
-@app.route('/admin/parking_lot/edit/<int:lot_id>', methods=['GET', 'POST'])
+def _update_tariff(parking_lot, form):
+    """Sets the lot's optional tariff rules from the edit form; blank fields switch a rule off."""
+    def amount(field):
+        value = (form.get(field) or '').strip()
+        if not value:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(f'Invalid number for {field.replace("_", " ")}.')
+        if value < 0:
+            raise ValueError(f'{field.replace("_", " ").capitalize()} cannot be negative.')
+        return value
+
+    def hour(field, default):
+        value = (form.get(field) or '').strip()
+        if not value:
+            return default
+        if not value.isdigit() or int(value) > 23:
+            raise ValueError(f'{field.replace("_", " ").capitalize()} must be an hour from 0 to 23.')
+        return int(value)
+
+    rules = dict(minimum_charge=amount('minimum_charge'), daily_cap=amount('daily_cap'),
+                 night_price=amount('night_price'))
+    if not any(value is not None for value in rules.values()):
+        parking_lot.tariff = None
+        return
+    tariff = parking_lot.tariff or Tariff(lot_id=parking_lot.id)
+    for name, value in rules.items():
+        setattr(tariff, name, value)
+    tariff.night_start_hour = hour('night_start_hour', 22)
+    tariff.night_end_hour = hour('night_end_hour', 6)
+    parking_lot.tariff = tariff
+
+@route('/admin/parking_lot/edit/<int:lot_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_parking_lot(lot_id):
     parking_lot = ParkingLot.query.get_or_404(lot_id)
@@ -217,18 +327,20 @@ def edit_parking_lot(lot_id):
         address = request.form.get('address')
         pin_code = request.form.get('pin_code')
         price_str = request.form.get('price')
+        maximum_number_of_spots_str = request.form.get('maximum_number_of_spots')
 
-        if not all([prime_location_name, address, pin_code, price_str]):
+        if not all([prime_location_name, address, pin_code, price_str, maximum_number_of_spots_str]):
             flash('Please fill in all required fields.', 'danger')
             return render_template('parking_lot_form.html', parking_lot=parking_lot)
 
         try:
             price = float(price_str)
-            if price <= 0:
-                flash('Price must be a positive number.', 'danger')
+            maximum_number_of_spots = int(maximum_number_of_spots_str)
+            if price <= 0 or maximum_number_of_spots <= 0:
+                flash('Price and maximum spots must be positive numbers.', 'danger')
                 return render_template('parking_lot_form.html', parking_lot=parking_lot)
         except ValueError:
-            flash('Invalid number for price.', 'danger')
+            flash('Invalid numbers for price or maximum spots.', 'danger')
             return render_template('parking_lot_form.html', parking_lot=parking_lot)
 
         existing_lot = ParkingLot.query.filter(
@@ -243,29 +355,46 @@ def edit_parking_lot(lot_id):
         parking_lot.address = address
         parking_lot.pin_code = pin_code
         parking_lot.price = price
+        try:
+            _update_tariff(parking_lot, request.form)
+            resize_lot(parking_lot, maximum_number_of_spots)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_parking_lot', lot_id=lot_id))
         db.session.commit()
+        bookings.booking_index.invalidate(lot_id)
+        search.index_lot(parking_lot)
+        cache.invalidate_lots()
 
         flash('Parking Lot updated successfully!', 'success')
         return redirect(url_for('admin'))
 
     return render_template('parking_lot_form.html', parking_lot=parking_lot)
 
-@app.route('/admin/parking_lot/delete/<int:lot_id>', methods=['POST'])
+@route('/admin/parking_lot/delete/<int:lot_id>', methods=['POST'])
 @admin_required
 def delete_parking_lot(lot_id):
     """Handles the deletion logic, called from the edit page."""
     parking_lot = ParkingLot.query.get_or_404(lot_id)
-    if ParkingSpot.query.filter_by(lot_id=lot_id, status='O').count() > 0:
-        flash(f'Cannot delete "{parking_lot.prime_location_name}" as it has occupied spots.', 'danger')
-        return redirect(url_for('edit_parking_lot', lot_id=lot_id))
-    
-    lot_name = parking_lot.prime_location_name
-    db.session.delete(parking_lot)
-    db.session.commit()
+    with write_behind.exclusive(lot_id):
+        if ParkingSpot.query.filter_by(lot_id=lot_id, status='O').count() > 0:
+            flash(f'Cannot delete "{parking_lot.prime_location_name}" as it has occupied spots.', 'danger')
+            return redirect(url_for('edit_parking_lot', lot_id=lot_id))
+
+        lot_name = parking_lot.prime_location_name
+        reports.record_lot_removed(lot_id)
+        analytics.record_lot_removed(lot_id)
+        db.session.delete(parking_lot)
+        db.session.commit()
+    shards.forget(lot_id)
+    free_spots.remove_lot(lot_id)
+    bookings.booking_index.invalidate(lot_id)
+    search.unindex_lot(lot_id)
+    cache.invalidate_lots()
     flash(f'Parking Lot "{lot_name}" and all its spots were deleted.', 'success')
     return redirect(url_for('admin'))
 
-@app.route('/admin/spot/details/<int:spot_id>')
+@route('/admin/spot/details/<int:spot_id>')
 @admin_required
 def spot_details(spot_id):
     """Shows a details page for a single parking spot."""
@@ -273,77 +402,163 @@ def spot_details(spot_id):
     active_reservation = Reservation.query.filter_by(spot_id=spot.id, leaving_timestamp=None).first()
     return render_template('spot_details.html', spot=spot, active_reservation=active_reservation, title="Spot Details")
 
-@app.route('/admin/spot/delete/<int:spot_id>', methods=['POST'])
+@route('/admin/spot/delete/<int:spot_id>', methods=['POST'])
 @admin_required
 
 def delete_parking_spot(spot_id):
     """Handles deletion of a single spot."""
     spot = ParkingSpot.query.get_or_404(spot_id)
-    if spot.status == 'O':
-        flash('Cannot delete an occupied spot.', 'danger')
-        return redirect(url_for('spot_details', spot_id=spot.id))
-    
     lot_id = spot.lot_id # Save lot_id for redirect before deleting
-    db.session.delete(spot)
-    db.session.commit()
+    with write_behind.exclusive(lot_id):
+        db.session.refresh(spot)  # with write-behind, bookings applied just now may have changed it
+        if spot.status == 'O':
+            flash('Cannot delete an occupied spot.', 'danger')
+            return redirect(url_for('spot_details', spot_id=spot.id))
+        if has_active_bookings([spot.id]):
+            flash('Cannot delete a spot with upcoming bookings.', 'danger')
+            return redirect(url_for('spot_details', spot_id=spot.id))
+
+        reports.record_spots_removed(lot_id, [spot.id])
+        db.session.delete(spot)
+        db.session.commit()
+    free_spots.remove_spot(spot_id)
+    bookings.booking_index.invalidate(lot_id)
+    cache.invalidate_lots()
     flash('Spot has been deleted.', 'success')
     return redirect(url_for('edit_parking_lot', lot_id=lot_id))
 
 
-@app.route('/admin/users')
+@route('/admin/users')
 @admin_required
 def admin_users():
     
     users = User.query.filter_by(is_admin=False).order_by(User.name).all()
     return render_template('admin_users.html', title='Registered Users', users=users)
 
-@app.route('/admin/search', methods=['GET', 'POST'])
+@route('/admin/search', methods=['GET', 'POST'])
 @admin_required
 def admin_search():
     search_results = None
-    search_type = ''
-    if request.method == 'POST':
-        search_by = request.form.get('search_by')
-        search_string = request.form.get('search_string')
-        search_type = search_by
-
+    total = 0
+    # The form POSTs; the pagination links repeat the search with GET parameters.
+    search_type = request.values.get('search_by', '')
+    search_string = request.values.get('search_string')
+    page = request.args.get('page', 1, type=int)
+    if request.method == 'POST' or search_type:
         if search_string:
-            if search_by == 'user_username':
-                search_results = User.query.filter(User.username.ilike(f'%{search_string}%')).all()
-            elif search_by == 'location':
-                search_results = ParkingLot.query.filter(ParkingLot.prime_location_name.ilike(f'%{search_string}%')).all()
+            if search_type == 'user_username':
+                search_results, total = search.search_users(search_string, page, SEARCH_RESULTS_PER_PAGE)
+            elif search_type == 'location':
+                search_results, total = search.search_lots(search_string, page, SEARCH_RESULTS_PER_PAGE)
         else:
             flash('Please enter a search term.', 'warning')
             
-    return render_template('admin_search.html', title='Search', results=search_results, search_type=search_type)
+    return render_template('admin_search.html', title='Search', results=search_results, search_type=search_type,
+                           search_string=search_string, page=page, total=total, per_page=SEARCH_RESULTS_PER_PAGE)
 
-@app.route('/admin/summary')
+@route('/admin/export/reservations.<fmt>')
 @admin_required
-def admin_summary():
-    all_lots = ParkingLot.query.all()
-    
+def export_reservations(fmt):
+    """Streams reservation history as CSV or NDJSON, optionally for one lot and a date range."""
+    if fmt not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'danger')
+        return redirect(url_for('admin_summary'))
+
+    lot_id = request.args.get('lot_id', type=int)
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else None
+        # The end date is inclusive: take everything parked before the following midnight.
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('end') else None
+    except ValueError:
+        flash('Dates must be in YYYY-MM-DD format.', 'danger')
+        return redirect(url_for('admin_summary'))
+
+    stream, mimetype = EXPORT_FORMATS[fmt]
+    filename = f"reservations{f'-lot{lot_id}' if lot_id else ''}.{fmt}"
+    return Response(
+        stream_with_context(stream(reservation_rows(lot_id, start, end))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
 
-    occupancy_labels = [lot.prime_location_name for lot in all_lots]
-    occupied_counts = [ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count() for lot in all_lots]
-    available_counts = [ParkingSpot.query.filter_by(lot_id=lot.id, status='A').count() for lot in all_lots]
-    occupancy_data = {
-        "labels": occupancy_labels,
-        "occupied": occupied_counts,
-        "available": available_counts
-    }
-    
-    revenue_values = []
-    for lot in all_lots:
-        total_revenue = db.session.query(db.func.sum(Reservation.parking_cost))\
-                                  .join(ParkingSpot)\
-                                  .filter(ParkingSpot.lot_id == lot.id)\
-                                  .scalar() or 0
-        revenue_values.append(total_revenue)
-        
-    revenue_data = {
-        "labels": occupancy_labels,
-        "values": revenue_values
-    }
+@route('/admin/cache')
+@admin_required
+def cache_stats():
+    """Hit/miss counters for tuning CACHE_TTL and CACHE_MAX_ENTRIES."""
+    return jsonify({c.name: c.stats() for c in cache.all_caches})
+
+@route('/admin/sweeper')
+@admin_required
+def sweeper_stats():
+    """Overstay sweep counters and timings for this worker process."""
+    return jsonify(sweeper.stats.stats())
+
+@route('/admin/write-behind')
+@admin_required
+def write_behind_stats():
+    """Events logged and applied by the write-behind writer in this worker process."""
+    if not write_behind.enabled():
+        abort(404)
+    return jsonify(write_behind.stats())
+
+@route('/admin/profile')
+@admin_required
+def profile_stats():
+    """Per-endpoint means and the statements with the most total SQL time, for this worker process."""
+    return jsonify({
+        "endpoints": instrumentation.metrics.endpoint_stats(),
+        "slowest_statements": instrumentation.metrics.slowest_statements(),
+    })
+
+@route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint for this worker process. Requires METRICS_TOKEN as a bearer token if set."""
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+
+    extra = []
+    cache_stats = {c.name: c.stats() for c in cache.all_caches}
+    for field in ('hits', 'misses', 'evictions'):
+        extra.append((f'cache_{field}_total', 'counter', f'Cache {field}, by cache.',
+                      [({"cache": name}, stats[field]) for name, stats in cache_stats.items()]))
+    extra.append(('cache_entries', 'gauge', 'Entries held, by cache.',
+                  [({"cache": name}, stats["entries"]) for name, stats in cache_stats.items()]))
+
+    sweep = sweeper.stats.stats()
+    extra.append(('sweeper_runs_total', 'counter', 'Overstay sweeps run.', [({}, sweep["runs"])]))
+    extra.append(('sweeper_errors_total', 'counter', 'Overstay sweeps that failed.', [({}, sweep["errors"])]))
+    extra.append(('sweeper_rows_total', 'counter', 'Rows handled by the sweeper, by action.',
+                  [({"action": action}, sweep[action]) for action in ('released', 'flagged', 'expired_bookings')]))
+    extra.append(('sweeper_last_duration_seconds', 'gauge', 'Duration of the last sweep.',
+                  [({}, sweep["last_duration_seconds"])]))
+
+    hashing, failures = auth.hash_pool.stats(), auth.login_failures.stats()
+    extra.append(('auth_password_checks_pending', 'gauge', 'Password checks queued or running.',
+                  [({}, hashing["pending"])]))
+    extra.append(('auth_password_checks_rejected_total', 'counter', 'Logins turned away because the hash pool was full.',
+                  [({}, hashing["rejected"])]))
+    extra.append(('auth_login_refused_total', 'counter', 'Logins refused by the failed-login limit.',
+                  [({}, failures["refused"])]))
+
+    if write_behind.enabled():
+        writes = write_behind.stats()
+        extra.append(('write_behind_pending_events', 'gauge', 'Logged bookings and releases not yet in the database.',
+                      [({}, writes["pending"])]))
+        extra.append(('write_behind_events_total', 'counter', 'Logged events applied to the database.',
+                      [({}, writes["events"])]))
+        extra.append(('write_behind_batches_total', 'counter', 'Batches committed by the writer.',
+                      [({}, writes["batches"])]))
+        extra.append(('write_behind_errors_total', 'counter', 'Batches that failed and were retried.',
+                      [({}, writes["errors"])]))
+
+    extra.append(('availability_subscribers', 'gauge', 'Open availability event streams.', [({}, hub.subscribers)]))
+    return Response(instrumentation.metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@route('/admin/summary')
+@admin_required
+def admin_summary():
+    occupancy_data, revenue_data = cache.summaries.get_or_set(cache.ADMIN_SUMMARY_KEY, reports.admin_summary_data)
 
     return render_template(
         'admin_summary.html',
@@ -354,98 +569,236 @@ def admin_summary():
 
 
 
+ANALYTICS_RANGES = {'hour': (48, timedelta(hours=1)), 'day': (30, timedelta(days=1))}
+
+@route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ANALYTICS_RANGES:
+        granularity = 'day'
+    default_buckets, width = ANALYTICS_RANGES[granularity]
+    buckets = min(max(request.args.get('buckets', default_buckets, type=int), 1), 1000)
+    lot_id = request.args.get('lot_id', type=int)
+
+    end = datetime.utcnow() + width
+    chart_data = analytics.series(granularity, end - buckets * width, end, lot_id)
+    lots = db.session.query(ParkingLot.id, ParkingLot.prime_location_name).order_by(ParkingLot.prime_location_name).all()
+    return render_template(
+        'admin_analytics.html',
+        title='Analytics',
+        chart_data=chart_data,
+        lots=lots,
+        lot_id=lot_id,
+        granularity=granularity,
+        buckets=buckets,
+    )
 
-@app.route('/dashboard')
+
+def _search_lots(search_query, page):
+    """Immutable tuples rather than ORM objects, so results can outlive the request in the search cache."""
+    lots, total = search.search_lots(search_query, page, SEARCH_RESULTS_PER_PAGE)
+    return [LotSearchResult(lot.id, lot.prime_location_name, lot.price) for lot in lots], total
+
+DASHBOARD_RESERVATIONS = 5
+
+def _recent_reservations(user_id):
+    # The table shows each reservation's lot name; load spots with the reservations and lots
+    # (from the default database) in one more query, instead of two queries per row.
+    return Reservation.query.filter_by(user_id=user_id)\
+                            .options(joinedload(Reservation.parking_spot).selectinload(ParkingSpot.parking_lot))\
+                            .order_by(Reservation.parking_timestamp.desc()).limit(DASHBOARD_RESERVATIONS).all()
+
+@route('/dashboard')
 @auth_required
 def user_dashboard():
     user_id = session['user_id']
     
     
-    reservations = Reservation.query.filter_by(user_id=user_id)\
-                                    .order_by(Reservation.parking_timestamp.desc()).limit(5).all()
+    reservations = sorted((reservation for result in shards.gather(_recent_reservations, user_id) for reservation in result),
+                          key=lambda reservation: reservation.parking_timestamp, reverse=True)[:DASHBOARD_RESERVATIONS]
     
     
     search_query = request.args.get('q')
-    parking_lots = []
+    page = request.args.get('page', 1, type=int)
+    parking_lots, total = [], 0
     if search_query:
-        
-        parking_lots = ParkingLot.query.filter(
-            or_(
-                ParkingLot.prime_location_name.ilike(f'%{search_query}%'),
-                ParkingLot.pin_code.ilike(f'%{search_query}%')
-            )
-        ).all()
+        parking_lots, total = cache.lot_search.get_or_set((search_query.lower(), page),
+                                                          lambda: _search_lots(search_query, page))
+    availability = {lot.id: free_spots.free_count(lot.id) for lot in parking_lots}
+    upcoming = bookings.upcoming(user_id)
     
-    return render_template('user_dashboard.html', reservations=reservations, parking_lots=parking_lots)
+    return render_template('user_dashboard.html', reservations=reservations, parking_lots=parking_lots, availability=availability,
+                           live_availability=streams_offered(current_app, request.environ),
+                           upcoming=upcoming, page=page, total=total, per_page=SEARCH_RESULTS_PER_PAGE)
+
+AVAILABILITY_MAX_LOTS = 50
 
-@app.route('/book/<int:spot_id>', methods=['GET', 'POST'])
+@route('/events/availability')
+@auth_required
+def availability_events():
+    """Server-Sent Events stream of free-spot counts for ?lots=1,2,3."""
+    try:
+        lot_ids = sorted({int(lot_id) for lot_id in request.args.get('lots', '').split(',') if lot_id})
+    except ValueError:
+        return jsonify(error='lots must be a comma-separated list of lot ids'), 400
+    if not lot_ids or len(lot_ids) > AVAILABILITY_MAX_LOTS:
+        return jsonify(error=f'Pass between 1 and {AVAILABILITY_MAX_LOTS} lot ids.'), 400
+    if not streams_supported(request.environ):
+        return Response(status=204)  # tells EventSource not to reconnect
+    if hub.subscribers >= current_app.config['SSE_MAX_SUBSCRIBERS']:
+        return jsonify(error='Too many live subscribers; reload to refresh.'), 503, {'Retry-After': '30'}
+
+    app = current_app._get_current_object()
+    heartbeat = app.config['SSE_HEARTBEAT']
+    version = hub.version
+    initial = {lot_id: available for lot_id, _name, _occupied, available in reports.lot_occupancy(lot_ids)}
+    watched = set(lot_ids)
+
+    def stream():
+        # No request context or database session is held while the stream is open.
+        hub.subscribe(app, lot_ids)
+        try:
+            yield f'event: availability\ndata: {json.dumps(initial)}\n\n'
+            seen = version
+            while True:
+                seen, changes = hub.wait(seen, watched, heartbeat)
+                if changes:
+                    yield f'event: availability\ndata: {json.dumps(changes)}\n\n'
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            hub.unsubscribe(lot_ids)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@route('/book/<int:spot_id>', methods=['GET', 'POST'])
 @auth_required
 def book_spot(spot_id):
     spot = ParkingSpot.query.get_or_404(spot_id)
     
-    
-    if spot.status != 'A':
-        flash('This spot is already occupied or unavailable.', 'warning')
+    try:
+        if request.method != 'POST':
+            allocation.check_bookable(spot)
+            return render_template('book_spot.html', spot=spot, title="Book Spot")
+        allocation.book_spot(spot, session['user_id'], request.form.get('vehicle_number'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('book_spot', spot_id=spot_id))
+    except allocation.BookingRefused as e:
+        flash(str(e), 'warning')
         return redirect(url_for('user_dashboard'))
-    
+
+    flash(f'Spot {spot.spot_number} at {spot.parking_lot.prime_location_name} booked successfully!', 'success')
+    return redirect(url_for('user_dashboard'))
+
+@route('/book/lot/<int:lot_id>', methods=['GET', 'POST'])
+@auth_required
+def book_lot(lot_id):
+    """Books whichever spot in the lot is free, chosen server-side."""
+    lot = ParkingLot.query.get_or_404(lot_id)
+
+    if request.method == 'POST':
+        try:
+            reservation = allocation.book_lot(lot, session['user_id'], request.form.get('vehicle_number'))
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('book_lot', lot_id=lot_id))
+        except allocation.BookingRefused as e:
+            flash(str(e), 'warning')
+            return redirect(url_for('user_dashboard'))
+
+        spot = db.session.get(ParkingSpot, reservation.spot_id)
+        flash(f'Spot {spot.spot_number} at {lot.prime_location_name} booked successfully!', 'success')
+        return redirect(url_for('user_dashboard'))
+
+    return render_template('book_spot.html', spot=None, lot=lot, title="Book Spot")
+
+def _parse_window(form):
+    try:
+        return (datetime.fromisoformat(form.get('start_time', '')),
+                datetime.fromisoformat(form.get('end_time', '')))
+    except ValueError:
+        raise ValueError('Please enter a valid start and end time.')
+
+@route('/book/lot/<int:lot_id>/ahead', methods=['GET', 'POST'])
+@auth_required
+def book_ahead(lot_id):
+    """Books a spot in the lot for a future time window."""
+    lot = ParkingLot.query.get_or_404(lot_id)
+
     if request.method == 'POST':
         vehicle_number = request.form.get('vehicle_number')
-        if not vehicle_number:
-            flash('Vehicle number is required.', 'danger')
-            return redirect(url_for('book_spot', spot_id=spot_id))
-
-        
-        new_reservation = Reservation(
-            user_id=session['user_id'],
-            spot_id=spot.id,
-            vechile_number=vehicle_number
-        )
-        
-        
-        spot.status = 'O'
-        
-        db.session.add(new_reservation)
-        db.session.commit()
-        
-        flash(f'Spot {spot.spot_number} at {spot.parking_lot.prime_location_name} booked successfully!', 'success')
+        try:
+            if not vehicle_number:
+                raise ValueError('Vehicle number is required.')
+            start, end = _parse_window(request.form)
+            booking = bookings.book(lot.id, session['user_id'], start, end, vehicle_number)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('book_ahead.html', lot=lot, form=request.form, title="Book Ahead")
+        if not booking:
+            flash(f'No spot at {lot.prime_location_name} is free for that whole window.', 'warning')
+            return render_template('book_ahead.html', lot=lot, form=request.form, title="Book Ahead")
+
+        estimate = billing.quote(lot, start, end)
+        flash(f'Spot {booking.parking_spot.spot_number} at {lot.prime_location_name} is booked from '
+              f'{start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M} (estimated ₹{estimate:.2f}).', 'success')
+        return redirect(url_for('user_dashboard'))
+
+    return render_template('book_ahead.html', lot=lot, form={}, title="Book Ahead")
+
+@route('/booking/<int:booking_id>/cancel', methods=['POST'])
+@auth_required
+def cancel_booking(booking_id):
+    if bookings.cancel(booking_id, session['user_id']):
+        flash('Booking cancelled.', 'success')
+    else:
+        flash('That booking could not be cancelled.', 'danger')
+    return redirect(url_for('user_dashboard'))
+
+@route('/booking/<int:booking_id>/check-in', methods=['POST'])
+@auth_required
+def check_in_booking(booking_id):
+    booking = AdvanceBooking.query.get_or_404(booking_id)
+    if booking.user_id != session['user_id']:
+        flash('That booking could not be found.', 'danger')
+        return redirect(url_for('user_dashboard'))
+    try:
+        reservation = bookings.check_in(booking)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('user_dashboard'))
+    if not reservation:
+        flash('Sorry, no spot is free for the rest of your booking right now.', 'warning')
         return redirect(url_for('user_dashboard'))
-        
-    return render_template('book_spot.html', spot=spot, title="Book Spot")
 
-@app.route('/release/<int:reservation_id>', methods=['GET', 'POST'])
+    flash(f'Checked in at spot {reservation.parking_spot.spot_number}.', 'success')
+    return redirect(url_for('user_dashboard'))
+
+@route('/release/<int:reservation_id>', methods=['GET', 'POST'])
 @auth_required
 def release_spot(reservation_id):
-    reservation = Reservation.query.get_or_404(reservation_id)
-    
+    reservation = get_reservation(reservation_id)
+    if reservation is None:
+        abort(404)
     
-    if reservation.user_id != session['user_id'] or reservation.leaving_timestamp is not None:
-        flash('Invalid reservation or already released.', 'danger')
+    now = datetime.utcnow()
+    try:
+        if request.method == 'POST':
+            allocation.release_spot(reservation, session['user_id'], now)
+            flash('Spot released successfully. Thank you!', 'success')
+            return redirect(url_for('user_dashboard'))
+        cost = allocation.release_quote(reservation, session['user_id'], now)
+    except allocation.BookingRefused as e:
+        flash(str(e), 'danger')
         return redirect(url_for('user_dashboard'))
-        
-    
-    parking_duration = datetime.utcnow() - reservation.parking_timestamp
-    duration_hours = parking_duration.total_seconds() / 3600
-    price_per_hour = reservation.parking_spot.parking_lot.price
-    cost = duration_hours * price_per_hour
     
-    
-    total_minutes = int(parking_duration.total_seconds() / 60)
+    total_minutes = int((now - reservation.parking_timestamp).total_seconds() / 60)
     hours, minutes = divmod(total_minutes, 60)
     duration_str = f"{hours} hours, {minutes} minutes"
 
-    if request.method == 'POST':
-        
-        reservation.leaving_timestamp = datetime.utcnow()
-        reservation.parking_cost = cost
-        
-        
-        reservation.parking_spot.status = 'A'
-        
-        db.session.commit()
-        
-        flash('Spot released successfully. Thank you!', 'success')
-        return redirect(url_for('user_dashboard'))
-
     return render_template(
         'release_spot.html', 
         reservation=reservation, 
@@ -454,19 +807,11 @@ def release_spot(reservation_id):
         title="Release Spot"
     )
 
-@app.route('/summary')
+@route('/summary')
 @auth_required
 def user_summary():
     user_id = session['user_id']
-    
-    monthly_data = db.session.query(
-        db.func.strftime('%Y-%m', Reservation.parking_timestamp),
-        db.func.count(Reservation.id)
-    ).filter_by(user_id=user_id).group_by(db.func.strftime('%Y-%m', Reservation.parking_timestamp)).all()
-    
-    chart_data = {
-        "labels": [row[0] for row in monthly_data],
-        "values": [row[1] for row in monthly_data]
-    }
+    chart_data = cache.summaries.get_or_set(cache.user_summary_key(user_id),
+                                            lambda: reports.user_monthly_counts(user_id))
     
     return render_template('user_summary.html', chart_data=chart_data, title="Your Summary")
@@ -0,0 +1,219 @@
+"""In-process search indexes for users and parking lots.
+
+Leading-wildcard ILIKE cannot use a B-tree index, so every search used to
+scan the whole table. Instead, usernames and lot names are kept in a
+trigram index (every 3-character substring maps to the ids that contain
+it): a query intersects the postings of its trigrams and only the few
+surviving candidates are checked for the full substring. Queries shorter
+than three characters scan the in-memory texts. Pin codes are kept sorted
+for prefix lookups with bisect.
+
+Indexes are built lazily on first use, updated by the routes that write
+users and lots, and rebuilt in the background once older than
+``SEARCH_INDEX_MAX_AGE`` seconds so each worker process picks up changes
+made by the others.
+"""
+import bisect
+import threading
+import time
+
+from flask import current_app
+
+from models import db, User, ParkingLot
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _rank(text, query):
+    """Lower is better: exact match, then prefix, then word start, then anywhere; shorter texts first."""
+    if text == query:
+        position = 0
+    elif text.startswith(query):
+        position = 1
+    elif f' {query}' in text:
+        position = 2
+    else:
+        position = 3
+    return position, len(text)
+
+
+class TrigramIndex:
+
+    def __init__(self, load_rows):
+        self._load_rows = load_rows  # callable returning [(id, text)] from the database
+        self._lock = threading.Lock()
+        self._texts = {}     # id -> lowercased text
+        self._postings = {}  # trigram -> set of ids
+        self._built_at = None
+        self._rebuilding = False
+
+    def _index(self, doc_id, text):
+        self._texts[doc_id] = text
+        for gram in _trigrams(text):
+            self._postings.setdefault(gram, set()).add(doc_id)
+
+    def _unindex(self, doc_id):
+        text = self._texts.pop(doc_id, None)
+        if text is None:
+            return
+        for gram in _trigrams(text):
+            postings = self._postings.get(gram)
+            if postings:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._postings[gram]
+
+    def rebuild(self):
+        fresh = TrigramIndex(self._load_rows)
+        for doc_id, text in self._load_rows():
+            fresh._index(doc_id, (text or '').lower())
+        with self._lock:
+            self._texts, self._postings = fresh._texts, fresh._postings
+            self._built_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        if self._built_at is None:
+            self.rebuild()
+            return
+        max_age = current_app.config.get('SEARCH_INDEX_MAX_AGE')
+        if max_age is None or time.monotonic() - self._built_at < max_age or self._rebuilding:
+            return
+        # Serve from the current index while a background thread rebuilds it.
+        self._rebuilding = True
+        app = current_app._get_current_object()
+
+        def rebuild_in_background():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild_in_background, daemon=True).start()
+
+    def put(self, doc_id, text):
+        if self._built_at is None:
+            return  # not built yet; the first search loads everything
+        with self._lock:
+            self._unindex(doc_id)
+            self._index(doc_id, (text or '').lower())
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._unindex(doc_id)
+
+    def search(self, query):
+        """Returns the ids whose text contains query, best match first."""
+        self._ensure_fresh()
+        query = query.lower()
+        if not query:
+            return []
+        with self._lock:
+            if len(query) < 3:
+                candidates = self._texts
+            else:
+                postings = sorted((self._postings.get(gram, set()) for gram in _trigrams(query)), key=len)
+                candidates = postings[0].intersection(*postings[1:])
+            matches = [(doc_id, self._texts[doc_id]) for doc_id in candidates if query in self._texts[doc_id]]
+        matches.sort(key=lambda match: (_rank(match[1], query), match[0]))
+        return [doc_id for doc_id, _text in matches]
+
+
+class PrefixIndex:
+    """Sorted (key, id) pairs; prefix lookups are two bisects. Cheap enough to rebuild inline when stale."""
+
+    def __init__(self, load_rows):
+        self._load_rows = load_rows
+        self._lock = threading.Lock()
+        self._entries = []
+        self._keys = {}  # id -> key
+        self._built_at = None
+
+    def rebuild(self):
+        rows = [(key or '', doc_id) for doc_id, key in self._load_rows()]
+        rows.sort()
+        with self._lock:
+            self._entries = rows
+            self._keys = {doc_id: key for key, doc_id in rows}
+            self._built_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        max_age = current_app.config.get('SEARCH_INDEX_MAX_AGE')
+        if self._built_at is None or (max_age is not None and time.monotonic() - self._built_at >= max_age):
+            self.rebuild()
+
+    def put(self, doc_id, key):
+        if self._built_at is None:
+            return
+        with self._lock:
+            self._remove(doc_id)
+            bisect.insort(self._entries, (key or '', doc_id))
+            self._keys[doc_id] = key or ''
+
+    def _remove(self, doc_id):
+        key = self._keys.pop(doc_id, None)
+        if key is not None:
+            position = bisect.bisect_left(self._entries, (key, doc_id))
+            if position < len(self._entries) and self._entries[position] == (key, doc_id):
+                del self._entries[position]
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def search(self, prefix):
+        self._ensure_fresh()
+        if not prefix:
+            return []
+        with self._lock:
+            start = bisect.bisect_left(self._entries, (prefix,))
+            end = bisect.bisect_left(self._entries, (prefix + '\uffff',))
+            return [doc_id for _key, doc_id in self._entries[start:end]]
+
+
+usernames = TrigramIndex(lambda: db.session.query(User.id, User.username).all())
+lot_names = TrigramIndex(lambda: db.session.query(ParkingLot.id, ParkingLot.prime_location_name).all())
+pin_codes = PrefixIndex(lambda: db.session.query(ParkingLot.id, ParkingLot.pin_code).all())
+
+
+def paginate(ids, page, per_page):
+    """Returns (ids on the page, total number of ids)."""
+    page = max(page, 1)
+    return ids[(page - 1) * per_page:page * per_page], len(ids)
+
+
+def search_users(query, page=1, per_page=20):
+    """Users whose username contains query, ranked. Returns (users, total)."""
+    ids, total = paginate(usernames.search(query), page, per_page)
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return [users[i] for i in ids if i in users], total
+
+
+def matching_lot_ids(query):
+    """Ids of lots whose pin code starts with query, then of lots whose name contains it."""
+    ranked = pin_codes.search(query.strip())
+    seen = set(ranked)
+    return ranked + [lot_id for lot_id in lot_names.search(query) if lot_id not in seen]
+
+
+def search_lots(query, page=1, per_page=20):
+    """Lots whose pin code starts with query, then lots whose name contains it. Returns (lots, total)."""
+    ids, total = paginate(matching_lot_ids(query), page, per_page)
+    lots = {lot.id: lot for lot in ParkingLot.query.filter(ParkingLot.id.in_(ids))}
+    return [lots[i] for i in ids if i in lots], total
+
+
+def index_user(user):
+    usernames.put(user.id, user.username)
+
+
+def index_lot(lot):
+    lot_names.put(lot.id, lot.prime_location_name)
+    pin_codes.put(lot.id, lot.pin_code)
+
+
+def unindex_lot(lot_id):
+    lot_names.remove(lot_id)
+    pin_codes.remove(lot_id)
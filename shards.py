@@ -0,0 +1,192 @@
+"""Lot-sharded storage.
+
+With ``LOT_SHARDS`` set, every lot is assigned to a shard: a separate
+database (a SQLAlchemy bind) that holds the lot's spots, reservations,
+advance bookings, summaries and rollups. Users, lots and tariffs stay in
+the default database, which is also the shard of lots without an
+assignment, so an existing database keeps working when shards are added.
+Bookings and releases only write to their lot's shard, so lots on
+different shards never wait on each other's write locks.
+
+``use(name)`` makes a shard current; ``db.session`` then sends statements
+on sharded tables to it (see models.ShardedSession). Requests whose URL
+names a lot, spot, reservation or booking get that shard automatically.
+Spot, reservation and booking ids are allocated in per-shard ranges, so
+the id alone identifies the shard. Admin aggregates call ``gather``, which
+runs a query on every shard concurrently, and merge the results.
+
+Commits that touch the default database and a shard (e.g. deleting a lot)
+are two commits, not one atomic transaction. Moving a lot between shards
+is not supported.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import current_app, g
+from sqlalchemy import func
+
+from models import db, current_shard, ParkingLot, LotShard, SHARD_ID_SPAN
+import instrumentation
+
+
+class LotShardCache:
+    """lot_id -> shard name for this worker process. A lot never changes shard, so entries never expire."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shards = {}
+
+    def get(self, lot_id):
+        try:
+            return True, self._shards[lot_id]
+        except KeyError:
+            return False, None
+
+    def put(self, lot_id, name):
+        with self._lock:
+            self._shards[lot_id] = name
+
+    def forget(self, lot_id):
+        with self._lock:
+            self._shards.pop(lot_id, None)
+
+
+lot_shards = LotShardCache()
+
+
+def enabled():
+    return bool(current_app.config.get('LOT_SHARDS'))
+
+
+def names():
+    """Every shard, the default database (None) first, in id-range order."""
+    return [None] + list(current_app.config.get('LOT_SHARDS', []))
+
+
+def current():
+    return current_shard.get()
+
+
+@contextmanager
+def use(name):
+    """Makes name (None for the default database) the current shard inside the block."""
+    token = current_shard.set(name)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+def for_lot(lot_id):
+    """The shard holding the lot's spots; None for the default database or an unknown lot."""
+    found, name = lot_shards.get(lot_id)
+    if found:
+        return name
+    row = db.session.query(ParkingLot.id, LotShard.shard)\
+                    .outerjoin(LotShard, LotShard.lot_id == ParkingLot.id)\
+                    .filter(ParkingLot.id == lot_id).first()
+    if row is None:
+        return None  # not cached: the lot may be created later
+    lot_shards.put(lot_id, row[1])
+    return row[1]
+
+
+def for_id(row_id):
+    """The shard holding a spot, reservation or booking id, from the range it was allocated in."""
+    all_names = names()
+    index = row_id // SHARD_ID_SPAN if row_id and row_id > 0 else 0
+    return all_names[index] if index < len(all_names) else None
+
+
+def assign(lot_ids, name=None):
+    """Assigns new lots to a shard, staged in the current transaction. Returns {lot_id: shard name}.
+
+    Without a name each lot goes to the shard with the fewest lots at the time.
+    """
+    order = names()
+    if name is not None and name not in order:
+        raise ValueError(f'Unknown shard "{name}"')
+    lot_ids = list(lot_ids)
+    balance = name is None and enabled()
+    if balance:
+        counts = dict.fromkeys(order, 0)
+        counts.update(db.session.query(LotShard.shard, func.count(LotShard.lot_id)).group_by(LotShard.shard).all())
+        # Lots without an assignment are in the default database; the ones being assigned are not counted.
+        counts[None] = db.session.query(func.count(ParkingLot.id)).filter(ParkingLot.id.notin_(lot_ids)).scalar()\
+            - sum(counts.values())
+    placed = {}
+    for lot_id in lot_ids:
+        if balance:
+            chosen = min(order, key=lambda shard: counts[shard])
+            counts[chosen] += 1
+        else:
+            chosen = name
+        if chosen is not None:
+            db.session.add(LotShard(lot_id=lot_id, shard=chosen))
+        placed[lot_id] = chosen
+    return placed
+
+
+def forget(lot_id):
+    lot_shards.forget(lot_id)
+
+
+def lot_ids(name):
+    """Ids of the lots stored in the shard."""
+    query = db.session.query(ParkingLot.id).outerjoin(LotShard, LotShard.lot_id == ParkingLot.id)
+    query = query.filter(LotShard.shard.is_(None)) if name is None else query.filter(LotShard.shard == name)
+    return [row[0] for row in query.order_by(ParkingLot.id)]
+
+
+def gather(func, *args):
+    """Calls func(*args) once per shard, concurrently, and returns the results in names() order.
+
+    Each call runs in its own thread, app context and session with its shard
+    current, so func should return plain rows or fully loaded objects. Without
+    shards func is simply called once, here.
+    """
+    if not enabled():
+        return [func(*args)]
+    app = current_app._get_current_object()
+
+    def call(name):
+        with app.app_context(), use(name), instrumentation.count_queries() as counter:
+            return func(*args), counter
+
+    # A pool per call rather than a shared one, so a gathered function may itself gather.
+    all_names = names()
+    with ThreadPoolExecutor(max_workers=len(all_names), thread_name_prefix='shard-gather') as executor:
+        results = list(executor.map(call, all_names))
+    # Counted here, so the request's profile and query budgets include every shard's queries.
+    for _result, counter in results:
+        instrumentation.add_counted(counter)
+    return [result for result, _counter in results]
+
+
+def _route_request(endpoint, values):
+    if not values or not enabled():
+        return
+    if 'lot_id' in values:
+        name = for_lot(values['lot_id'])
+    else:
+        row_id = values.get('spot_id', values.get('reservation_id', values.get('booking_id')))
+        if row_id is None:
+            return
+        name = for_id(row_id)
+    g.shard_token = current_shard.set(name)
+
+
+def _reset_shard(exc):
+    token = g.pop('shard_token', None)
+    if token is not None:
+        current_shard.reset(token)
+
+
+def init_app(app):
+    app.url_value_preprocessor(_route_request)
+    app.teardown_request(_reset_shard)
+
+    @app.context_processor
+    def shard_names():
+        return {"lot_shards": app.config['LOT_SHARDS']}
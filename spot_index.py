@@ -0,0 +1,134 @@
+"""In-memory free-spot index.
+
+Keeps, per parking lot, the set of free spot ids plus a stack of claim
+candidates, so "next free spot" and "free count" cost O(1) regardless of
+lot size. The database stays authoritative: allocation still claims spots
+with a conditional UPDATE, and the index is only a fast hint. A lot is
+loaded from ``parking_spots`` the first time it is used, so startup does
+not read every spot.
+
+Each worker process has its own index, so a lot is reloaded from the
+database once its entry is older than ``FREE_SPOT_INDEX_MAX_AGE`` seconds;
+this picks up lots created and spots booked by other workers.
+"""
+import threading
+import time
+
+from flask import current_app
+
+from models import db, ParkingSpot
+import shards
+
+
+class FreeSpotIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = {}       # lot_id -> set of free spot ids
+        self._stack = {}      # lot_id -> list of candidate spot ids (may hold stale entries)
+        self._spot_lot = {}   # spot_id -> lot_id
+        self._loaded_at = {}  # lot_id -> time.monotonic() of the last load from the database
+
+    def _load_lot(self, lot_id):
+        with shards.use(shards.for_lot(lot_id)):
+            rows = db.session.query(ParkingSpot.id, ParkingSpot.status)\
+                             .filter_by(lot_id=lot_id)\
+                             .order_by(ParkingSpot.spot_number.desc()).all()
+        with self._lock:
+            for spot_id, _status in rows:
+                self._spot_lot[spot_id] = lot_id
+            self._free[lot_id] = {spot_id for spot_id, status in rows if status == 'A'}
+            self._stack[lot_id] = [spot_id for spot_id, status in rows if status == 'A']
+            self._loaded_at[lot_id] = time.monotonic()
+
+    def _refresh_if_stale(self, lot_id):
+        max_age = current_app.config.get('FREE_SPOT_INDEX_MAX_AGE')
+        loaded_at = self._loaded_at.get(lot_id)
+        if loaded_at is None or (max_age is not None and time.monotonic() - loaded_at >= max_age):
+            self._load_lot(lot_id)
+
+    def add_lot(self, lot_id, spot_ids):
+        """Registers new free spots of a lot, in spot_number order.
+
+        Only a lot this worker has loaded is extended; any other is read whole
+        from the database on first use, new spots included.
+        """
+        with self._lock:
+            if lot_id not in self._loaded_at:
+                return
+            for spot_id in spot_ids:
+                self._spot_lot[spot_id] = lot_id
+                self._free[lot_id].add(spot_id)
+            self._stack[lot_id].extend(reversed(spot_ids))
+
+    def remove_lot(self, lot_id):
+        with self._lock:
+            self._free.pop(lot_id, None)
+            self._stack.pop(lot_id, None)
+            self._loaded_at.pop(lot_id, None)
+            self._spot_lot = {s: l for s, l in self._spot_lot.items() if l != lot_id}
+
+    def remove_spot(self, spot_id):
+        with self._lock:
+            lot_id = self._spot_lot.pop(spot_id, None)
+            if lot_id is not None:
+                self._free[lot_id].discard(spot_id)
+
+    def take(self, lot_id, skip=()):
+        """Removes and returns a free spot id of the lot not in skip, or None if none is known to be free."""
+        self._refresh_if_stale(lot_id)
+        with self._lock:
+            free = self._free.get(lot_id)
+            stack = self._stack.get(lot_id)
+            skipped = []
+            taken = None
+            while stack:
+                spot_id = stack.pop()
+                if spot_id in free:
+                    if spot_id in skip:
+                        skipped.append(spot_id)
+                        continue
+                    free.discard(spot_id)
+                    taken = spot_id
+                    break
+            stack.extend(reversed(skipped))
+            return taken
+
+    def mark_occupied(self, spot_id):
+        with self._lock:
+            lot_id = self._spot_lot.get(spot_id)
+            if lot_id is not None:
+                self._free[lot_id].discard(spot_id)
+
+    def mark_free(self, spot_id):
+        with self._lock:
+            lot_id = self._spot_lot.get(spot_id)
+            if lot_id is not None and spot_id not in self._free[lot_id]:
+                free, stack = self._free[lot_id], self._stack[lot_id]
+                free.add(spot_id)
+                stack.append(spot_id)
+                if len(stack) > 2 * len(free) + 64:
+                    # Drop stale entries left behind by mark_occupied so the stack stays bounded.
+                    seen = set()
+                    self._stack[lot_id] = [s for s in stack if s in free and not (s in seen or seen.add(s))]
+
+    def lot_of(self, spot_id):
+        return self._spot_lot.get(spot_id)
+
+    def free_count(self, lot_id):
+        self._refresh_if_stale(lot_id)
+        with self._lock:
+            return len(self._free.get(lot_id, ()))
+
+    def next_free(self, lot_id):
+        """Peeks at the spot take() would hand out, without claiming it."""
+        self._refresh_if_stale(lot_id)
+        with self._lock:
+            free = self._free.get(lot_id)
+            stack = self._stack.get(lot_id)
+            while stack and stack[-1] not in free:
+                stack.pop()
+            return stack[-1] if stack else None
+
+
+free_spots = FreeSpotIndex()
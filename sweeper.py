@@ -0,0 +1,218 @@
+"""Background sweep of overstayed reservations and no-show bookings.
+
+Every ``SWEEP_INTERVAL`` seconds a daemon thread in each worker process
+walks the active reservations parked for longer than
+``OVERSTAY_LIMIT_HOURS``, oldest first, through a partial index on active
+reservations. By default it flags them for an admin; with
+``OVERSTAY_ACTION=release`` it releases them instead, priced by the lot's
+tariff exactly as release_spot would. Releasing is opt-in because it ends
+and charges customers' stays. Advance bookings whose window passed
+without a check-in are marked expired.
+
+Work is done in batches of ``SWEEP_BATCH_SIZE`` rows, one short
+transaction each, with a pause in between so request handlers are never
+kept waiting on the database for long. Every write is conditional, so
+several workers sweeping at once cannot release anything twice. With lot
+shards each shard is swept in turn.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import exists, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, ParkingSpot, Reservation, AdvanceBooking, OverstayFlag
+from allocation import release_reservations
+import billing
+import shards
+
+
+BATCH_PAUSE_SECONDS = 0.05
+
+
+class SweepStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.errors = 0
+        self.released = 0
+        self.flagged = 0
+        self.expired_bookings = 0
+        self.last_started_at = None
+        self.last_duration = None
+        self.last_rows = 0
+        self.last_error = None
+
+    def record(self, started_at, duration, released=0, flagged=0, expired_bookings=0, error=None):
+        with self._lock:
+            self.runs += 1
+            self.released += released
+            self.flagged += flagged
+            self.expired_bookings += expired_bookings
+            self.last_started_at = started_at
+            self.last_duration = duration
+            self.last_rows = released + flagged + expired_bookings
+            if error is not None:
+                self.errors += 1
+                self.last_error = error
+
+    def stats(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "errors": self.errors,
+                "released": self.released,
+                "flagged": self.flagged,
+                "expired_bookings": self.expired_bookings,
+                "last_started_at": self.last_started_at.isoformat() if self.last_started_at else None,
+                "last_duration_seconds": self.last_duration,
+                "last_rows": self.last_rows,
+                "last_error": self.last_error,
+            }
+
+
+stats = SweepStats()
+
+
+def _overstayed(cutoff, batch_size, unflagged_only):
+    query = db.session.query(Reservation.id, ParkingSpot.lot_id, Reservation.parking_timestamp)\
+                      .join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
+                      .filter(Reservation.leaving_timestamp.is_(None), Reservation.parking_timestamp < cutoff)
+    if unflagged_only:
+        query = query.filter(~exists().where(OverstayFlag.reservation_id == Reservation.id))
+    return query.order_by(Reservation.parking_timestamp).limit(batch_size).all()
+
+
+def release_overstays(cutoff, now, batch_size):
+    """Releases reservations parked before cutoff, charging them up to now. Returns the number released."""
+    total = 0
+    while True:
+        rows = _overstayed(cutoff, batch_size, unflagged_only=False)
+        if not rows:
+            return total
+        ids, lot_ids, parked = zip(*rows)
+        costs = billing.price(np.array(parked, dtype='datetime64[us]'), np.datetime64(now, 'us'),
+                              **billing.lot_parameters(np.array(lot_ids)))
+        released = release_reservations(dict(zip(ids, costs.tolist())), now)
+        total += released
+        if released == 0 or len(rows) < batch_size:
+            return total  # 0: locked out on every attempt; try again next sweep
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+
+def _insert_flags(reservation_ids, now):
+    """Flags the reservations, skipping any another worker's sweep flagged since they were read."""
+    dialect = db.session.get_bind(mapper=OverstayFlag).dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        return dialect_insert(OverstayFlag).values([{"reservation_id": reservation_id, "flagged_at": now}
+                                                    for reservation_id in reservation_ids]).on_conflict_do_nothing()
+    return insert(OverstayFlag).from_select(
+        ['reservation_id', 'flagged_at'],
+        select(Reservation.id, literal(now)).where(Reservation.id.in_(reservation_ids),
+                                                   ~exists().where(OverstayFlag.reservation_id == Reservation.id)),
+    )
+
+
+def flag_overstays(cutoff, now, batch_size):
+    """Flags unflagged reservations parked before cutoff. Returns the number flagged."""
+    total = 0
+    while True:
+        rows = _overstayed(cutoff, batch_size, unflagged_only=True)
+        if not rows:
+            return total
+        result = db.session.execute(_insert_flags([row[0] for row in rows], now))
+        db.session.commit()
+        total += result.rowcount
+        if len(rows) < batch_size:
+            return total
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+
+def expire_bookings(now, batch_size):
+    """Marks advance bookings whose window ended without a check-in as expired."""
+    total = 0
+    while True:
+        ids = [row[0] for row in db.session.query(AdvanceBooking.id)
+               .filter(AdvanceBooking.status == 'B', AdvanceBooking.end_time <= now)
+               .limit(batch_size)]
+        if not ids:
+            return total
+        result = db.session.execute(
+            update(AdvanceBooking)
+            .where(AdvanceBooking.id.in_(ids), AdvanceBooking.status == 'B')
+            .values(status='E')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        total += result.rowcount
+        if len(ids) < batch_size:
+            return total
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+
+def sweep(now=None):
+    """One pass. Needs an app context; returns this pass's counts and records them in stats."""
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    config = current_app.config
+    counts = {"released": 0, "flagged": 0, "expired_bookings": 0}
+    try:
+        for name in shards.names():
+            with shards.use(name):
+                if config['OVERSTAY_LIMIT_HOURS'] is not None:
+                    cutoff = now - timedelta(hours=config['OVERSTAY_LIMIT_HOURS'])
+                    if config['OVERSTAY_ACTION'] == 'release':
+                        counts["released"] += release_overstays(cutoff, now, config['SWEEP_BATCH_SIZE'])
+                    else:
+                        counts["flagged"] += flag_overstays(cutoff, now, config['SWEEP_BATCH_SIZE'])
+                counts["expired_bookings"] += expire_bookings(now, config['SWEEP_BATCH_SIZE'])
+    except Exception as e:
+        db.session.rollback()
+        stats.record(now, time.perf_counter() - started, error=repr(e), **counts)
+        raise
+    stats.record(now, time.perf_counter() - started, **counts)
+    return counts
+
+
+class Sweeper:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, app):
+        """Starts this process's sweeper thread once; forked workers each start their own."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(app,), daemon=True)
+                self._thread.start()
+
+    def _run(self, app):
+        while True:
+            time.sleep(app.config['SWEEP_INTERVAL'])
+            try:
+                with app.app_context():
+                    sweep()
+            except Exception:
+                app.logger.exception('Overstay sweep failed')
+
+
+sweeper = Sweeper()
+
+
+def init_app(app):
+    if not app.config['SWEEP_INTERVAL']:
+        return
+
+    @app.before_request
+    def start_sweeper():
+        # Started from the first request rather than at import, so it runs in
+        # the worker processes and not in a preloading gunicorn master.
+        sweeper.start(app)
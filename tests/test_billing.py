@@ -0,0 +1,88 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import billing
+
+MONDAY = datetime(2024, 1, 1)
+
+
+def _price(parked, left, hourly=10.0, **tariff):
+    return float(billing.price([parked], [left], hourly, **tariff)[0])
+
+
+def _reference(parked, left, hourly, night_price=None, minimum_charge=None, daily_cap=None,
+               night_start=22, night_end=6):
+    """Minute by minute: each full 24 hours from parked is capped, then the rest once."""
+    def rate(t):
+        hour = t.hour
+        at_night = (hour >= night_start or hour < night_end) if night_start > night_end \
+            else night_start <= hour < night_end
+        return night_price if at_night and night_price is not None else hourly
+
+    cost, day_cost, minutes = 0.0, 0.0, 0
+    t = parked
+    while t < left:
+        day_cost += rate(t) / 60
+        minutes += 1
+        t += timedelta(minutes=1)
+        if minutes % (24 * 60) == 0:
+            cost += min(day_cost, daily_cap) if daily_cap is not None else day_cost
+            day_cost = 0.0
+    cost += min(day_cost, daily_cap) if daily_cap is not None else day_cost
+    return max(cost, minimum_charge) if minimum_charge is not None else cost
+
+
+def test_hourly_price_without_a_tariff():
+    assert _price(MONDAY, MONDAY + timedelta(hours=2, minutes=30)) == pytest.approx(25)
+
+
+def test_stay_wrapping_the_night_window():
+    # 20:00 to 02:00 under a 22:00-06:00 night rate: 2 day hours and 4 night hours.
+    parked = MONDAY + timedelta(hours=20)
+    assert _price(parked, parked + timedelta(hours=6), night_price=4) == pytest.approx(2 * 10 + 4 * 4)
+
+
+def test_night_window_within_the_day():
+    # A 01:00-05:00 window that does not cross midnight.
+    assert _price(MONDAY, MONDAY + timedelta(hours=6), night_price=2, night_start=1, night_end=5) \
+        == pytest.approx(2 * 10 + 4 * 2)
+
+
+def test_daily_cap_applies_to_each_full_day_and_the_remainder():
+    left = MONDAY + timedelta(days=3, hours=5)
+    assert _price(MONDAY, left) == pytest.approx(77 * 10)
+    assert _price(MONDAY, left, daily_cap=150) == pytest.approx(3 * 150 + 50)
+    assert _price(MONDAY, left, daily_cap=40) == pytest.approx(4 * 40)
+
+
+def test_minimum_charge():
+    assert _price(MONDAY, MONDAY + timedelta(minutes=10), minimum_charge=20) == pytest.approx(20)
+    assert _price(MONDAY, MONDAY + timedelta(hours=3), minimum_charge=20) == pytest.approx(30)
+    # A stay that ends before it starts costs nothing, or the minimum.
+    assert _price(MONDAY, MONDAY - timedelta(hours=1)) == 0
+    assert _price(MONDAY, MONDAY - timedelta(hours=1), minimum_charge=5) == pytest.approx(5)
+
+
+def test_tariffs_broadcast_per_stay():
+    parked = np.array([MONDAY, MONDAY, MONDAY], dtype='datetime64[us]')
+    left = parked + np.timedelta64(30, 'h')
+    costs = billing.price(parked, left, np.array([10.0, 10.0, 20.0]),
+                          daily_cap=np.array([np.nan, 100.0, np.nan]),
+                          minimum_charge=np.array([np.nan, np.nan, 1000.0]))
+    assert costs.tolist() == pytest.approx([300, 100 + 60, 1000])
+
+
+def test_matches_a_minute_by_minute_reference():
+    rng = random.Random(13)
+    for _ in range(40):
+        parked = MONDAY + timedelta(minutes=rng.randrange(0, 7 * 24 * 60))
+        left = parked + timedelta(minutes=rng.randrange(1, 4 * 24 * 60))
+        tariff = dict(night_price=rng.choice([None, 3.0]), minimum_charge=rng.choice([None, 25.0]),
+                      daily_cap=rng.choice([None, 120.0]), night_start=rng.choice([22, 1, 18]),
+                      night_end=rng.choice([6, 5, 23]))
+        expected = _reference(parked, left, 10.0, **tariff)
+        arguments = {key: np.nan if value is None else value for key, value in tariff.items()}
+        assert _price(parked, left, **arguments) == pytest.approx(expected, abs=0.01), (parked, left, tariff)
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from models import db, AdvanceBooking, ParkingSpot, Reservation
+from booking_index import booking_index
+import allocation
+import bookings
+
+
+def test_releasing_early_frees_the_rest_of_the_window(app, add_lot, add_user):
+    lot_id = add_lot('Early Garage', 1)
+    _client, user_id = add_user('early1')
+    now = datetime.utcnow()
+    start, end = now, now + timedelta(hours=4)
+    with app.app_context():
+        booking = bookings.book(lot_id, user_id, start, end, 'KA02-EARLY')
+        reservation = bookings.check_in(booking, now)
+        spot_id = reservation.spot_id
+        allocation.release_spot(reservation, user_id, now + timedelta(hours=1))
+
+        left = now + timedelta(hours=1)
+        assert db.session.get(AdvanceBooking, booking.id).end_time == left
+        assert booking_index.is_free(spot_id, left, end)
+        assert allocation.held_for_bookings(lot_id, left) == set()
+        # The one spot can be booked again for the rest of the window.
+        assert bookings.book(lot_id, user_id, left + timedelta(minutes=5), end, 'KA02-NEXT').spot_id == spot_id
+        assert db.session.get(Reservation, reservation.id).leaving_timestamp == left
+
+
+def _brute_force_held(windows, start, end):
+    return {spot_id for spot_id, window_start, window_end in windows if window_start < end and window_end > start}
+
+
+def test_interval_index_matches_a_scan(app, add_lot, add_user):
+    lot_id = add_lot('Interval Garage', 6)
+    _client, user_id = add_user('interval1')
+    now = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        for offset in range(40):
+            start = now + timedelta(hours=offset * 7 % 50)
+            bookings.book(lot_id, user_id, start, start + timedelta(hours=1 + offset % 9), f'KA03-{offset}')
+        spot_ids = [row[0] for row in db.session.query(ParkingSpot.id).filter_by(lot_id=lot_id)]
+        windows = [(b.spot_id, b.start_time, b.end_time) for b in AdvanceBooking.query.filter(
+            AdvanceBooking.spot_id.in_(spot_ids), AdvanceBooking.status == 'B')]
+        assert len(windows) >= 30  # most requests found a spot
+
+        for reloaded in (False, True):
+            if reloaded:
+                booking_index.invalidate(lot_id)
+            for hour in range(0, 60, 3):
+                start = now + timedelta(hours=hour, minutes=30)
+                end = start + timedelta(hours=hour % 5 + 1)
+                held = _brute_force_held(windows, start, end)
+                assert booking_index.held(lot_id, start, end) == held
+                assert set(booking_index.free_spots(lot_id, start, end)) == set(spot_ids) - held
+                assert all(booking_index.is_free(spot_id, start, end) == (spot_id not in held) for spot_id in spot_ids)
+
+
+def test_shrinking_a_lot_keeps_upcoming_bookings(app, admin_client, add_lot, add_user):
+    lot_id = add_lot('Shrink Garage', 3)
+    _client, user_id = add_user('shrink1')
+    start = datetime.utcnow() + timedelta(days=1)
+    with app.app_context():
+        booked = [bookings.book(lot_id, user_id, start, start + timedelta(hours=2), f'KA04-{n}').id for n in range(3)]
+        bookings.cancel(booked[2], user_id)
+
+    edit = {'prime_location_name': 'Shrink Garage', 'address': 'Shrink Garage Road', 'pin_code': '560099',
+            'price': '10'}
+    admin_client.post(f'/admin/parking_lot/edit/{lot_id}', data={**edit, 'maximum_number_of_spots': '1'})
+    with app.app_context():
+        assert db.session.query(ParkingSpot).filter_by(lot_id=lot_id).count() == 3
+        assert AdvanceBooking.query.filter(AdvanceBooking.id.in_(booked)).count() == 3
+
+    # Only the spot with the cancelled booking can go.
+    admin_client.post(f'/admin/parking_lot/edit/{lot_id}', data={**edit, 'maximum_number_of_spots': '2'})
+    with app.app_context():
+        assert db.session.query(ParkingSpot).filter_by(lot_id=lot_id).count() == 2
+        assert [b.status for b in AdvanceBooking.query.filter(AdvanceBooking.id.in_(booked))] == ['B', 'B']
@@ -0,0 +1,70 @@
+"""Many clients booking one lot at the same moment; benchmarks/concurrent_booking.py is the full-size run."""
+import threading
+
+from werkzeug.security import generate_password_hash
+
+from models import db, User, ParkingSpot, Reservation
+
+CLIENTS = 30
+
+
+def _clients(app, prefix):
+    with app.app_context():
+        password_hash = generate_password_hash('secret1')
+        users = [User(username=f'{prefix}{n}', password_hash=password_hash) for n in range(CLIENTS)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+    clients = []
+    for user_id in user_ids:
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['is_admin'] = False
+        clients.append(client)
+    return clients
+
+
+def _all_at_once(clients, url):
+    barrier = threading.Barrier(len(clients))
+    statuses = []
+
+    def book(n, client):
+        barrier.wait()
+        statuses.append(client.post(url, data={'vehicle_number': f'KA05-{n}'}).status_code)
+
+    threads = [threading.Thread(target=book, args=(n, client)) for n, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def _active_spots(app, lot_id):
+    with app.app_context():
+        return [row[0] for row in db.session.query(Reservation.spot_id)
+                .join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)
+                .filter(ParkingSpot.lot_id == lot_id, Reservation.leaving_timestamp.is_(None))]
+
+
+def test_no_spot_is_double_booked(app, add_lot):
+    lot_id = add_lot('Contested Garage', 20)
+    statuses = _all_at_once(_clients(app, 'racer'), f'/book/lot/{lot_id}')
+
+    booked_spots = _active_spots(app, lot_id)
+    double_booked = len(booked_spots) - len(set(booked_spots))
+    assert double_booked == 0
+    assert statuses == [302] * CLIENTS  # refused bookings redirect too
+    with app.app_context():
+        occupied = db.session.query(ParkingSpot).filter_by(lot_id=lot_id, status='O').count()
+    assert len(booked_spots) == occupied == 20
+
+
+def test_one_spot_goes_to_one_client(app, add_lot):
+    lot_id = add_lot('Single Spot Garage', 1)
+    with app.app_context():
+        spot_id = db.session.query(ParkingSpot.id).filter_by(lot_id=lot_id).scalar()
+    _all_at_once(_clients(app, 'sprinter'), f'/book/{spot_id}')
+
+    assert _active_spots(app, lot_id) == [spot_id]
@@ -0,0 +1,41 @@
+"""Query budgets for the busiest pages, so an N+1 fails the test run instead of slowing production.
+
+Each page is requested once first, so the per-process indexes are loaded,
+and caches are cleared before the measured request, so the budget covers
+the queries a cache miss runs.
+"""
+import pytest
+
+import cache
+
+
+def _get_uncached(client, url):
+    for c in cache.all_caches:
+        c.clear()
+    return client.get(url)
+
+
+def test_admin_grid_budget(admin_client, query_budget):
+    admin_client.get('/admin')
+    with query_budget(4):
+        assert _get_uncached(admin_client, '/admin').status_code == 200
+
+
+def test_admin_summary_budget(admin_client, query_budget):
+    admin_client.get('/admin/summary')
+    with query_budget(3):
+        assert _get_uncached(admin_client, '/admin/summary').status_code == 200
+
+
+def test_user_dashboard_budget(user_client, query_budget):
+    user_client.get('/dashboard?q=Lot')
+    with query_budget(4):
+        response = _get_uncached(user_client, '/dashboard?q=Lot')
+    assert response.status_code == 200
+    assert b'KA01-3' in response.data and b'Lot 3' in response.data
+
+
+def test_over_budget_fails(admin_client, query_budget):
+    with pytest.raises(pytest.fail.Exception, match='budget is 0'):
+        with query_budget(0):
+            admin_client.get('/admin/parking_lot/edit/1')
@@ -0,0 +1,80 @@
+"""The statements the booking, release, dashboard and admin paths actually run must be served by an index.
+
+Every statement is recorded as it is executed, then run again under
+EXPLAIN QUERY PLAN with the same parameters; a plan that scans one of the
+large tables without an index fails the test.
+"""
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, ParkingSpot, Reservation
+import allocation
+import cache
+import shards
+
+LARGE_TABLES = ('parking_spots', 'reservations', 'advance_bookings', 'overstay_flags')
+FULL_SCAN = re.compile(rf"^SCAN ({'|'.join(LARGE_TABLES)})$")
+
+
+@contextmanager
+def recorded_statements(app):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def _full_scans(app, statements):
+    found = {}
+    with app.app_context():
+        connection = db.session.connection()
+        for statement, parameters in statements:
+            plan = [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+            scans = [step for step in plan if FULL_SCAN.match(step)]
+            if scans:
+                found[' '.join(statement.split())] = scans
+        db.session.rollback()
+    return found
+
+
+def test_hot_paths_use_indexes(app, admin_client, add_lot, add_user):
+    lot_id = add_lot('Plan Garage', 4)
+    client, user_id = add_user('planner1')
+    with app.app_context():
+        spot_id = db.session.query(ParkingSpot.id).filter_by(lot_id=lot_id).order_by(ParkingSpot.spot_number).first()[0]
+    start = datetime.utcnow() + timedelta(days=1)
+    for c in cache.all_caches:
+        c.clear()
+
+    with recorded_statements(app) as statements:
+        client.get('/dashboard?q=Plan')
+        client.get(f'/book/{spot_id}')
+        client.post(f'/book/lot/{lot_id}', data={'vehicle_number': 'KA06-1'})
+        client.post(f'/book/lot/{lot_id}/ahead', data={
+            'vehicle_number': 'KA06-2', 'start_time': start.isoformat(timespec='minutes'),
+            'end_time': (start + timedelta(hours=2)).isoformat(timespec='minutes')})
+        client.get('/summary')
+        with app.app_context():
+            reservation_id = db.session.query(Reservation.id).filter_by(user_id=user_id).scalar()
+            with shards.use(shards.for_lot(lot_id)):
+                allocation._claim_any_spot_from_db(lot_id, user_id, 'KA06-3', set())
+        client.post(f'/release/{reservation_id}')
+        admin_client.get('/admin')
+        admin_client.get(f'/admin/parking_lot/{lot_id}/spots')
+        admin_client.get(f'/admin/spot/details/{spot_id}')
+        admin_client.post(f'/admin/parking_lot/delete/{lot_id}')  # refused: a spot is still occupied
+
+    assert len(statements) > 20
+    assert _full_scans(app, statements) == {}
@@ -0,0 +1,26 @@
+import pytest
+
+from spot_index import free_spots
+
+
+def _grow(admin_client, lot_id, name, spots):
+    admin_client.post(f'/admin/parking_lot/edit/{lot_id}', data={
+        'prime_location_name': name, 'address': f'{name} Road', 'pin_code': '560099', 'price': '10',
+        'maximum_number_of_spots': str(spots)})
+
+
+@pytest.mark.parametrize('loaded', [False, True])
+def test_growing_a_lot_keeps_its_existing_spots(app, admin_client, add_lot, monkeypatch, loaded):
+    monkeypatch.setitem(app.config, 'FREE_SPOT_INDEX_MAX_AGE', None)  # no reload to hide a wrong entry
+    name = f'Growing Garage {loaded}'
+    lot_id = add_lot(name, 5)
+    with app.app_context():
+        if loaded:
+            assert free_spots.free_count(lot_id) == 5
+        else:
+            free_spots.remove_lot(lot_id)  # as in a worker that has not used the lot yet
+        _grow(admin_client, lot_id, name, 8)
+        assert free_spots.free_count(lot_id) == 8
+        taken = [free_spots.take(lot_id) for _ in range(8)]
+        assert None not in taken and len(set(taken)) == 8
+        assert free_spots.take(lot_id) is None
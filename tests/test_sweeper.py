@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+
+from models import db, Reservation, OverstayFlag
+import sweeper
+
+
+def _overstayed_reservation(app, add_lot, add_user):
+    lot_id = add_lot('Sweep Garage', 2)
+    client, _user_id = add_user('late1')
+    client.post(f'/book/lot/{lot_id}', data={'vehicle_number': 'KA09-LATE'})
+    with app.app_context():
+        reservation = db.session.query(Reservation).filter_by(vechile_number='KA09-LATE').one()
+        reservation.parking_timestamp = datetime.utcnow() - timedelta(hours=48)
+        db.session.commit()
+        return reservation.id
+
+
+def test_concurrent_flag_passes_do_not_collide(app, add_lot, add_user, monkeypatch):
+    reservation_id = _overstayed_reservation(app, add_lot, add_user)
+    now = datetime.utcnow()
+    cutoff = now - timedelta(hours=24)
+    with app.app_context():
+        # One worker reads its batch, another worker flags the same rows, then the first inserts.
+        stale = sweeper._overstayed(cutoff, 200, unflagged_only=True)
+        assert [row[0] for row in stale] == [reservation_id]
+        assert sweeper.flag_overstays(cutoff, now, 200) == 1
+
+        batches = iter([stale])
+        monkeypatch.setattr(sweeper, '_overstayed', lambda *args, **kwargs: next(batches, []))
+        assert sweeper.flag_overstays(cutoff, now, 200) == 0
+        assert db.session.query(OverstayFlag).filter_by(reservation_id=reservation_id).count() == 1
@@ -0,0 +1,104 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, ParkingSpot, Reservation
+import write_behind
+
+
+def _write_log(path, events, torn=''):
+    with open(path, 'a', encoding='utf-8') as log_file:
+        for event in events:
+            log_file.write(json.dumps(event) + '\n')
+        log_file.write(torn)
+
+
+def _next_ids(app):
+    """The next free event seq and reservation id, past whatever earlier tests applied."""
+    with app.app_context():
+        seq = write_behind._checkpoint() or 0
+        reservation_id = db.session.query(db.func.max(Reservation.id)).scalar() or 0
+    return seq + 1, reservation_id + 100
+
+
+def _claim(seq, reservation_id, spot_id, lot_id, user_id, at):
+    return {"op": "claim", "reservation": reservation_id, "spot": spot_id, "lot": lot_id, "user": user_id,
+            "vehicle": f'KA07-{reservation_id}', "at": at.isoformat(), "seq": seq}
+
+
+def _release(seq, claim, at, cost):
+    return {"op": "release", "reservation": claim['reservation'], "spot": claim['spot'], "lot": claim['lot'],
+            "user": claim['user'], "parked": claim['at'], "at": at.isoformat(), "cost": cost, "seq": seq}
+
+
+@pytest.fixture
+def write_behind_config(app, monkeypatch, tmp_path):
+    path = str(tmp_path / 'bookings.log')
+    monkeypatch.setitem(app.config, 'WRITE_BEHIND_LOG', path)
+    monkeypatch.setitem(app.config, 'WRITE_BEHIND_INTERVAL', 0)
+    return path
+
+
+def test_torn_last_line_is_cut_off(tmp_path):
+    path = str(tmp_path / 'torn.log')
+    _write_log(path, [{"seq": 1}, {"seq": 2}], torn='{"seq": 3, "op": "cla')
+    assert write_behind._read_events(path) == [{"seq": 1}, {"seq": 2}]
+    with open(path, encoding='utf-8') as log_file:
+        assert log_file.read() == '{"seq": 1}\n{"seq": 2}\n'
+
+
+def test_corrupt_line_inside_the_log_is_an_error(tmp_path):
+    path = str(tmp_path / 'corrupt.log')
+    _write_log(path, [{"seq": 1}])
+    _write_log(path, [], torn='not json\n')
+    _write_log(path, [{"seq": 3}])
+    with pytest.raises(RuntimeError, match='line 2'):
+        write_behind._read_events(path)
+
+
+def test_replay_applies_each_event_once(app, add_lot, add_user, write_behind_config):
+    lot_id = add_lot('Replay Garage', 3)
+    _client, user_id = add_user('replay1')
+    seq, reservation_id = _next_ids(app)
+    with app.app_context():
+        first, second = [row[0] for row in db.session.query(ParkingSpot.id).filter_by(lot_id=lot_id)
+                         .order_by(ParkingSpot.spot_number).limit(2)]
+    parked = datetime.utcnow().replace(microsecond=0) - timedelta(hours=2)
+    left = parked + timedelta(hours=1)
+    kept = _claim(seq, reservation_id, first, lot_id, user_id, parked)
+    released = _claim(seq + 1, reservation_id + 1, second, lot_id, user_id, parked)
+    _write_log(write_behind_config, [kept, released, _release(seq + 2, released, left, 10.0)],
+               torn='{"op": "claim", "reserv')
+
+    for _ in range(2):  # the second start finds everything already applied
+        writer = write_behind.Writer()
+        writer.start(app)
+        writer.stop()
+        with app.app_context():
+            reservations = {r.id: r for r in Reservation.query.filter(
+                Reservation.id.in_([reservation_id, reservation_id + 1]))}
+            assert reservations[reservation_id].leaving_timestamp is None
+            assert reservations[reservation_id + 1].leaving_timestamp == left
+            assert reservations[reservation_id + 1].parking_cost == 10.0
+            assert db.session.get(ParkingSpot, first).status == 'O'
+            assert db.session.get(ParkingSpot, second).status == 'A'
+            assert write_behind._checkpoint() == seq + 2
+
+
+def test_log_is_replayed_before_the_first_request(app, add_lot, add_user, write_behind_config, monkeypatch):
+    lot_id = add_lot('Restart Garage', 1)
+    _client, user_id = add_user('restart1')
+    seq, reservation_id = _next_ids(app)
+    with app.app_context():
+        spot_id = db.session.query(ParkingSpot.id).filter_by(lot_id=lot_id).scalar()
+    _write_log(write_behind_config, [_claim(seq, reservation_id, spot_id, lot_id, user_id, datetime.utcnow())])
+
+    monkeypatch.setattr(write_behind, 'writer', write_behind.Writer())
+    monkeypatch.setenv('WRITE_BEHIND_LOG', write_behind_config)
+    from app import create_app
+    restarted = create_app()
+    restarted.test_client().get('/login')  # not a booking
+    write_behind.writer.stop()
+    with app.app_context():
+        assert db.session.get(Reservation, reservation_id).spot_id == spot_id
@@ -0,0 +1,623 @@
+"""Write-behind bookings: claims and releases in memory, a durable event log, batched commits.
+
+With ``WRITE_BEHIND_LOG`` set, claiming and releasing spots (allocation.py)
+no longer commits to the database once per booking. Each claim or release
+is decided against this process's in-memory spot store and appended to an
+append-only event log. The request returns once the event is on disk; one
+fsync covers every event appended in the meantime (group commit). A
+background writer then applies the logged events to ``reservations``,
+``parking_spots``, the lot summaries and the rollups in batches of up to
+``WRITE_BEHIND_BATCH_SIZE``, one transaction per shard, and records the
+last event applied in that same transaction (``write_behind_checkpoints``).
+When the process starts (``init_app``; each gunicorn worker as it boots)
+the log is replayed past each shard's checkpoint, before any request is
+served, so after a crash nothing logged is lost, nothing is applied
+twice, and no page shows the database as it was before the crash.
+
+The store loads a lot's spots and active reservations from the database
+the first time the lot is booked, and is the source of truth for them from
+then on. Reservation ids are handed out by the store, from each shard's id
+range. Only one process may therefore book: the first one to do so locks
+the log, and any other gets a RuntimeError. Run a single worker
+(``WEB_WORKERS=1``, any number of threads), with the sweeper in-process,
+and nothing else that writes spots or reservations (``flask sweep``, bulk
+imports) while it is up.
+
+Pages that read reservations from the database (dashboard, history,
+reports, exports) see a booking once the writer has applied it, normally
+within ``WRITE_BEHIND_INTERVAL``. Admin changes to a lot's spots run
+inside ``exclusive(lot_id)``, which holds bookings back and applies
+everything pending first.
+"""
+import atexit
+import fcntl
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, insert, update
+
+from models import db, ParkingSpot, Reservation, WriteBehindCheckpoint, SHARD_ID_SPAN, reserve_id_range
+from spot_index import free_spots
+from booking_index import booking_index, end_checked_in
+import analytics
+import cache
+from availability import hub
+import reports
+import shards
+
+
+CHECKPOINT_ID = 1
+RETRY_SECONDS = 1
+DRAIN_TIMEOUT_SECONDS = 30
+# Bookings wait once this many batches are logged but not applied, so a writer that cannot keep up
+# slows bookings down instead of falling further and further behind.
+MAX_PENDING_BATCHES = 20
+WRITER_BEHIND = 'The write-behind writer is behind; check the log for failed batches.'
+STOP_TIMEOUT_SECONDS = 30
+
+Active = namedtuple('Active', 'id user_id spot_id lot_id vehicle_number parked_at')
+
+
+def enabled():
+    return bool(current_app.config.get('WRITE_BEHIND_LOG'))
+
+
+class EventLog:
+    """An append-only file of JSON events, one per line, numbered by ``seq``.
+
+    append() only buffers an event; sync(seq) returns once every event up
+    to seq is on disk. Whichever caller syncs first flushes everything
+    appended so far with a single fsync, which the others then share. Once
+    the file has grown past max_bytes and all of it is applied, it becomes
+    ``<path>.1``, replacing the previous one, and a new file is started.
+    """
+
+    def __init__(self, path, fsync=True, max_bytes=None):
+        self.path = path
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()       # appends
+        self._sync_lock = threading.Lock()  # one flush and fsync at a time
+        self._owner = None
+        self._file = None
+        self.last_seq = 0
+        self.synced_seq = 0
+
+    def open(self):
+        """Locks the log for this process and returns the events already in it, oldest first."""
+        owner = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            owner.close()
+            raise RuntimeError(f'The write-behind log {self.path} is in use by another process; '
+                               'write-behind bookings need a single worker process.') from None
+        self._owner = owner
+        events = _read_events(self.path + '.1') + _read_events(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return events
+
+    def resume(self, seq):
+        """Continues numbering after seq."""
+        self.last_seq = self.synced_seq = seq
+
+    def append(self, event):
+        """Numbers the event, buffers it and returns its seq."""
+        with self._lock:
+            self.last_seq += 1
+            event['seq'] = self.last_seq
+            self._file.write(json.dumps(event, separators=(',', ':')) + '\n')
+            return self.last_seq
+
+    def sync(self, seq):
+        if self.synced_seq >= seq:
+            return
+        with self._sync_lock:
+            if self.synced_seq >= seq:
+                return  # covered by the fsync we were waiting for
+            with self._lock:
+                self._file.flush()
+                last_seq = self.last_seq
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.synced_seq = last_seq
+
+    def rotate(self, applied_seq):
+        """Starts a new file if this one is past max_bytes and applied up to its end. Returns True if it did."""
+        with self._sync_lock, self._lock:
+            if not self.max_bytes or applied_seq < self.last_seq or self._file.tell() < self.max_bytes:
+                return False
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self.path, self.path + '.1')
+            self._file = open(self.path, 'a', encoding='utf-8')
+            return True
+
+    def close(self):
+        with self._sync_lock, self._lock:
+            self._file.close()
+        self._owner.close()
+
+
+def _read_events(path):
+    """The events in one log file. A torn last line, from a crash mid-append, is cut off the file."""
+    if not os.path.exists(path):
+        return []
+    events = []
+    with open(path, 'rb+') as log_file:
+        lines = log_file.readlines()
+        offset = 0
+        for number, line in enumerate(lines):
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('incomplete line')
+                events.append(json.loads(line))
+            except ValueError:
+                if number != len(lines) - 1:
+                    raise RuntimeError(f'{path} is corrupt at line {number + 1}') from None
+                log_file.truncate(offset)
+                break
+            offset += len(line)
+    return events
+
+
+class SpotStore:
+    """Spot states and active reservations of the lots booked in by this process, loaded per lot on first use.
+
+    Not thread-safe on its own: callers hold Writer.lock.
+    """
+
+    def __init__(self):
+        self._free = {}     # lot_id -> ids of its free spots
+        self._heaps = {}    # lot_id -> heap of (spot_number, spot_id); entries no longer in _free are skipped
+        self._spots = {}    # spot_id -> (lot_id, spot_number)
+        self._active = {}   # reservation id -> Active
+        self._last_id = {}  # shard name -> last reservation id handed out
+
+    def load(self, lot_id):
+        if lot_id in self._free:
+            return
+        with shards.use(shards.for_lot(lot_id)):
+            spots = db.session.query(ParkingSpot.id, ParkingSpot.spot_number, ParkingSpot.status)\
+                              .filter_by(lot_id=lot_id).all()
+            active = db.session.query(Reservation.id, Reservation.user_id, Reservation.spot_id,
+                                      Reservation.vechile_number, Reservation.parking_timestamp)\
+                               .join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
+                               .filter(ParkingSpot.lot_id == lot_id, Reservation.leaving_timestamp.is_(None)).all()
+        heap = []
+        for spot_id, number, status in spots:
+            self._spots[spot_id] = (lot_id, number)
+            if status == 'A':
+                heap.append((number, spot_id))
+        heapq.heapify(heap)
+        self._heaps[lot_id] = heap
+        self._free[lot_id] = {spot_id for _number, spot_id in heap}
+        for reservation_id, user_id, spot_id, vehicle_number, parked_at in active:
+            self._active[reservation_id] = Active(reservation_id, user_id, spot_id, lot_id, vehicle_number, parked_at)
+
+    def drop(self, lot_id):
+        """Forgets a lot, to be reloaded on its next booking. Only safe with none of its events pending."""
+        self._free.pop(lot_id, None)
+        self._heaps.pop(lot_id, None)
+        for spot_id in [spot_id for spot_id, (lot, _number) in self._spots.items() if lot == lot_id]:
+            del self._spots[spot_id]
+        for reservation_id in [r.id for r in self._active.values() if r.lot_id == lot_id]:
+            del self._active[reservation_id]
+
+    def lot_of(self, spot_id):
+        if spot_id not in self._spots:
+            with shards.use(shards.for_id(spot_id)):
+                lot_id = db.session.query(ParkingSpot.lot_id).filter_by(id=spot_id).scalar()
+            if lot_id is None:
+                return None
+            self.load(lot_id)
+        return self._spots[spot_id][0] if spot_id in self._spots else None
+
+    def take(self, lot_id, spot_id=None, skip=()):
+        """Marks spot_id, or the lot's lowest-numbered free spot not in skip, occupied. Returns its id or None."""
+        self.load(lot_id)
+        free = self._free[lot_id]
+        if spot_id is None:
+            heap = self._heaps[lot_id]
+            skipped = []
+            while heap and (heap[0][1] not in free or heap[0][1] in skip):
+                entry = heapq.heappop(heap)
+                if entry[1] in free:
+                    skipped.append(entry)
+            spot_id = heapq.heappop(heap)[1] if heap else None
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            if spot_id is None:
+                return None
+        elif spot_id not in free:
+            return None
+        free.discard(spot_id)
+        return spot_id
+
+    def active(self, reservation_id):
+        """The active reservation, or None if it is released or unknown."""
+        if reservation_id not in self._active:
+            with shards.use(shards.for_id(reservation_id)):
+                lot_id = db.session.query(ParkingSpot.lot_id)\
+                                   .join(Reservation, Reservation.spot_id == ParkingSpot.id)\
+                                   .filter(Reservation.id == reservation_id).scalar()
+            if lot_id is not None:
+                self.load(lot_id)
+        return self._active.get(reservation_id)
+
+    def open(self, active):
+        self._active[active.id] = active
+
+    def close(self, active):
+        del self._active[active.id]
+        lot_id, number = self._spots[active.spot_id]
+        self._free[lot_id].add(active.spot_id)
+        heapq.heappush(self._heaps[lot_id], (number, active.spot_id))
+
+    def next_reservation_id(self, shard):
+        if shard not in self._last_id:
+            with shards.use(shard):
+                last = db.session.query(func.max(Reservation.id)).scalar()
+            self._last_id[shard] = last or shards.names().index(shard) * SHARD_ID_SPAN
+        self._last_id[shard] += 1
+        return self._last_id[shard]
+
+
+class Writer:
+
+    def __init__(self):
+        # Held while a claim or release is decided and logged, so the log's order is the store's order.
+        self.lock = threading.RLock()
+        self._start_lock = threading.Lock()
+        self._applied = threading.Condition()
+        self._queue = queue.Queue()
+        self._thread = None
+        self.store = SpotStore()
+        self.log = None
+        self.applied_seq = 0
+        self.batches = 0
+        self.events = 0
+        self.errors = 0
+        self.last_error = None
+
+    def start(self, app):
+        """Replays the log into the database and starts the writer thread, once per process."""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            config = app.config
+            log = EventLog(config['WRITE_BEHIND_LOG'], config['WRITE_BEHIND_FSYNC'],
+                           config['WRITE_BEHIND_SEGMENT_BYTES'])
+            events = log.open()
+            batch_size = config['WRITE_BEHIND_BATCH_SIZE']
+            with app.app_context():
+                for start in range(0, len(events), batch_size):
+                    _apply(events[start:start + batch_size])
+                checkpoints = []
+                for name in shards.names():
+                    with shards.use(name):
+                        checkpoints.append(_checkpoint() or 0)
+            last_seq = max(checkpoints + [events[-1]['seq'] if events else 0])
+            log.resume(last_seq)
+            self.log = log
+            self.applied_seq = last_seq
+            self._thread = threading.Thread(target=self._run, args=(app,), daemon=True, name='write-behind')
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Applies everything logged and stops the writer thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(STOP_TIMEOUT_SECONDS)
+        if not self._thread.is_alive():
+            self.log.close()
+
+    def _wait_for_writer(self):
+        limit = MAX_PENDING_BATCHES * current_app.config['WRITE_BEHIND_BATCH_SIZE']
+        if self.log.last_seq - self.applied_seq < limit:
+            return
+        with self._applied:
+            if not self._applied.wait_for(lambda: self.log.last_seq - self.applied_seq < limit,
+                                          DRAIN_TIMEOUT_SECONDS):
+                raise RuntimeError(WRITER_BEHIND)
+
+    def _record(self, event):
+        seq = self.log.append(event)
+        self._queue.put(event)
+        return seq
+
+    def claim(self, lot_id, spot_id, user_id, vehicle_number, skip=()):
+        """Takes spot_id, or the lowest-numbered free spot of lot_id not in skip. Returns an Active or None."""
+        self._wait_for_writer()
+        now = datetime.utcnow()
+        with self.lock:
+            if spot_id is not None:
+                lot_id = self.store.lot_of(spot_id)
+                if lot_id is None:
+                    return None
+            spot_id = self.store.take(lot_id, spot_id, skip)
+            if spot_id is None:
+                return None
+            active = Active(self.store.next_reservation_id(shards.for_id(spot_id)),
+                            user_id, spot_id, lot_id, vehicle_number, now)
+            self.store.open(active)
+            seq = self._record({"op": "claim", "reservation": active.id, "spot": spot_id, "lot": lot_id,
+                                "user": user_id, "vehicle": vehicle_number, "at": now.isoformat()})
+        self.log.sync(seq)
+        return active
+
+    def release(self, costs, leaving_timestamp):
+        """Closes the active reservations among costs (reservation id -> cost). Returns the Actives closed."""
+        self._wait_for_writer()
+        released, seq = [], 0
+        with self.lock:
+            for reservation_id, cost in costs.items():
+                active = self.store.active(reservation_id)
+                if active is None:
+                    continue
+                self.store.close(active)
+                seq = self._record({"op": "release", "reservation": active.id, "spot": active.spot_id,
+                                    "lot": active.lot_id, "user": active.user_id,
+                                    "parked": active.parked_at.isoformat(), "at": leaving_timestamp.isoformat(),
+                                    "cost": cost})
+                released.append(active)
+        if released:
+            self.log.sync(seq)
+        return released
+
+    def active(self, reservation_id):
+        with self.lock:
+            return self.store.active(reservation_id)
+
+    def drain(self, timeout=DRAIN_TIMEOUT_SECONDS):
+        """Waits until every event logged so far is in the database."""
+        target = self.log.last_seq
+        with self._applied:
+            if not self._applied.wait_for(lambda: self.applied_seq >= target, timeout):
+                raise RuntimeError(WRITER_BEHIND)
+
+    @contextmanager
+    def exclusive(self, lot_id):
+        with self.lock:
+            self.drain()
+            try:
+                yield
+            finally:
+                self.store.drop(lot_id)
+
+    def _next_batch(self, size, interval):
+        event = self._queue.get()
+        if event is None:
+            return None
+        if interval:
+            time.sleep(interval)  # let more events arrive, so they share the commit
+        batch = [event]
+        while len(batch) < size:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is None:
+                self._queue.put(None)  # stop after this batch
+                break
+            batch.append(event)
+        return batch
+
+    def _run(self, app):
+        config = app.config
+        while True:
+            batch = self._next_batch(config['WRITE_BEHIND_BATCH_SIZE'], config['WRITE_BEHIND_INTERVAL'])
+            if batch is None:
+                return
+            # Only what is durable in the log reaches the database, so a replay can never miss an applied event.
+            self.log.sync(batch[-1]['seq'])
+            with app.app_context():
+                while True:
+                    try:
+                        _apply(batch)
+                        break
+                    except Exception as e:
+                        db.session.rollback()
+                        self.errors += 1
+                        self.last_error = repr(e)
+                        app.logger.exception('Write-behind batch failed; retrying')
+                        time.sleep(RETRY_SECONDS)
+                with self._applied:
+                    self.applied_seq = batch[-1]['seq']
+                    self.batches += 1
+                    self.events += len(batch)
+                    self._applied.notify_all()
+                for lot_id in {event['lot'] for event in batch}:
+                    hub.publish(lot_id)
+                for user_id in {event['user'] for event in batch}:
+                    cache.invalidate_bookings(user_id)
+            self.log.rotate(self.applied_seq)
+
+    def stats(self):
+        with self._applied:
+            return {
+                "logged": self.log.last_seq if self.log else 0,
+                "applied": self.applied_seq,
+                "pending": (self.log.last_seq - self.applied_seq) if self.log else 0,
+                "batches": self.batches,
+                "events": self.events,
+                "errors": self.errors,
+                "last_error": self.last_error,
+            }
+
+
+writer = Writer()
+
+
+def _checkpoint():
+    return db.session.query(WriteBehindCheckpoint.seq).filter_by(id=CHECKPOINT_ID).scalar()
+
+
+def _apply(events):
+    """Writes events to their shards, one transaction per shard. Events a shard already has are skipped."""
+    by_shard = defaultdict(list)
+    for event in events:
+        by_shard[shards.for_id(event['spot'])].append(event)
+    for name, shard_events in by_shard.items():
+        with shards.use(name):
+            _apply_shard(shard_events)
+
+
+def _apply_shard(events):
+    done = _checkpoint()
+    events = [event for event in events if event['seq'] > (done or 0)]
+    if not events:
+        db.session.rollback()
+        return
+
+    opened, closed, statuses = {}, {}, {}
+    changes = defaultdict(lambda: [0, 0.0])  # lot_id -> [net claims, revenue], for the lot summaries
+    bookings, releases = [], []
+    leaving = {}  # reservation id -> leaving timestamp, for checked-in bookings
+    for event in events:
+        at = datetime.fromisoformat(event['at'])
+        if event['op'] == 'claim':
+            opened[event['reservation']] = {
+                "id": event['reservation'], "user_id": event['user'], "spot_id": event['spot'],
+                "vechile_number": event['vehicle'], "parking_timestamp": at,
+                "leaving_timestamp": None, "parking_cost": None,
+            }
+            statuses[event['spot']] = 'O'
+            changes[event['lot']][0] += 1
+            bookings.append((event['lot'], at))
+        else:
+            values = {"leaving_timestamp": at, "parking_cost": event['cost']}
+            if event['reservation'] in opened:
+                opened[event['reservation']].update(values)  # booked and released within the batch
+            else:
+                closed[event['reservation']] = {"id": event['reservation'], **values}
+            leaving[event['reservation']] = at
+            statuses[event['spot']] = 'A'
+            changes[event['lot']][0] -= 1
+            changes[event['lot']][1] += event['cost'] or 0
+            releases.append((event['lot'], datetime.fromisoformat(event['parked']), at, event['cost']))
+
+    if opened:
+        db.session.execute(insert(Reservation), list(opened.values()))
+    if closed:
+        db.session.execute(update(Reservation), list(closed.values()))
+    for status in ('O', 'A'):
+        spot_ids = [spot_id for spot_id, final in statuses.items() if final == status]
+        if spot_ids:
+            db.session.execute(
+                update(ParkingSpot)
+                .where(ParkingSpot.id.in_(spot_ids))
+                .values(status=status)
+                .execution_options(synchronize_session=False)
+            )
+    reports.record_changes(changes)
+    analytics.record_activity(bookings, releases)
+    ended = end_checked_in(leaving) if leaving else []
+
+    last_seq = events[-1]['seq']
+    if done is None:
+        db.session.execute(insert(WriteBehindCheckpoint).values(id=CHECKPOINT_ID, seq=last_seq))
+    else:
+        db.session.execute(update(WriteBehindCheckpoint).where(WriteBehindCheckpoint.id == CHECKPOINT_ID)
+                           .values(seq=last_seq))
+    connection = db.session.connection(bind_arguments={"mapper": Reservation})
+    if connection.dialect.name != 'sqlite':
+        # The ids came from the store, not the sequence; keep the sequence ahead of them.
+        reserve_id_range(connection, 'reservations', 0)
+    db.session.commit()
+    for window in ended:
+        booking_index.remove(*window)
+
+
+def _writer():
+    writer.start(current_app._get_current_object())
+    return writer
+
+
+def _as_reservation(active):
+    # Transient: the row may not be written yet, so it is never added to the session.
+    return Reservation(id=active.id, user_id=active.user_id, spot_id=active.spot_id,
+                       vechile_number=active.vehicle_number, parking_timestamp=active.parked_at)
+
+
+def claim(lot_id, spot_id, user_id, vehicle_number, skip=()):
+    """Books spot_id, or any free spot of lot_id not in skip. Returns a transient Reservation, or None."""
+    active = _writer().claim(lot_id, spot_id, user_id, vehicle_number, skip)
+    if active is None:
+        return None
+    free_spots.mark_occupied(active.spot_id)
+    return _as_reservation(active)
+
+
+def release(costs, leaving_timestamp):
+    """Releases the active reservations among costs (reservation id -> cost). Returns the number released."""
+    released = _writer().release(costs, leaving_timestamp)
+    for active in released:
+        free_spots.mark_free(active.spot_id)
+    return len(released)
+
+
+def active_reservation(reservation_id):
+    """The reservation as a transient Reservation if it is active, written yet or not; otherwise None."""
+    active = _writer().active(reservation_id)
+    return _as_reservation(active) if active else None
+
+
+def drain():
+    """Waits until everything booked or released so far is in the database. Does nothing without write-behind."""
+    if enabled():
+        _writer().drain()
+
+
+@contextmanager
+def exclusive(lot_id):
+    """Holds bookings back and applies everything pending, while an admin changes a lot's spots.
+
+    The lot is reloaded from the database on its next booking. Does nothing without write-behind.
+    """
+    if not enabled():
+        yield
+        return
+    with _writer().exclusive(lot_id):
+        yield
+
+
+def start(app):
+    """Replays the log into the database and starts the writer. Does nothing without write-behind."""
+    if app.config['WRITE_BEHIND_LOG']:
+        writer.start(app)
+
+
+def init_app(app):
+    if not app.config['WRITE_BEHIND_LOG']:
+        return
+
+    @app.before_request
+    def start_writer():
+        # The writer locks the log, so it starts in the serving process, never in a preloading gunicorn
+        # master. Gunicorn workers start it as they boot (gunicorn.conf.py); this covers other servers,
+        # before their first request of any kind is answered from pre-crash data.
+        writer.start(app)
+
+
+def replay():
+    """Applies the log to the database and stops. Returns the last event applied."""
+    _writer().stop()
+    return writer.applied_seq
+
+
+def stats():
+    return writer.stats()